@@ -0,0 +1,186 @@
+import time
+
+import numpy as np
+
+import spincam
+import stage
+import frameproc
+
+# Autofocus - a coarse sweep of the focus stage around the current z finds the peak of a focus
+# metric, then a parabola through the best coarse plane and its neighbours is refined with a few
+# fine planes. Every plane is scored on a centred ROI of the frame, optionally binned, so scoring
+# is cheap. Interferometric contrast oscillates with defocus, so the coarse step must stay well
+# below the oscillation period or the sweep can land on a side lobe. Every plane, and the focus
+# the stage is left at, is approached from below, so backlash of a geared z stage is the same for
+# all of them.
+__METRIC = 'contrast'
+__RANGE = 4.0  # um searched either side of the current z
+__COARSE_STEP = 1.0  # um
+__FINE_STEP = 0.25  # um
+__ROI_SIZE = 512  # pixels of the centred ROI that is scored; None scores the full frame
+__BIN = 1
+
+# A sweep has passed the peak once the last __PEAK_PLANES scores all fell by more than
+# __PEAK_DROP of the peak's height above the lowest score, and that height is at least
+# __PEAK_PROMINENCE of the peak, so noise on a flat sweep never counts as a peak
+__PEAK_DROP = 0.5
+__PEAK_PLANES = 2
+__PEAK_PROMINENCE = 0.1
+
+
+def __crop(data, roi_size):
+    # Returns centred roi_size x roi_size view of data
+
+    if roi_size is None:
+        return data
+    height, width = data.shape
+    offset_y = max(0, (height - roi_size) // 2)
+    offset_x = max(0, (width - roi_size) // 2)
+    return data[offset_y:offset_y + roi_size, offset_x:offset_x + roi_size]
+
+
+def __move_to(state, z_pos):
+    # Moves focus stage to "z_pos" um relative to the start, approaching it from below; a move
+    # down first overshoots by state['overshoot'] um
+
+    if z_pos < state['z']:
+        __move(state, z_pos - state['overshoot'])
+    __move(state, z_pos)
+
+
+def __move(state, z_pos):
+    # Moves focus stage straight to "z_pos" um relative to the start
+
+    if z_pos != state['z']:
+        stage.__go_z(z_pos - state['z'])
+        state['z'] = z_pos
+        state['moves'] += 1
+
+        # Frames exposed while moving are not scored
+        spincam.mark_stale()
+
+
+def __score_frame(data, metric, roi_size, factor):
+    # Focus score of the centred ROI of data, binned by "factor"
+
+    data = __crop(data, roi_size)
+    if factor > 1:
+        data = frameproc.bin_frame(data, factor)
+    return frameproc.focus_metric(data, metric)
+
+
+def __score(state, z_pos, params):
+    # Moves to "z_pos", acquires and scores a plane
+
+    __move_to(state, z_pos)
+    image_dict = spincam.get_image_and_avg(params['num_to_avg'])
+    state['frames'] += params['num_to_avg']
+
+    score = __score_frame(image_dict['data'], params['metric'], params['roi_size'],
+                          params['factor'])
+    state['points'].append((z_pos, score))
+    return score
+
+
+def __vertex(z_pos, scores):
+    # Peak of the parabola through three planes, kept within them; the best plane if the points
+    # don't form a peak
+
+    coeffs = np.polyfit(z_pos, scores, 2)
+    best = z_pos[int(np.argmax(scores))]
+    if coeffs[0] >= 0:
+        return best
+    return float(np.clip(-coeffs[1] / (2 * coeffs[0]), min(z_pos), max(z_pos)))
+
+
+def __peak(z_pos, scores):
+    # Peak of a sweep; parabola through the best plane and its neighbours
+
+    if len(scores) < 3:
+        return z_pos[int(np.argmax(scores))]
+    index = min(max(int(np.argmax(scores)), 1), len(scores) - 2)
+    return __vertex(z_pos[index - 1:index + 2], scores[index - 1:index + 2])
+
+
+def __passed_peak(scores, drop, num_planes):
+    # True once the last "num_planes" scores all lie below the peak by more than "drop" of its
+    # height above the lowest score
+
+    best = int(np.argmax(scores))
+    height = scores[best] - min(scores)
+    if len(scores) - best <= num_planes or height < __PEAK_PROMINENCE * abs(scores[best]):
+        return False
+    return max(scores[-num_planes:]) < scores[best] - drop * height
+
+
+def __find_focus(params):
+    # Coarse sweep, then parabolic refinement; leaves the stage at the focus and returns the
+    # offset from the start position
+
+    state = {'z': 0.0, 'overshoot': params['coarse_step'], 'moves': 0, 'frames': 0, 'points': []}
+    tic = time.perf_counter()
+    try:
+        # Coarse sweep upwards
+        num_coarse = int(round(params['range'] / params['coarse_step']))
+        coarse_z = [k * params['coarse_step'] for k in range(-num_coarse, num_coarse + 1)]
+        coarse_scores = [__score(state, z_pos, params) for z_pos in coarse_z]
+
+        # Parabola through the best coarse plane and its neighbours, then one through fine planes
+        # around its peak, swept upwards again
+        estimate = __peak(coarse_z, coarse_scores)
+        fine_z = [estimate - params['fine_step'], estimate, estimate + params['fine_step']]
+        fine_scores = [__score(state, z_pos, params) for z_pos in fine_z]
+        focus = __vertex(fine_z, fine_scores)
+
+        __move_to(state, focus)
+    except:  # pylint: disable=bare-except
+        # Stage goes back to where it was, so a failed search never leaves it out of focus
+        __move_to(state, 0.0)
+        raise
+
+    return {'z': focus,
+            'score': max(fine_scores),
+            'frames': state['frames'],
+            'moves': state['moves'],
+            'time': time.perf_counter() - tic,
+            'points': state['points']}
+
+
+### Public Functions ###
+
+def find_focus(search_range=__RANGE, coarse_step=__COARSE_STEP, fine_step=__FINE_STEP,
+               metric=__METRIC, num_to_avg=1, roi_size=__ROI_SIZE, factor=__BIN):
+    # Moves the focus stage to the peak of the focus "metric" (one of
+    # frameproc.focus_metrics()) within "search_range" um of the current z, scoring planes
+    # averaged over "num_to_avg" frames on a centred "roi_size" ROI binned by "factor". Needs a
+    # running capture engine and connected stages. Returns the focus 'z' relative to the start in
+    # um, its 'score', the 'frames', stage 'moves' and seconds ('time') used, and the scored
+    # 'points' as (z, score).
+    if coarse_step <= 0 or fine_step <= 0 or search_range < coarse_step:
+        raise RuntimeError('Search range must be at least one coarse step, and steps must be '
+                           'positive.')
+    return __find_focus({'range': search_range,
+                         'coarse_step': coarse_step,
+                         'fine_step': fine_step,
+                         'metric': metric,
+                         'num_to_avg': num_to_avg,
+                         'roi_size': roi_size,
+                         'factor': factor})
+
+
+def score(data, metric=__METRIC, roi_size=__ROI_SIZE, factor=__BIN):
+    # Returns focus score of a frame the way find_focus() scores planes
+    return __score_frame(data, metric, roi_size, factor)
+
+
+def peak(z_pos, scores):
+    # Returns z of the peak of a sweep of "scores" at "z_pos", refined by a parabola through the
+    # best plane and its neighbours
+    return __peak(list(z_pos), list(scores))
+
+
+def passed_peak(scores, drop=__PEAK_DROP, num_planes=__PEAK_PLANES):
+    # Returns True once a sweep has clearly passed the peak of its "scores": the last
+    # "num_planes" scores all lie below the peak by more than "drop" of its height above the
+    # lowest score
+    return __passed_peak(list(scores), drop, num_planes)
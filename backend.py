@@ -0,0 +1,43 @@
+import os
+
+# Hardware backends can be swapped for simulated ones (simspin, simapt, simserial) so the
+# acquisition pipeline runs without the microscope. Selected with the SPINACQ_BACKEND environment
+# variable, or per device with SPINACQ_CAM_BACKEND, SPINACQ_STAGE_BACKEND and SPINACQ_LED_BACKEND.
+__BACKENDS = ('hardware', 'sim')
+__DEVICES = ('cam', 'stage', 'led')
+__DEFAULT = 'hardware'
+
+
+def __get(device):
+    # Returns backend selected for device
+
+    if device not in __DEVICES:
+        raise RuntimeError('Device: "' + str(device) + '" is not supported. Options are: ' +
+                           str(__DEVICES))
+
+    backend = os.environ.get('SPINACQ_' + device.upper() + '_BACKEND',
+                             os.environ.get('SPINACQ_BACKEND', __DEFAULT)).lower()
+    if backend not in __BACKENDS:
+        raise RuntimeError('Backend: "' + backend + '" is not supported. Options are: ' +
+                           str(__BACKENDS))
+
+    return backend
+
+
+### Public Functions ###
+
+def get(device):
+    # Returns 'hardware' or 'sim' for 'cam', 'stage' or 'led'
+    return __get(device)
+
+
+def is_sim(device):
+    # Returns True if device uses the simulated backend
+    return __get(device) == 'sim'
+
+
+def use_sim(devices=__DEVICES):
+    # Selects simulated backends; must be called before spincam, stage or ledserial are imported
+    for device in devices:
+        __get(device)
+        os.environ['SPINACQ_' + device.upper() + '_BACKEND'] = 'sim'
@@ -0,0 +1,455 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import datetime
+import functools
+import tempfile
+import subprocess
+
+import numpy as np
+
+import backend
+
+# End-to-end acquisition benchmark. Runs the acquisition paths of spin_withstage against the
+# simulated camera, stage and LED (see backend.py) without a GUI window and stores the results as
+# JSON, so runs can be compared across versions:
+#
+#   python benchmark.py --output before.json
+#   python benchmark.py --output after.json --compare before.json
+#
+# Every scenario runs in its own process so peak RSS and module state are per scenario.
+
+# Default params; every one can be overridden from the command line
+__PARAMS = {'num_to_avg': 10,  # frames averaged per plane
+            'num_images': 8,  # planes for save/fourcolor scenarios, time points for defocus
+            'num_z_step': 2,  # defocus radius in steps
+            'z_step': 1.0,  # um
+            'exposure': 5000.0,  # us
+            'warmup': 2}  # planes acquired before measuring
+
+# Metrics compared by --compare, and whether higher is better (None: reported, never flagged).
+# 'frames_per_s' counts frames averaged into planes (including autofocus); 'camera_frames_per_s'
+# is what the camera delivered, whether or not anything used it.
+__COMPARE_METRICS = (('frames_per_s', True),
+                     ('camera_frames_per_s', None),
+                     ('planes_per_s', True),
+                     ('plane_latency_p50_s', False),
+                     ('plane_latency_p99_s', False),
+                     ('write_mb_per_s', True),
+                     ('peak_rss_mb', False),
+                     ('stage_idle_fraction', None))
+# Startup metrics, measured in a fresh process
+__COMPARE_STARTUP = (('import_s', False),
+                     ('system_init_s', None))
+__THRESHOLD = 0.1  # relative change flagged as a regression
+
+
+def __import_sim():
+    # Imports acquisition modules with simulated backends; must happen before anything imports
+    # spincam, stage or ledserial
+    backend.use_sim()
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+    import spincam
+    import stage
+    import tiffwriter
+    import spin_withstage
+
+    return spincam, stage, tiffwriter, spin_withstage
+
+
+def __instrument(module, name, on_call):
+    # Replaces module.name with a wrapper calling on_call(tic, toc) after every call. Callers look
+    # the function up on the module at call time, so this also catches calls from other modules.
+    func = getattr(module, name)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        tic = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            on_call(tic, time.perf_counter())
+
+    setattr(module, name, wrapper)
+
+
+def __peak_rss_mb():
+    # Returns peak resident set size of this process in MB, or None if it cannot be read
+
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD),
+                        ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t),
+                        ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t),
+                        ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters),
+                                                        counters.cb):
+            return None
+        return counters.PeakWorkingSetSize / 2**20
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+### Checks ###
+
+def __check_averaging():
+    # Robust averaging modes must reject a single outlier frame in a 10 frame average; a timing
+    # of modes that quietly fall back to the mean would be meaningless
+    import frameproc
+
+    rng = np.random.RandomState(0)
+    frames = [rng.normal(1000, 10, (16, 16)).astype(np.uint16) for _ in range(10)]
+    frames[0][8, 8] = 60000
+    for mode in ('median', 'sigma_clip'):
+        value = int(frameproc.average_frames(frames, mode)[8, 8])
+        if abs(value - 1000) > 30:
+            raise RuntimeError('Averaging mode: "' + mode + '" kept an outlier frame (' +
+                               str(value) + ' instead of about 1000).')
+
+
+### Scenarios ###
+
+def __scenario_get_image_and_avg(modules, params, planes):
+    # Averaged acquisition only; no writes
+    spincam = modules[0]
+
+    for _ in range(params['num_images']):
+        image_dict = spincam.get_image_and_avg(params['num_to_avg'])
+        if 'data' in image_dict:
+            planes.append(time.perf_counter())
+
+
+def __save_images(modules, params, stack):
+    # Writes one averaged frame num_images times, so the writer is measured on its own
+    spincam, _, tiffwriter, spin_withstage = modules
+
+    data = spincam.get_image_and_avg(params['num_to_avg'])['data']
+    img_name = spin_withstage.__fix_name()
+
+    stack_name = None
+    if stack:
+        stack_name = img_name + '.tiff'
+        tiffwriter.open_stack(stack_name, (params['num_images'],), 'TYX')
+
+    for ii in range(params['num_images']):
+        spin_withstage.__save_images(img_name, data, ii, 0, stack_name)
+
+    if stack_name is not None:
+        tiffwriter.close_stack(stack_name)
+    tiffwriter.flush()
+
+
+def __scenario_save_images(modules, params, _):
+    __save_images(modules, params, False)
+
+
+def __scenario_save_images_stack(modules, params, _):
+    __save_images(modules, params, True)
+
+
+def __scenario_save_fourcolor(modules, _, __):
+    spin_withstage = modules[3]
+    spin_withstage.__save_fourcolor(None)
+
+
+def __scenario_save_fourcolor_sequence(modules, _, __):
+    spin_withstage = modules[3]
+    spin_withstage.__LED_MODE = 'trigger'
+    spin_withstage.__save_fourcolor(None)
+
+
+def __scenario_defocus_acquisition(modules, _, __):
+    spin_withstage = modules[3]
+    spin_withstage.__defocus_acquisition()
+
+
+def __scenario_defocus_acquisition_stack(modules, _, __):
+    spin_withstage = modules[3]
+    spin_withstage.__OUTPUT_MODE = 'stack'
+    spin_withstage.__defocus_acquisition()
+
+
+def __scenario_mosaic(modules, _, __):
+    spin_withstage = modules[3]
+    spin_withstage.__mosaic_acquisition()
+
+
+__SCENARIOS = {'get_image_and_avg': __scenario_get_image_and_avg,
+               'save_images': __scenario_save_images,
+               'save_images_stack': __scenario_save_images_stack,
+               'save_fourcolor': __scenario_save_fourcolor,
+               'save_fourcolor_sequence': __scenario_save_fourcolor_sequence,
+               'defocus_acquisition': __scenario_defocus_acquisition,
+               'defocus_acquisition_stack': __scenario_defocus_acquisition_stack,
+               'mosaic': __scenario_mosaic}
+
+
+def __setup(modules, params, directory):
+    # Builds the (hidden) GUI, connects simulated devices and starts the stream
+    spincam, stage, tiffwriter, spin_withstage = modules
+
+    spin_withstage.__GUI_DICT = spin_withstage.__spincam_gui()
+    gui_dict = spin_withstage.__GUI_DICT
+    tiffwriter.start(spin_withstage.__WRITER_DEPTH, spin_withstage.__WRITER_THREADS)
+    stage.__connect_stages()
+
+    # Simulated positions never touch the positions file of the real stage
+    spin_withstage.positions.set_file(os.path.join(directory, 'positions.json'))
+    spin_withstage.__find_and_init_cam()
+
+    # Widgets run their callbacks, so values are applied exactly as from the GUI
+    gui_dict['directory_text'].set_val(directory)
+    gui_dict['name_format_text'].set_val('bench')
+    gui_dict['avg_images_text'].set_val(params['num_to_avg'])
+    gui_dict['num_images_text'].set_val(params['num_images'])
+    gui_dict['exposure_text'].set_val(params['exposure'])
+    gui_dict['stage_dict']['z_step_text1'].set_val(params['z_step'])
+    gui_dict['stage_dict']['step_num_text'].set_val(params['num_z_step'])
+    gui_dict['stage_dict']['time_btwn_z_text'].set_val(0)
+
+    spin_withstage.__ensure_stream()
+    for _ in range(params['warmup']):
+        spincam.get_image_and_avg(params['num_to_avg'])
+
+
+def __run_scenario(name, params, directory):
+    # Runs scenario in this process and returns its metrics
+    modules = __import_sim()
+    spincam, stage, tiffwriter, spin_withstage = modules
+
+    __setup(modules, params, directory)
+
+    # A plane is done when it is handed to the writer (or acquired, if nothing is written)
+    planes = []
+    frames = []
+    stage_moves = []
+    __instrument(spincam.frameproc, 'add_frame', lambda tic, toc: frames.append(toc))
+    for func_name in ('submit', 'submit_plane'):
+        __instrument(tiffwriter, func_name, lambda tic, toc: planes.append(toc))
+    for func_name in ('__go_x', '__go_y', '__go_z', '__wait_moves'):
+        __instrument(stage, func_name, lambda tic, toc: stage_moves.append(toc - tic))
+
+    cam_start = spincam.get_capture_stats()
+    writer_start = tiffwriter.get_stats()
+    tic = time.perf_counter()
+    __SCENARIOS[name](modules, params, planes)
+    toc = time.perf_counter()
+    cam_end = spincam.get_capture_stats()
+    writer_end = tiffwriter.get_stats()
+
+    spin_withstage.__stop_stream()
+    tiffwriter.stop()
+
+    wall_time = toc - tic
+    latencies = np.diff([tic] + planes)
+    num_bytes = writer_end['bytes'] - writer_start['bytes']
+    write_time = writer_end['write_time'] - writer_start['write_time']
+    stage_time = sum(stage_moves)
+
+    result = {'wall_time_s': wall_time,
+              'frames': len(frames),
+              'frames_per_s': len(frames) / wall_time,
+              'camera_frames': cam_end['frames'] - cam_start['frames'],
+              'camera_frames_per_s': (cam_end['frames'] - cam_start['frames']) / wall_time,
+              'dropped': cam_end['dropped'] - cam_start['dropped'],
+              'incomplete': cam_end['incomplete'] - cam_start['incomplete'],
+              'overruns': cam_end['overruns'] - cam_start['overruns'],
+              'planes': len(planes),
+              'planes_per_s': len(planes) / wall_time,
+              'write_mb': num_bytes / 2**20,
+              'write_mb_per_s': num_bytes / 2**20 / wall_time,
+              'writer_mb_per_s': num_bytes / 2**20 / write_time if write_time > 0 else None,
+              'writer_blocked_s': writer_end['blocked_time'] - writer_start['blocked_time'],
+              'peak_rss_mb': __peak_rss_mb(),
+              'stage_moves': len(stage_moves),
+              'stage_busy_s': stage_time,
+              'stage_idle_fraction': 1 - stage_time / wall_time if stage_moves else None}
+    for percentile in (50, 90, 99):
+        result['plane_latency_p%d_s' % percentile] = \
+            float(np.percentile(latencies, percentile)) if len(latencies) else None
+    result['plane_latency_max_s'] = float(latencies.max()) if len(latencies) else None
+
+    return result
+
+
+def __run_child(name, params):
+    # Runs scenario in a fresh process; returns metrics or raises with the child's output
+    with tempfile.TemporaryDirectory(prefix='spinbench_') as directory:
+        result_file = os.path.join(directory, 'result.json')
+        data_dir = os.path.join(directory, 'data')
+        os.mkdir(data_dir)
+
+        cmd = [sys.executable, os.path.abspath(__file__),
+               '--child', name,
+               '--params', json.dumps(params),
+               '--data-dir', data_dir,
+               '--result-file', result_file]
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              universal_newlines=True)
+        if proc.returncode != 0 or not os.path.isfile(result_file):
+            raise RuntimeError('Scenario "' + name + '" failed:\n' + proc.stdout)
+
+        with open(result_file) as file:
+            return json.load(file)
+
+
+def __run_startup():
+    # Times importing spin_withstage and creating the (simulated) Spinnaker system in a fresh
+    # process; nothing is imported before the timer starts
+    code = ('import sys, time\n'
+            'tic = time.perf_counter()\n'
+            'import backend\n'
+            'backend.use_sim()\n'
+            'import spin_withstage, spincam\n'
+            'import_s = time.perf_counter() - tic\n'
+            'spincam.list_cams()\n'
+            'import json\n'
+            'with open(sys.argv[1], "w") as file:\n'
+            '    json.dump({"import_s": import_s,\n'
+            '               "system_init_s": spincam.get_system_init_time()}, file)\n')
+    with tempfile.TemporaryDirectory(prefix='spinbench_') as directory:
+        result_file = os.path.join(directory, 'startup.json')
+        proc = subprocess.run([sys.executable, '-c', code, result_file],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              universal_newlines=True)
+        if proc.returncode != 0 or not os.path.isfile(result_file):
+            raise RuntimeError('Startup measurement failed:\n' + proc.stdout)
+
+        with open(result_file) as file:
+            return json.load(file)
+
+
+def __git_version():
+    # Returns "git describe" of the source tree, or None outside a checkout
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def __compare(old, new, threshold):
+    # Prints metrics of new vs old results; returns number of regressions
+    num_regressions = 0
+
+    print('Comparing ' + str(new['version']) + ' against ' + str(old['version']))
+    for name, metrics in [('startup', new.get('startup', {}))] + list(new['scenarios'].items()):
+        old_metrics = old.get('startup') if name == 'startup' else old['scenarios'].get(name)
+        if not old_metrics:
+            continue
+        print(name)
+        for metric, higher_is_better in (__COMPARE_STARTUP if name == 'startup' else
+                                         __COMPARE_METRICS):
+            old_val = old_metrics.get(metric)
+            new_val = metrics.get(metric)
+            if old_val is None or new_val is None:
+                continue
+            change = (new_val - old_val) / old_val if old_val else 0.0
+            regressed = False
+            if higher_is_better is not None:
+                regressed = (change < -threshold) if higher_is_better else (change > threshold)
+            num_regressions += regressed
+            print('  %-22s %12.4g -> %12.4g  %+7.1f%%%s' % (metric, old_val, new_val, 100 * change,
+                                                           '  REGRESSION' if regressed else ''))
+
+    return num_regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end acquisition benchmark against the '
+                                                 'simulated camera, stage and LED.')
+    parser.add_argument('--scenarios', nargs='+', choices=list(__SCENARIOS),
+                        default=list(__SCENARIOS))
+    parser.add_argument('--output', help='JSON file results are written to')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=__THRESHOLD,
+                        help='relative change reported as a regression')
+    for key, value in __PARAMS.items():
+        parser.add_argument('--' + key.replace('_', '-'), type=type(value), default=value)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--params', help=argparse.SUPPRESS)
+    parser.add_argument('--data-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = __run_scenario(args.child, json.loads(args.params), args.data_dir)
+        with open(args.result_file, 'w') as file:
+            json.dump(result, file)
+        return 0
+
+    __check_averaging()
+
+    params = {key: getattr(args, key) for key in __PARAMS}
+    results = {'version': __git_version(),
+               'timestamp': datetime.datetime.now().isoformat(),
+               'platform': {'system': platform.platform(),
+                            'machine': platform.machine(),
+                            'python': platform.python_version(),
+                            'numpy': np.__version__,
+                            'cpu_count': os.cpu_count()},
+               'params': params,
+               'scenarios': {}}
+
+    print('Measuring startup...')
+    results['startup'] = __run_startup()
+    print('  import %.3f s, Spinnaker system %.3f s' % (results['startup']['import_s'],
+                                                       results['startup']['system_init_s'] or 0))
+
+    for name in args.scenarios:
+        print('Running ' + name + '...')
+        result = __run_child(name, params)
+        results['scenarios'][name] = result
+        print('  %.1f frames/s (camera %.1f), %.2f planes/s, p50 %.3f s, p99 %.3f s, '
+              '%.1f MB/s written, peak RSS %s MB' %
+              (result['frames_per_s'], result['camera_frames_per_s'], result['planes_per_s'],
+               result['plane_latency_p50_s'] or 0,
+               result['plane_latency_p99_s'] or 0,
+               result['write_mb_per_s'],
+               '%.0f' % result['peak_rss_mb'] if result['peak_rss_mb'] else '-'))
+        if result['stage_idle_fraction'] is not None:
+            print('  stage idle %.1f%%' % (100 * result['stage_idle_fraction']))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print('Results written to ' + args.output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            old = json.load(file)
+        if __compare(old, results, args.threshold):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,402 @@
+import threading
+import numpy as np
+
+# Averaging modes - 'median' and 'sigma_clip' hold every frame of an average in memory, so they
+# average at most __MAX_STACK_FRAMES frames (about 380 MB at 2736x2192)
+__AVG_MODES = ('mean', 'median', 'sigma_clip')
+__SIGMA = 3.0
+__MAX_STACK_FRAMES = 32
+
+# sigma_clip measures the spread of each pixel by its median absolute deviation, scaled by
+# __MAD_TO_STD to a standard deviation for Gaussian noise, and processes __CLIP_ROWS rows at a time
+__MAD_TO_STD = 1.4826
+__CLIP_ROWS = 64
+
+# Histograms sample every __HIST_STRIDE-th pixel of every __HIST_STRIDE-th row and keep the top
+# __HIST_BITS bits of each sample, so the last bin holds saturated pixels of 12 and 16 bit data
+__HIST_STRIDE = 4
+__HIST_BITS = 12
+
+# Focus metrics - 'gradient' is the gradient energy and 'variance' the normalized variance of the
+# frame. 'contrast' is the interferometric contrast of particles: frames are split into
+# __CONTRAST_BLOCK square blocks, each block's brightest pixel is taken relative to the block
+# mean, and the top __CONTRAST_TOP fraction of blocks is averaged, so the metric follows the peak
+# particle signal rather than the number of pixels it covers.
+__FOCUS_METRICS = ('gradient', 'variance', 'contrast')
+__CONTRAST_BLOCK = 16
+__CONTRAST_TOP = 0.01
+
+# Averagers are cached by (thread, shape, num_to_avg, mode) so their buffers are reused between
+# calls; cameras averaging in parallel threads each get their own. Each thread keeps at most one
+# median or sigma_clip averager, as their frame stacks are large.
+__AVERAGERS = {}
+__AVERAGERS_LOCK = threading.Lock()
+__MAX_AVERAGERS = 4
+
+
+def __new_averager(shape, num_to_avg, mode):
+    # Returns averager dict with preallocated buffers
+
+    if mode not in __AVG_MODES:
+        raise RuntimeError('Averaging mode: "' + str(mode) + '" is not supported. Options are: ' +
+                           str(__AVG_MODES))
+    if num_to_avg < 1:
+        raise RuntimeError('Number of frames to average must be at least 1.')
+    if mode != 'mean' and num_to_avg > __MAX_STACK_FRAMES:
+        raise RuntimeError('Averaging mode: "' + mode + '" holds every frame in memory and '
+                           'averages at most ' + str(__MAX_STACK_FRAMES) + ' frames, not ' +
+                           str(num_to_avg) + '. Use "mean" or average fewer frames.')
+
+    averager = {'mode': mode,
+                'num_to_avg': num_to_avg,
+                'count': 0,
+                'sum': None,
+                'stack': None,
+                'work': None}
+
+    if mode == 'mean':
+        # uint32 holds the rounded sum of up to 65536 full-scale 16 bit frames
+        sum_dtype = np.uint32 if num_to_avg <= 65536 else np.uint64
+        averager['sum'] = np.zeros(shape, dtype=sum_dtype)
+    else:
+        # Robust modes need all frames at once
+        averager['stack'] = np.empty((num_to_avg,) + tuple(shape), dtype=np.uint16)
+        if mode == 'sigma_clip':
+            block_shape = (num_to_avg, min(__CLIP_ROWS, shape[0])) + tuple(shape[1:])
+            averager['work'] = {'sorted': np.empty(block_shape, dtype=np.uint16),
+                                'dev': np.empty(block_shape, dtype=np.float32),
+                                'median': np.empty(block_shape[1:], dtype=np.float32),
+                                'threshold': np.empty(block_shape[1:], dtype=np.float32),
+                                'mask': np.empty(block_shape[1:], dtype=bool),
+                                'kept_sum': np.empty(block_shape[1:], dtype=np.float32),
+                                'kept_count': np.empty(block_shape[1:], dtype=np.float32)}
+
+    return averager
+
+
+def __add_frame(averager, frame):
+    # Adds frame to averager in place
+
+    if averager['count'] >= averager['num_to_avg']:
+        raise RuntimeError('Averager already holds ' + str(averager['num_to_avg']) + ' frames.')
+
+    if averager['mode'] == 'mean':
+        np.add(averager['sum'], frame, out=averager['sum'], casting='unsafe')
+    else:
+        np.copyto(averager['stack'][averager['count']], frame, casting='unsafe')
+    averager['count'] += 1
+
+
+def __mean_result(averager):
+    # Rounded integer mean; the only division happens here, once per average
+
+    count = averager['count']
+    acc = averager['sum']
+    np.add(acc, count // 2, out=acc, casting='unsafe')
+    np.floor_divide(acc, count, out=acc)
+    return acc.astype(np.uint16)
+
+
+def __median_result(averager):
+    # Per pixel median of stack
+
+    stack = averager['stack'][:averager['count']]
+    median = np.median(stack, axis=0, overwrite_input=True)
+    return np.rint(median).astype(np.uint16)
+
+
+def __sigma_clip_result(averager, sigma):
+    # Mean of frames after rejecting pixels further than "sigma" standard deviations from the per
+    # pixel median. The spread is taken from the median absolute deviation, which an outlier can't
+    # inflate the way it inflates the standard deviation, so one bad frame is rejected even in a
+    # short average. At least half the frames are always within threshold. Rows are processed in
+    # blocks of __CLIP_ROWS so the work buffers stay small.
+
+    count = averager['count']
+    stack = averager['stack'][:count]
+    work = averager['work']
+    lower, upper = (count - 1) // 2, count // 2
+    result = np.empty(stack.shape[1:], dtype=np.uint16)
+
+    for start in range(0, stack.shape[1], __CLIP_ROWS):
+        block = stack[:, start:start + __CLIP_ROWS]
+        rows = block.shape[1]
+        ordered = work['sorted'][:count, :rows]
+        dev = work['dev'][:count, :rows]
+        median = work['median'][:rows]
+        threshold = work['threshold'][:rows]
+        mask = work['mask'][:rows]
+        kept_sum = work['kept_sum'][:rows]
+        kept_count = work['kept_count'][:rows]
+
+        # Median; which frames are kept doesn't depend on their order, so the sorted copy is used
+        # from here on
+        np.copyto(ordered, block)
+        ordered.sort(axis=0)
+        np.add(ordered[lower], ordered[upper], out=median, dtype=np.float32)
+        np.multiply(median, 0.5, out=median)
+
+        # Threshold from median absolute deviation
+        np.subtract(ordered, median, out=dev, dtype=np.float32)
+        np.abs(dev, out=dev)
+        dev.sort(axis=0)
+        np.add(dev[lower], dev[upper], out=threshold)
+        np.multiply(threshold, 0.5 * sigma * __MAD_TO_STD, out=threshold)
+
+        # Mean of pixels within threshold
+        kept_sum.fill(0)
+        kept_count.fill(0)
+        for frame in ordered:
+            np.subtract(frame, median, out=dev[0], dtype=np.float32)
+            np.abs(dev[0], out=dev[0])
+            np.less_equal(dev[0], threshold, out=mask)
+            np.add(kept_sum, frame, out=kept_sum, where=mask, casting='unsafe')
+            np.add(kept_count, 1, out=kept_count, where=mask)
+        np.divide(kept_sum, kept_count, out=kept_sum)
+        np.rint(kept_sum, out=kept_sum)
+        result[start:start + rows] = kept_sum
+
+    return result
+
+
+def __result(averager, sigma):
+    # Returns averaged frame as a new uint16 array and resets averager for reuse
+
+    if averager['count'] == 0:
+        raise RuntimeError('No frames were added to averager.')
+
+    if averager['mode'] == 'mean':
+        result = __mean_result(averager)
+    elif averager['mode'] == 'median':
+        result = __median_result(averager)
+    else:
+        result = __sigma_clip_result(averager, sigma)
+
+    __reset(averager)
+    return result
+
+
+def __reset(averager):
+    # Clears averager
+
+    averager['count'] = 0
+    if averager['sum'] is not None:
+        averager['sum'].fill(0)
+
+
+def __bin_frame(frame, factor):
+    # Block mean of factor x factor pixels; rows and columns that don't fill a block are dropped.
+    # Blocks are summed with strided adds, which is much faster than reducing a 4D reshaped view.
+
+    if factor < 1:
+        raise RuntimeError('Binning factor must be at least 1.')
+    if factor == 1:
+        return np.array(frame, dtype=np.uint16)
+
+    height = frame.shape[0] // factor
+    width = frame.shape[1] // factor
+    if height == 0 or width == 0:
+        raise RuntimeError('Frame of shape ' + str(frame.shape) + ' is smaller than one ' +
+                           str(factor) + 'x' + str(factor) + ' block.')
+
+    # Sum rows, then columns; uint32 holds 65536 full-scale 16 bit pixels
+    rows = np.zeros((height, frame.shape[1]), dtype=np.uint32)
+    for i in range(factor):
+        np.add(rows, frame[i:height * factor:factor], out=rows, casting='unsafe')
+    binned = np.zeros((height, width), dtype=np.uint32)
+    for j in range(factor):
+        np.add(binned, rows[:, j:width * factor:factor], out=binned)
+
+    num_pixels = factor * factor
+    np.add(binned, num_pixels // 2, out=binned, casting='unsafe')
+    np.floor_divide(binned, num_pixels, out=binned)
+    return binned.astype(np.uint16)
+
+
+def __focus_metric(frame, metric):
+    # Focus score of frame; higher is sharper. All metrics are normalized by the mean intensity,
+    # so exposure and LED changes don't move them.
+
+    frame = np.asarray(frame, dtype=np.float32)
+    mean = float(frame.mean())
+    if mean <= 0:
+        return 0.0
+
+    if metric == 'gradient':
+        grad_x = np.diff(frame, axis=1)
+        grad_y = np.diff(frame, axis=0)
+        energy = np.einsum('ij,ij->', grad_x, grad_x) + np.einsum('ij,ij->', grad_y, grad_y)
+        return float(energy) / (frame.size * mean * mean)
+    if metric == 'variance':
+        return float(frame.var()) / mean
+    if metric == 'contrast':
+        block = __CONTRAST_BLOCK
+        height = frame.shape[0] // block
+        width = frame.shape[1] // block
+        if height == 0 or width == 0:
+            raise RuntimeError('Frame of shape ' + str(frame.shape) + ' is smaller than one ' +
+                               str(block) + 'x' + str(block) + ' block.')
+        blocks = frame[:height * block, :width * block].reshape(height, block, width, block)
+        peaks = blocks.max(axis=(1, 3)) / np.maximum(blocks.mean(axis=(1, 3)), 1e-6) - 1.0
+        num_top = max(1, int(peaks.size * __CONTRAST_TOP))
+        return float(np.partition(peaks.ravel(), peaks.size - num_top)[-num_top:].mean())
+    raise RuntimeError('Focus metric: "' + str(metric) + '" is not supported. Options are: ' +
+                       str(__FOCUS_METRICS))
+
+
+def __histogram(frame, bitsperpixel, stride, bits):
+    # Counts of the top "bits" bits of a strided subsample of frame; integer binning with bincount
+
+    shift = max(0, bitsperpixel - bits)
+    num_bins = 2**(bitsperpixel - shift)
+    sample = frame[::stride, ::stride]
+    if shift:
+        sample = np.right_shift(sample, shift)
+    return np.bincount(sample.ravel(), minlength=num_bins)[:num_bins]
+
+
+def __new_running_histogram(decay):
+    # Returns running histogram; older frames fade out by "decay" per added frame
+
+    if not 0 <= decay < 1:
+        raise RuntimeError('Histogram decay must be in [0, 1).')
+
+    return {'decay': decay,
+            'hist': None,
+            'saturation': 0.0,
+            'count': 0}
+
+
+def __add_histogram(running, counts):
+    # Blends normalized counts into running histogram in place
+
+    fractions = counts / float(max(1, counts.sum()))
+    if running['hist'] is None or running['hist'].shape != fractions.shape:
+        running['hist'] = fractions
+    else:
+        running['hist'] *= running['decay']
+        running['hist'] += (1.0 - running['decay']) * fractions
+
+    # Saturation of the newest frame, so it reacts to exposure changes right away
+    running['saturation'] = 100.0 * fractions[-1]
+    running['count'] += 1
+
+
+def __rebin_histogram(hist, num_bins):
+    # Sums adjacent bins down to "num_bins", which must divide the number of bins
+
+    if num_bins >= hist.shape[0]:
+        return hist.copy()
+    if hist.shape[0] % num_bins:
+        raise RuntimeError('Number of bins ' + str(num_bins) + ' does not divide ' +
+                           str(hist.shape[0]) + '.')
+    return hist.reshape(num_bins, -1).sum(axis=1)
+
+
+def __display_lut(black, white, bitsperpixel):
+    # Linear contrast ramp from "black" to "white" as a uint8 lookup table over all pixel values
+
+    values = np.arange(2**bitsperpixel, dtype=np.float32)
+    scale = 255.0 / max(1, white - black)
+    np.subtract(values, black, out=values)
+    np.multiply(values, scale, out=values)
+    np.clip(values, 0, 255, out=values)
+    np.rint(values, out=values)
+    return values.astype(np.uint8)
+
+
+### Public Functions ###
+
+def get_averager(shape, num_to_avg, mode='mean'):
+    # Returns a cleared averager, reusing buffers from previous calls of this thread with the same
+    # parameters
+    key = (threading.get_ident(), tuple(shape), num_to_avg, mode)
+    with __AVERAGERS_LOCK:
+        averager = __AVERAGERS.get(key)
+        if averager is None:
+            if len(__AVERAGERS) >= __MAX_AVERAGERS:
+                __AVERAGERS.clear()
+            if mode != 'mean':
+                for other_key in [other_key for other_key in __AVERAGERS
+                                  if other_key[0] == key[0] and other_key[3] != 'mean']:
+                    del __AVERAGERS[other_key]
+            averager = __new_averager(shape, num_to_avg, mode)
+            __AVERAGERS[key] = averager
+
+    __reset(averager)
+    return averager
+
+
+def add_frame(averager, frame):
+    # Adds frame to averager
+    __add_frame(averager, frame)
+
+
+def get_result(averager, sigma=__SIGMA):
+    # Returns averaged uint16 frame
+    return __result(averager, sigma)
+
+
+def average_frames(frames, mode='mean', sigma=__SIGMA):
+    # Averages a sequence of equally sized frames
+    frames = list(frames)
+    averager = get_averager(frames[0].shape, len(frames), mode)
+    for frame in frames:
+        __add_frame(averager, frame)
+    return __result(averager, sigma)
+
+
+def bin_frame(frame, factor):
+    # Returns rounded factor x factor block mean of frame as a new uint16 array
+    return __bin_frame(frame, factor)
+
+
+def focus_metric(frame, metric='contrast'):
+    # Returns focus score of frame, higher is sharper; "metric" is one of focus_metrics()
+    return __focus_metric(frame, metric)
+
+
+def focus_metrics():
+    # Returns supported focus metrics
+    return __FOCUS_METRICS
+
+
+def histogram(frame, bitsperpixel=16, stride=__HIST_STRIDE, bits=__HIST_BITS):
+    # Returns bin counts of a strided subsample of frame; bin i holds values with top "bits" bits
+    # equal to i, so the last bin counts saturated pixels
+    return __histogram(frame, bitsperpixel, stride, bits)
+
+
+def new_running_histogram(decay=0.5):
+    # Returns empty running histogram
+    return __new_running_histogram(decay)
+
+
+def add_histogram(running, counts):
+    # Adds counts from histogram() to running histogram
+    __add_histogram(running, counts)
+
+
+def rebin_histogram(hist, num_bins):
+    # Returns histogram summed down to "num_bins" bins
+    return __rebin_histogram(hist, num_bins)
+
+
+def display_lut(black, white, bitsperpixel=16):
+    # Returns uint8 lookup table mapping pixel values linearly from [black, white] to [0, 255]
+    return __display_lut(black, white, bitsperpixel)
+
+
+def apply_lut(frame, lut, out=None):
+    # Returns lut[frame]; "out" may be a preallocated uint8 array of the frame's shape
+    return np.take(lut, frame, out=out)
+
+
+def avg_modes():
+    # Returns supported averaging modes
+    return __AVG_MODES
+
+
+def get_max_to_avg(mode):
+    # Returns most frames "mode" can average, or None if unlimited
+    return None if mode == 'mean' else __MAX_STACK_FRAMES
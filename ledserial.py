@@ -1,41 +1,342 @@
-import serial
+import time
+import queue
 import atexit
-import os
+import struct
+import threading
+import backend
+
+# Framed binary protocol spoken by the LED controller. Every message is
+#   SYNC (0xA5) | type | seq | length | payload (length bytes) | CRC-8 (poly 0x07) of type..payload
+# Multi-byte values are little endian. The controller acknowledges every command with ACK
+# (payload: seq of the command, status), reports every step of a running sequence with STEP
+# (payload: step uint16, colour, cycle uint16) and the end of a sequence with DONE.
+__SYNC = 0xA5
+__CMD_SET_COLOR = 0x01  # colour
+__CMD_UPLOAD = 0x02  # number of steps, then per step: colour, dwell uint16
+__CMD_START = 0x03  # mode, period_us uint32, cycles uint16 (0 runs until STOP)
+__CMD_ADVANCE = 0x04
+__CMD_STOP = 0x05
+__MSG_ACK = 0x80
+__MSG_STEP = 0x81
+__MSG_DONE = 0x82
+__STATUS = ('ok', 'checksum error', 'unknown command', 'bad payload', 'no sequence', 'busy')
+
+# Colours are sent as their index in __COLORS
+__COLORS = 'rgbyc'
+
+# Sequence modes - 'command' advances one step per advance(), 'trigger' runs on the controller:
+# it pulses the camera trigger line every period and switches the LED between pulses after the
+# dwell of each step
+__MODES = ('command', 'trigger')
+__MAX_STEPS = 64
+
+__BAUDRATE = 57600
+__ACK_TIMEOUT = 1.0  # seconds
+__READ_TIMEOUT = 0.1  # seconds; reader thread checks for stop this often
+
+# Port is created on connect, so importing ledserial doesn't load pyserial
+__SERIAL = None
+
+# Reader thread - parses replies; acknowledgments of pending commands are stored by seq, events
+# are queued for receive()
+__READER = {'thread': None,
+            'stop': None,
+            'error': None,
+            'seq': 0,
+            'pending': {},
+            'cond': threading.Condition(),
+            'events': queue.Queue(),
+            'write_lock': threading.Lock()}
+
+
+def __import_serial():
+    # Returns pyserial, or the simulated LED controller
+
+    if backend.is_sim('led'):
+        import simserial as serial
+    else:
+        import serial
+    return serial
 
-__SERIAL = serial.Serial()
 
 def __destructor():
 
     print('Closing LED Connection')
 
     __close()
-    
+
+
 atexit.register(__destructor)
 
+
 def __connect(portno):
-	__SERIAL.baudrate = 57600
-	__SERIAL.port = 'COM'+str(portno)
-	__SERIAL.open()
+    global __SERIAL
+
+    if __SERIAL is None:
+        __SERIAL = __import_serial().Serial()
+    __SERIAL.baudrate = __BAUDRATE
+    __SERIAL.timeout = __READ_TIMEOUT
+    __SERIAL.port = 'COM' + str(portno)
+    __SERIAL.open()
+    __start_reader()
+
 
-	
-	
 def __close():
-	__SERIAL.close()
+    __stop_reader()
+    if __SERIAL is not None:
+        __SERIAL.close()
+
+
+def __crc8(data):
+    # CRC-8 with polynomial 0x07
+
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+def __read_exact(num_bytes):
+    # Reads "num_bytes" bytes; returns None if the reader is stopped first
+
+    data = b''
+    while len(data) < num_bytes:
+        if __READER['stop'].is_set():
+            return None
+        data += __SERIAL.read(num_bytes - len(data))
+    return data
+
+
+def __read_message():
+    # Reads next valid message; returns (type, payload) or None if the reader is stopped
+
+    while True:
+        sync = __read_exact(1)
+        if sync is None:
+            return None
+        if sync[0] != __SYNC:
+            continue
+
+        header = __read_exact(3)
+        if header is None:
+            return None
+        rest = __read_exact(header[2] + 1)
+        if rest is None:
+            return None
+
+        # Corrupt messages are dropped; the command they acknowledge times out
+        if __crc8(header + rest[:-1]) == rest[-1]:
+            return header[0], rest[:-1]
+
+
+def __reader_loop(stop):
+    # Reader thread
+
+    try:
+        while not stop.is_set():
+            message = __read_message()
+            if message is None:
+                return
+            msg_type, payload = message
+            now = time.perf_counter()
+
+            if msg_type == __MSG_ACK:
+                with __READER['cond']:
+                    if payload[0] in __READER['pending']:
+                        __READER['pending'][payload[0]] = payload[1]
+                        __READER['cond'].notify_all()
+            elif msg_type == __MSG_STEP:
+                step, color, cycle = struct.unpack('<HBH', payload)
+                __READER['events'].put({'type': 'step',
+                                        'step': step,
+                                        'color': __COLORS[color],
+                                        'cycle': cycle,
+                                        'time': now})
+            elif msg_type == __MSG_DONE:
+                __READER['events'].put({'type': 'done', 'time': now})
+    except Exception as ex:  # pylint: disable=broad-except
+        with __READER['cond']:
+            __READER['error'] = ex
+            __READER['cond'].notify_all()
+
+
+def __start_reader():
+    # Starts reader thread
+
+    __stop_reader()
+
+    stop = threading.Event()
+    thread = threading.Thread(target=__reader_loop, args=(stop,), name='ledserial-reader',
+                              daemon=True)
+    __READER['stop'] = stop
+    __READER['thread'] = thread
+    __READER['error'] = None
+    thread.start()
+
+
+def __stop_reader():
+    # Stops reader thread
+
+    if __READER['thread'] is None:
+        return
+
+    __READER['stop'].set()
+    __READER['thread'].join()
+    __READER['thread'] = None
+    __READER['stop'] = None
+
+
+def __send(msg_type, payload=b'', wait=True):
+    # Sends command; if "wait" is set, waits for its acknowledgment and returns the round trip in
+    # seconds
+
+    if __READER['thread'] is None:
+        raise RuntimeError('LED controller is not connected. Please connect() first.')
 
+    with __READER['cond']:
+        if __READER['error'] is not None:
+            raise RuntimeError('LED reader thread failed: ' + str(__READER['error']))
+        seq = __READER['seq']
+        __READER['seq'] = (seq + 1) % 256
+        if wait:
+            __READER['pending'][seq] = None
+
+    body = bytes([msg_type, seq, len(payload)]) + payload
+    tic = time.perf_counter()
+    with __READER['write_lock']:
+        __SERIAL.write(bytes([__SYNC]) + body + bytes([__crc8(body)]))
+    if not wait:
+        return None
+
+    with __READER['cond']:
+        acked = __READER['cond'].wait_for(lambda: __READER['pending'][seq] is not None or
+                                          __READER['error'] is not None, __ACK_TIMEOUT)
+        status = __READER['pending'].pop(seq)
+    if not acked or status is None:
+        raise RuntimeError('LED controller did not acknowledge command ' + hex(msg_type) + '.')
+    if status != 0:
+        raise RuntimeError('LED controller rejected command ' + hex(msg_type) + ': ' +
+                           (__STATUS[status] if status < len(__STATUS) else str(status)) + '.')
+
+    return time.perf_counter() - tic
+
+
+def __color_code(color):
+    # Returns protocol code of colour
+
+    if color not in __COLORS or len(color) != 1:
+        raise RuntimeError('Colour: "' + str(color) + '" is not supported. Options are: ' +
+                           str(tuple(__COLORS)))
+    return __COLORS.index(color)
+
+
+def __upload_sequence(steps):
+    # Uploads sequence of (colour, dwell) steps
+
+    if not 0 < len(steps) <= __MAX_STEPS:
+        raise RuntimeError('Sequence must have 1 to ' + str(__MAX_STEPS) + ' steps.')
+
+    payload = bytes([len(steps)])
+    for color, dwell in steps:
+        if not 0 < dwell < 65536:
+            raise RuntimeError('Dwell of step must be between 1 and 65535.')
+        payload += struct.pack('<BH', __color_code(color), dwell)
+    return __send(__CMD_UPLOAD, payload)
+
+
+def __start_sequence(mode, period, cycles):
+    # Starts uploaded sequence
+
+    if mode not in __MODES:
+        raise RuntimeError('Sequence mode: "' + str(mode) + '" is not supported. Options are: ' +
+                           str(__MODES))
+    period_us = 0
+    if mode == 'trigger':
+        if period is None or period <= 0:
+            raise RuntimeError('Trigger mode needs a trigger period.')
+        period_us = int(round(period * 1e6))
+
+    # Events of an earlier sequence are stale
+    __clear_events()
+    return __send(__CMD_START, struct.pack('<BIH', __MODES.index(mode), period_us, cycles))
+
+
+def __clear_events():
+    # Drops queued events
+
+    while True:
+        try:
+            __READER['events'].get_nowait()
+        except queue.Empty:
+            return
+
+
+def __receive(timeout):
+    # Returns next event, or None after "timeout" seconds
+
+    try:
+        return __READER['events'].get(timeout=timeout)
+    except queue.Empty:
+        return None
+
+
+### Public Functions ###
 
 def connect(portno):
-	__connect(portno)
-	if __SERIAL.is_open:
-		print('LEDs connected')
+    __connect(portno)
+    if __SERIAL.is_open:
+        print('LEDs connected')
+
 
 def close():
-	return __close()
-	
+    return __close()
+
+
 def send(command):
-	#send command to the arduino
-	__SERIAL.write(command.encode())
-	
-def receive(self):
-	#receive the data from the arduino
-	return __SERIAL.readline().decode('ascii')
-	
+    # Switches LED to colour "command" ('r', 'g', 'b', 'y' or 'c') without waiting for the
+    # controller
+    __send(__CMD_SET_COLOR, bytes([__color_code(command)]), wait=False)
+
+
+def send_confirmed(command):
+    # Switches LED to colour "command" and waits for the controller to acknowledge it; returns
+    # the round trip in seconds
+    return __send(__CMD_SET_COLOR, bytes([__color_code(command)]))
+
+
+def upload_sequence(steps):
+    # Uploads an illumination schedule in one message: a list of (colour, dwell) steps, where
+    # dwell is the number of camera frames of the step in trigger mode
+    return __upload_sequence(steps)
+
+
+def start_sequence(mode='command', period=None, cycles=1):
+    # Starts the uploaded sequence at its first step. In 'command' mode advance() moves to the
+    # next step; in 'trigger' mode the controller pulses the camera trigger line every "period"
+    # seconds and switches colours between pulses on its own. "cycles" is the number of passes
+    # through the sequence, 0 repeats until stop_sequence(). Progress is reported by receive().
+    return __start_sequence(mode, period, cycles)
+
+
+def advance(wait=False):
+    # Moves a 'command' mode sequence to its next step; the switch is reported by receive()
+    return __send(__CMD_ADVANCE, wait=wait)
+
+
+def stop_sequence():
+    # Stops running sequence; the LED keeps its colour
+    return __send(__CMD_STOP)
+
+
+def receive(timeout=None):
+    # Returns the next event of the controller, or None after "timeout" seconds: {'type': 'step',
+    # 'step', 'color', 'cycle', 'time'} when a step starts and {'type': 'done', 'time'} when a
+    # sequence ends. 'time' is the perf_counter time the event was read.
+    return __receive(timeout)
+
+
+def colors():
+    # Returns colours the controller supports
+    return tuple(__COLORS)
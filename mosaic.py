@@ -0,0 +1,186 @@
+import time
+
+import numpy as np
+
+import spincam
+import stage
+
+# Mosaic acquisition - tiles are (row, col) positions on a grid whose pitch is the tile size minus
+# the overlap. Rows run along the stage's x axis and columns along its y axis, and tile (0, 0) is
+# the stage position when the scan starts. The move to the next tile is started as soon as the
+# last frame of a tile is in, so averaging and writing a tile overlap with the stage travel.
+__ORDERS = ('serpentine', 'nearest', 'given')
+
+
+def __pitch(tile_size, overlap):
+    # Returns (row, col) grid pitch in um of tiles of "tile_size" (x, y) um overlapping by the
+    # fraction "overlap"
+
+    if not 0 <= overlap < 1:
+        raise RuntimeError('Tile overlap must be in [0, 1).')
+    return tile_size[0] * (1.0 - overlap), tile_size[1] * (1.0 - overlap)
+
+
+def __serpentine(tiles):
+    # Row by row, reversing every other row so each row starts next to where the last one ended
+
+    rows = {}
+    for tile in tiles:
+        rows.setdefault(tile[0], []).append(tile)
+
+    ordered = []
+    for i, row in enumerate(sorted(rows)):
+        ordered.extend(sorted(rows[row], key=lambda tile: tile[1], reverse=bool(i % 2)))
+    return ordered
+
+
+def __nearest(tiles, pitch):
+    # Greedy nearest neighbour from tile (0, 0). x and y move at the same time, so the cost of a
+    # move is its longer axis.
+
+    coords = np.array(tiles, dtype=np.float64) * pitch
+    remaining = np.ones(len(tiles), dtype=bool)
+    current = np.zeros(2)
+    ordered = []
+    for _ in range(len(tiles)):
+        cost = np.abs(coords - current).max(axis=1)
+        cost[~remaining] = np.inf
+        index = int(np.argmin(cost))
+        remaining[index] = False
+        current = coords[index]
+        ordered.append(tiles[index])
+    return ordered
+
+
+def __order(tiles, pitch, order):
+    # Returns tiles in scan order
+
+    tiles = [(int(row), int(col)) for row, col in tiles]
+    if order == 'serpentine':
+        return __serpentine(tiles)
+    if order == 'nearest':
+        return __nearest(tiles, pitch)
+    if order == 'given':
+        return tiles
+    raise RuntimeError('Mosaic order: "' + str(order) + '" is not supported. Options are: ' +
+                       str(__ORDERS))
+
+
+def __path_length(tiles, pitch):
+    # Returns length (um) of the stage path from tile (0, 0) through "tiles", as the longer axis
+    # of every move
+
+    coords = np.vstack([np.zeros((1, 2)), np.array(tiles, dtype=np.float64) * pitch])
+    return float(np.abs(np.diff(coords, axis=0)).max(axis=1).sum())
+
+
+def __move(state, tile, pitch):
+    # Starts move from the current tile to "tile"
+
+    state['pending'] = stage.__go_xy((tile[0] - state['tile'][0]) * pitch[0],
+                                     (tile[1] - state['tile'][1]) * pitch[1],
+                                     wait=False)
+    state['tile'] = tile
+
+
+def __wait(state, stats):
+    # Waits for the pending move and marks frames exposed while moving as stale
+
+    tic = time.perf_counter()
+    move_dict = stage.__wait_moves(state['pending'])
+    stats['move_time'] += move_dict['move_time']
+    stats['settle_time'] += move_dict['settle_time']
+    stats['stage_wait'] += time.perf_counter() - tic
+    state['pending'] = []
+    spincam.mark_stale()
+
+
+def __acquire(tiles, pitch, num_to_avg, avg_mode, callback, order, return_to_start):
+    # Acquires one averaged image per tile; callback(index, tile, image_dict) gets each tile while
+    # the stage moves to the next one
+
+    tiles = __order(tiles, pitch, order)
+    stats = {'tiles': 0,
+             'path_length': __path_length(tiles, pitch),
+             'move_time': 0.0,
+             'settle_time': 0.0,
+             'stage_wait': 0.0,
+             'time': 0.0}
+    if not tiles:
+        return stats
+
+    tic = time.perf_counter()
+    state = {'tile': (0, 0), 'pending': []}
+    try:
+        __move(state, tiles[0], pitch)
+        for i, tile in enumerate(tiles):
+            __wait(state, stats)
+
+            # Next move starts once the last frame is in; the last tile returns to the start
+            done = None
+            if i + 1 < len(tiles):
+                done = lambda i=i: __move(state, tiles[i + 1], pitch)
+            elif return_to_start:
+                done = lambda: __move(state, (0, 0), pitch)
+
+            image_dict = spincam.get_image_and_avg(num_to_avg, avg_mode, done)
+            stats['tiles'] += 1
+
+            callback(i, tile, image_dict)
+    finally:
+        # Stage position stays known even if an acquisition failed
+        if state['pending']:
+            stage.__wait_moves(state['pending'])
+            state['pending'] = []
+        if return_to_start and state['tile'] != (0, 0):
+            __move(state, (0, 0), pitch)
+            stage.__wait_moves(state['pending'])
+
+    stats['time'] = time.perf_counter() - tic
+    return stats
+
+
+### Public Functions ###
+
+def grid_pitch(tile_size, overlap=0.1):
+    # Returns (row, col) grid pitch in um for tiles of "tile_size" (x, y) um that overlap by the
+    # fraction "overlap" of a tile
+    return __pitch(tile_size, overlap)
+
+
+def grid(rows, cols):
+    # Returns tiles of a "rows" x "cols" rectangle starting at tile (0, 0)
+    return [(row, col) for row in range(rows) for col in range(cols)]
+
+
+def tiles_from_mask(mask):
+    # Returns tiles of an arbitrary region; tile (row, col) is taken where mask[row, col] is set
+    return [(int(row), int(col)) for row, col in np.argwhere(np.asarray(mask))]
+
+
+def scan_order(tiles, pitch, order='serpentine'):
+    # Returns "tiles" in the scan order used by acquire()
+    return __order(tiles, pitch, order)
+
+
+def path_length(tiles, pitch):
+    # Returns stage path length in um of scanning "tiles" in the given order from tile (0, 0)
+    return __path_length(tiles, pitch)
+
+
+def acquire(tiles, pitch, num_to_avg, callback, order='serpentine', avg_mode='mean',
+            return_to_start=True):
+    # Acquires one image averaged over "num_to_avg" frames per tile. "tiles" are (row, col) grid
+    # positions, e.g. from grid() or tiles_from_mask(), "pitch" the (row, col) grid pitch in um
+    # from grid_pitch(), and "order" one of 'serpentine', 'nearest' (nearest neighbour routing) or
+    # 'given'.
+    # callback(index, tile, image_dict) is called for every tile while the stage already moves to
+    # the next one; hand the data to tiffwriter there. Needs a running capture engine and
+    # connected stages. Returns 'tiles', 'path_length' (um), 'move_time', 'settle_time',
+    # 'stage_wait' (time spent waiting for the stage) and total 'time' in seconds.
+    return __acquire(tiles, pitch, num_to_avg, avg_mode, callback, order, return_to_start)
+
+
+def orders():
+    # Returns supported scan orders
+    return __ORDERS
@@ -0,0 +1,166 @@
+import math
+import time
+import functools
+
+import spincam
+import ledserial
+
+# Multicolor acquisition - one averaged plane per LED colour. Each switch is confirmed by the LED
+# controller, and frames exposed before it are discarded using the camera's timestamps. The next
+# colour is switched on as soon as the last frame of a plane is in, so computing and writing a
+# plane overlaps with the next colour's exposure.
+__COLORS = ('r', 'y', 'g', 'b')
+
+# Seconds from the controller's confirmation until the LED is fully on
+__LED_SETTLE = 0.002
+
+# Sequence engine - the LED controller runs the whole schedule on its own: it pulses the camera's
+# trigger line once per frame and switches colours between pulses, so no serial round trip is
+# spent per plane. Frames of plane i are known in advance from the first frame of the sequence.
+__TRIGGER_LINE = 0
+
+
+def __switch(color, state):
+    # Switches LED to "color"; frames exposed so far are marked stale, so the next average only
+    # takes frames exposed entirely under the new colour
+
+    state['switch_time'] += ledserial.send_confirmed(color)
+    time.sleep(__LED_SETTLE)
+    spincam.mark_stale()
+    state['switch_seq'] = spincam.get_next_seq()
+    state['color'] = color
+
+
+def __acquire(colors, num_images, num_to_avg, avg_mode, callback):
+    # Acquires "num_images" planes cycling through "colors"; callback(index, color, image_dict)
+    # gets each plane while the next one is being exposed
+
+    if not colors:
+        raise RuntimeError('At least one LED colour is needed.')
+
+    state = {'color': None, 'switch_seq': None, 'switch_time': 0.0}
+    stats = {'planes': 0, 'discarded': 0, 'overruns': 0, 'switch_time': 0.0}
+    if num_images < 1:
+        return stats
+
+    __switch(colors[0], state)
+    for i in range(num_images):
+        color = state['color']
+        switch_seq = state['switch_seq']
+
+        # Last plane leaves the LED on
+        done = None
+        if i + 1 < num_images:
+            done = functools.partial(__switch, colors[(i + 1) % len(colors)], state)
+
+        image_dict = spincam.get_image_and_avg(num_to_avg, avg_mode, done)
+
+        # Frames between the switch and the first averaged frame were exposed (partly) under the
+        # previous colour
+        overrun = image_dict.get('overrun', 0)
+        stats['discarded'] += max(0, image_dict['seq'] - num_to_avg - overrun + 1 - switch_seq)
+        stats['overruns'] += overrun
+        stats['planes'] += 1
+
+        callback(i, color, image_dict)
+
+    stats['switch_time'] = state['switch_time'] / num_images
+    return stats
+
+
+def __drain_frames(period):
+    # Waits for frames exposed before the trigger was enabled to come out of the camera; only
+    # needed when the camera can't latch its timestamp
+
+    time.sleep(2.0 * period)
+
+
+def __acquire_sequence(colors, num_images, num_to_avg, avg_mode, callback, frame_rate):
+    # Acquires "num_images" planes cycling through "colors" with the sequence running on the LED
+    # controller; callback(index, color, image_dict) gets each plane while later ones are exposed
+
+    if not colors:
+        raise RuntimeError('At least one LED colour is needed.')
+
+    stats = {'planes': 0, 'discarded': 0, 'overruns': 0, 'switch_time': 0.0}
+    if num_images < 1:
+        return stats
+
+    if frame_rate is None:
+        frame_rate = spincam.get_frame_rate()
+    period = 1.0 / frame_rate
+    exposure = spincam.cam_node_cmd('ExposureTime', 'GetValue') * 1e-6
+    if exposure + __LED_SETTLE > period:
+        raise RuntimeError('Exposure of %.2f ms plus LED settle of %.2f ms does not fit a trigger '
+                           'period of %.2f ms.' % (exposure * 1e3, __LED_SETTLE * 1e3,
+                                                   period * 1e3))
+
+    # One cycle of the sequence holds one plane per colour; the last cycle may be cut short
+    cycles = int(math.ceil(num_images / float(len(colors))))
+    stats['switch_time'] += ledserial.upload_sequence([(color, num_to_avg) for color in colors])
+
+    free_run_period = 1.0 / spincam.get_frame_rate()
+    spincam.set_trigger('Line' + str(__TRIGGER_LINE))
+    try:
+        # The first triggered frame is the first one exposed after the trigger was enabled; free
+        # run frames still in flight carry an earlier timestamp
+        first_seq = None
+        if spincam.mark_stale() is None:
+            __drain_frames(free_run_period)
+            first_seq = spincam.get_next_seq()
+        dropped = spincam.get_capture_stats()['dropped']
+
+        stats['switch_time'] += ledserial.start_sequence('trigger', period, cycles)
+        try:
+            timeout = max(1.0, 5.0 * period)
+            if first_seq is None:
+                first_seq = spincam.wait_ready(timeout)
+            for i in range(num_images):
+                image_dict = spincam.get_frames_and_avg(first_seq + i * num_to_avg,
+                                                        num_to_avg,
+                                                        avg_mode,
+                                                        timeout)
+
+                # A lost frame shifts every later plane onto the wrong colour
+                if image_dict.get('overrun', 0) or \
+                        spincam.get_capture_stats()['dropped'] != dropped:
+                    raise RuntimeError('Frames were lost during the LED sequence; planes would no '
+                                       'longer match their colour. Lower the frame rate or '
+                                       'speed up the callback.')
+                stats['planes'] += 1
+
+                callback(i, colors[i % len(colors)], image_dict)
+        finally:
+            ledserial.stop_sequence()
+    finally:
+        spincam.disable_trigger()
+
+    stats['switch_time'] /= num_images
+    return stats
+
+
+### Public Functions ###
+
+def acquire(num_images, num_to_avg, callback, colors=__COLORS, avg_mode='mean'):
+    # Acquires "num_images" planes cycling through the LED "colors", each the average of
+    # "num_to_avg" frames exposed under that colour only. callback(index, color, image_dict) is
+    # called for every plane, while the next colour is already exposing; hand the data to
+    # tiffwriter there. Needs a running capture engine and a connected LED controller. Returns
+    # 'planes', 'discarded' (frames straddling a switch), 'overruns' and the mean 'switch_time'
+    # round trip in seconds.
+    return __acquire(colors, num_images, num_to_avg, avg_mode, callback)
+
+
+def acquire_sequence(num_images, num_to_avg, callback, colors=__COLORS, avg_mode='mean',
+                     frame_rate=None):
+    # Like acquire(), but the whole colour schedule is uploaded to the LED controller, which then
+    # triggers every frame through the camera's trigger line at "frame_rate" (default: current
+    # camera frame rate) and switches colours between frames. No frames are discarded and there
+    # is no serial traffic per plane. Needs a running capture engine and the controller wired to
+    # the trigger line. Raises RuntimeError if a frame is lost, as planes would then mix colours.
+    return __acquire_sequence(colors, num_images, num_to_avg, avg_mode, callback, frame_rate)
+
+
+def colors():
+    # Returns default LED colour order
+    return __COLORS
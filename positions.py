@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import atexit
+import threading
+
+import stage
+
+# Stage position service - encoder positions of all axes are read from the controllers and cached
+# for a poll interval, so GUI readouts and scripts can ask often without loading the controllers.
+# The last-known position and named bookmarks are kept in a JSON file, so a field found in one
+# session can be revisited by its absolute coordinates in the next. Positions are absolute
+# encoder coordinates (x, y, z) in um; they are only comparable across sessions once the stages
+# have been homed. The last-known position is written when a move finishes and at exit, never
+# from the polled reads.
+__POLL_INTERVAL = 0.25  # seconds a read is reused
+__FILE = os.path.join(os.path.expanduser('~'), '.spinacquisition_positions.json')
+__AXES = ('x', 'y', 'z')
+__SAVE_TOL = 0.1  # um the position must change by before the last-known position is rewritten
+
+__CACHE = {'position': None, 'time': None, 'interval': __POLL_INTERVAL}
+__STORE = {'file': __FILE, 'loaded': False, 'last': None, 'bookmarks': {}}
+__LOCK = threading.RLock()
+
+
+def __destructor():
+    # Saves the last position read
+    with __LOCK:
+        if __CACHE['position'] is not None:
+            try:
+                __remember(__CACHE['position'])
+            except OSError as ex:
+                print('Could not save position to ' + __STORE['file'] + ': ' + str(ex))
+
+
+atexit.register(__destructor)
+
+
+def __load():
+    # Reads last-known position and bookmarks once; a missing or unreadable file starts empty
+
+    if __STORE['loaded']:
+        return
+    __STORE['loaded'] = True
+    if not os.path.isfile(__STORE['file']):
+        return
+
+    try:
+        with open(__STORE['file']) as file:
+            data = json.load(file)
+        __STORE['last'] = data.get('last')
+        __STORE['bookmarks'] = data.get('bookmarks', {})
+    except (OSError, ValueError) as ex:
+        print('Could not read positions from ' + __STORE['file'] + ': ' + str(ex))
+
+
+def __save():
+    # Writes last-known position and bookmarks; the file is replaced in one step so a crash never
+    # leaves it half written
+
+    tmp_name = __STORE['file'] + '.tmp'
+    with open(tmp_name, 'w') as file:
+        json.dump({'last': __STORE['last'], 'bookmarks': __STORE['bookmarks']}, file, indent=2)
+    os.replace(tmp_name, __STORE['file'])
+
+
+def __as_dict(position):
+    # Returns position as {'x', 'y', 'z'}
+    return {axis: round(value, 3) for axis, value in zip(__AXES, position)}
+
+
+def __as_tuple(position_dict):
+    # Returns (x, y, z) of position dict
+    return tuple(float(position_dict[axis]) for axis in __AXES)
+
+
+def __read(max_age):
+    # Returns (x, y, z) in um, read from the encoders if the cached read is older than "max_age"
+    # seconds (the poll interval if None)
+
+    if max_age is None:
+        max_age = __CACHE['interval']
+
+    with __LOCK:
+        now = time.perf_counter()
+        if __CACHE['time'] is not None and now - __CACHE['time'] <= max_age:
+            return __CACHE['position']
+
+        position = stage.__get_positions()
+        __CACHE['position'] = position
+        __CACHE['time'] = now
+        return position
+
+
+def __remember(position):
+    # Saves position as the last-known position if it differs from the saved one
+
+    with __LOCK:
+        __load()
+        last = __STORE['last']
+        if last is None or any(abs(value - last_value) > __SAVE_TOL
+                               for value, last_value in zip(position, __as_tuple(last))):
+            __STORE['last'] = __as_dict(position)
+            __save()
+
+
+def __move_to(x_position, y_position, z_position, wait):
+    # Moves to absolute position (um); None leaves an axis where it is
+
+    pending = stage.__move_to(x_position, y_position, z_position, wait=wait)
+    with __LOCK:
+        __CACHE['time'] = None
+    if not wait:
+        return pending
+    position = __read(0)
+    __remember(position)
+    return position
+
+
+def __get_bookmark(name):
+    # Returns (x, y, z) of bookmark
+
+    __load()
+    if name not in __STORE['bookmarks']:
+        raise RuntimeError('Bookmark: "' + str(name) + '" is not saved. Options are: ' +
+                           str(tuple(__STORE['bookmarks'])))
+    return __as_tuple(__STORE['bookmarks'][name])
+
+
+def __add_bookmark(name, position):
+    # Saves position (current if None) under name
+
+    if not name:
+        raise RuntimeError('Bookmark needs a name.')
+    if position is None:
+        position = __read(0)
+    with __LOCK:
+        __load()
+        __STORE['bookmarks'][name] = __as_dict(position)
+        __save()
+    return position
+
+
+def __remove_bookmark(name):
+    # Removes bookmark
+
+    __get_bookmark(name)
+    with __LOCK:
+        del __STORE['bookmarks'][name]
+        __save()
+
+
+### Public Functions ###
+
+def get_position(max_age=None):
+    # Returns (x, y, z) encoder position in um. A read younger than "max_age" seconds (the poll
+    # interval if None) is reused; 0 always reads the controllers.
+    return __read(max_age)
+
+
+def set_poll_interval(interval):
+    # Sets seconds a position read is reused by get_position()
+    __CACHE['interval'] = interval
+
+
+def move_to(x_position=None, y_position=None, z_position=None, wait=True):
+    # Moves axes to absolute positions in um at the same time; None leaves an axis where it is.
+    # Returns the new position, or without "wait" the pending moves for stage.__wait_moves();
+    # call save_position() once they finished.
+    return __move_to(x_position, y_position, z_position, wait)
+
+
+def save_position(max_age=0):
+    # Saves the current position as the last-known position; call once a move has finished.
+    # Returns the position, read as in get_position().
+    position = __read(max_age)
+    __remember(position)
+    return position
+
+
+def get_last_position():
+    # Returns last (x, y, z) read in this or an earlier session, or None
+    with __LOCK:
+        __load()
+        return None if __STORE['last'] is None else __as_tuple(__STORE['last'])
+
+
+def add_bookmark(name, position=None):
+    # Saves "position" (x, y, z) in um, or the current position, as bookmark "name"; returns it
+    return __add_bookmark(name, position)
+
+
+def go_to_bookmark(name, wait=True):
+    # Moves to bookmark "name"; returns the new position
+    return __move_to(*__get_bookmark(name), wait=wait)
+
+
+def remove_bookmark(name):
+    __remove_bookmark(name)
+
+
+def get_bookmarks():
+    # Returns {name: (x, y, z)} of saved bookmarks
+    with __LOCK:
+        __load()
+        return {name: __as_tuple(position) for name, position in __STORE['bookmarks'].items()}
+
+
+def set_file(file_name):
+    # Sets JSON file positions and bookmarks are kept in; it is read on next use
+    with __LOCK:
+        __STORE.update(file=file_name, loaded=False, last=None, bookmarks={})
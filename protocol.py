@@ -0,0 +1,507 @@
+import os
+import sys
+import json
+import time
+import inspect
+import argparse
+import datetime
+
+import backend
+
+# Headless protocol runner. A protocol is a JSON (or, with PyYAML installed, YAML) description of
+# an experiment: camera settings, XY positions (or a mosaic), a z range, LED channels, averaging
+# and time points. It is validated completely before any device is touched, then run on the same
+# spincam, stage, ledserial and tiffwriter modules the GUI uses, without matplotlib. Every step
+# is appended to a JSON Lines run log.
+#
+#   python protocol.py experiment.json [--log run.jsonl] [--validate] [--sim]
+#
+# Positions and z are in um relative to where the stage is when the run starts; the stage returns
+# there at the end.
+
+# Defaults; every key of a protocol not given is taken from here
+__DEFAULTS = {'name': 'protocol',
+              'directory': '.',
+              'name_format': '{name}_{date}',
+              'output_mode': 'files',
+              'camera': {'serial': '',
+                         'exposure': 5000.0,  # us
+                         'gain': 0.0,  # dB
+                         'frame_rate': None,  # None keeps the camera's
+                         'acq_mode': 'full'},
+              'led': {'port': None,  # None leaves the LEDs alone
+                      'mode': 'command'},
+              'channels': [],  # LED colours per plane; empty takes one plane without switching
+              'positions': [{'x': 0.0, 'y': 0.0}],
+              'mosaic': None,  # {'rows', 'cols', 'tile_size': [x, y], 'overlap', 'order'}
+              'z': {'radius': 0, 'step': 1.0},
+              'autofocus': None,  # True or find_focus() params; run at every position
+              'num_to_avg': 10,
+              'avg_mode': 'mean',
+              'timepoints': 1,
+              'interval': 0.0}  # seconds between the starts of time points
+
+__OUTPUT_MODES = ('files', 'stack')
+__LED_MODES = ('command', 'trigger')
+__AUTOFOCUS_KEYS = ('search_range', 'coarse_step', 'fine_step', 'metric', 'num_to_avg',
+                    'roi_size', 'factor')
+
+# TIFF writer params
+__WRITER_DEPTH = 8
+__WRITER_THREADS = 2
+
+# Acquisition modules; imported on first run so the backend can be chosen first
+__MODULES = {}
+
+
+def __import_modules():
+    # Imports acquisition modules
+
+    if not __MODULES:
+        import spincam
+        import stage
+        import ledserial
+        import multicolor
+        import mosaic
+        import autofocus
+        import tiffwriter
+        __MODULES.update(spincam=spincam, stage=stage, ledserial=ledserial,
+                         multicolor=multicolor, mosaic=mosaic, autofocus=autofocus,
+                         tiffwriter=tiffwriter)
+    return __MODULES
+
+
+def __load(file_name):
+    # Reads protocol from JSON or YAML file
+
+    with open(file_name) as file:
+        if os.path.splitext(file_name)[1].lower() in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError('YAML protocols need PyYAML; install it or use JSON.')
+            return yaml.safe_load(file)
+        return json.load(file)
+
+
+def __merge(defaults, protocol):
+    # Returns protocol with missing keys taken from defaults, one level into dicts
+
+    merged = {}
+    for key, value in defaults.items():
+        given = protocol.get(key, value)
+        if isinstance(value, dict) and isinstance(given, dict):
+            merged[key] = dict(value, **given)
+        else:
+            merged[key] = given
+    return merged
+
+
+def __check(errors, value, name, types, minimum=None, choices=None, optional=False, above=None,
+            below=None):
+    # Appends an error message if value doesn't have one of "types", is below "minimum", not above
+    # "above", not below "below" or not in "choices"
+
+    if value is None and optional:
+        return
+    if isinstance(value, bool) and bool not in types or not isinstance(value, types):
+        errors.append(name + ' must be ' + ' or '.join(t.__name__ for t in types) + ', not ' +
+                      repr(value))
+    elif minimum is not None and value < minimum:
+        errors.append(name + ' must be at least ' + str(minimum) + ', not ' + repr(value))
+    elif above is not None and value <= above:
+        errors.append(name + ' must be above ' + str(above) + ', not ' + repr(value))
+    elif below is not None and value >= below:
+        errors.append(name + ' must be below ' + str(below) + ', not ' + repr(value))
+    elif choices is not None and value not in choices:
+        errors.append(name + ' must be one of ' + str(tuple(choices)) + ', not ' + repr(value))
+
+
+def __autofocus_defaults():
+    # Returns default find_focus() params
+
+    import autofocus
+    return {name: param.default
+            for name, param in inspect.signature(autofocus.find_focus).parameters.items()}
+
+
+def __validate(protocol):
+    # Returns protocol with defaults filled in; raises with every problem found
+
+    # Option lists come from the modules that use them; importing them touches no device and
+    # works without the Spinnaker SDK
+    import spincam
+    import frameproc
+    import mosaic as mosaic_module
+
+    if not isinstance(protocol, dict):
+        raise RuntimeError('Protocol must be a JSON object.')
+    errors = ['Unknown key: ' + key for key in protocol if key not in __DEFAULTS]
+    for key in ('camera', 'led', 'z'):
+        if isinstance(protocol.get(key), dict):
+            errors += ['Unknown key: ' + key + '.' + sub_key for sub_key in protocol[key]
+                       if sub_key not in __DEFAULTS[key]]
+    protocol = __merge(__DEFAULTS, protocol)
+    number = (int, float)
+
+    __check(errors, protocol['name'], 'name', (str,))
+    __check(errors, protocol['directory'], 'directory', (str,))
+    __check(errors, protocol['name_format'], 'name_format', (str,))
+    __check(errors, protocol['output_mode'], 'output_mode', (str,), choices=__OUTPUT_MODES)
+
+    camera = protocol['camera']
+    if isinstance(camera, dict):
+        __check(errors, camera['serial'], 'camera.serial', (str,))
+        __check(errors, camera['exposure'], 'camera.exposure', number, minimum=0)
+        __check(errors, camera['gain'], 'camera.gain', number, minimum=0)
+        __check(errors, camera['frame_rate'], 'camera.frame_rate', number, minimum=0,
+                optional=True)
+        __check(errors, camera['acq_mode'], 'camera.acq_mode', (str,),
+                choices=spincam.acq_modes())
+    else:
+        __check(errors, camera, 'camera', (dict,))
+
+    led = protocol['led']
+    if isinstance(led, dict):
+        __check(errors, led['port'], 'led.port', (int, str), optional=True)
+        __check(errors, led['mode'], 'led.mode', (str,), choices=__LED_MODES)
+    else:
+        __check(errors, led, 'led', (dict,))
+
+    channels = protocol['channels']
+    if isinstance(channels, list):
+        for i, color in enumerate(channels):
+            __check(errors, color, 'channels[%d]' % i, (str,), choices='rgbyc')
+        if channels and isinstance(led, dict) and led['port'] is None:
+            errors.append('channels need led.port')
+    else:
+        __check(errors, channels, 'channels', (list,))
+
+    if protocol['mosaic'] is not None:
+        mosaic = protocol['mosaic']
+        if isinstance(mosaic, dict):
+            __check(errors, mosaic.get('rows'), 'mosaic.rows', (int,), minimum=1)
+            __check(errors, mosaic.get('cols'), 'mosaic.cols', (int,), minimum=1)
+            tile_size = mosaic.get('tile_size')
+            if not (isinstance(tile_size, list) and len(tile_size) == 2 and
+                    all(isinstance(size, number) and size > 0 for size in tile_size)):
+                errors.append('mosaic.tile_size must be [x, y] in um, not ' + repr(tile_size))
+            __check(errors, mosaic.get('overlap', 0.1), 'mosaic.overlap', number, minimum=0,
+                    below=1)
+            __check(errors, mosaic.get('order', 'serpentine'), 'mosaic.order', (str,),
+                    choices=mosaic_module.orders())
+        else:
+            __check(errors, mosaic, 'mosaic', (dict,))
+    elif isinstance(protocol['positions'], list) and protocol['positions']:
+        for i, position in enumerate(protocol['positions']):
+            if not isinstance(position, dict):
+                errors.append('positions[%d] must be an object with x and y' % i)
+                continue
+            __check(errors, position.get('x'), 'positions[%d].x' % i, number)
+            __check(errors, position.get('y'), 'positions[%d].y' % i, number)
+            __check(errors, position.get('name'), 'positions[%d].name' % i, (str,),
+                    optional=True)
+    else:
+        errors.append('positions must be a non-empty list')
+
+    z_dict = protocol['z']
+    if isinstance(z_dict, dict):
+        __check(errors, z_dict['radius'], 'z.radius', (int,), minimum=0)
+        # A zero step would take the same plane 2 * radius + 1 times
+        __check(errors, z_dict['step'], 'z.step', number,
+                above=0 if z_dict['radius'] != 0 else None)
+    else:
+        __check(errors, z_dict, 'z', (dict,))
+
+    focus = protocol['autofocus']
+    if isinstance(focus, dict):
+        errors += ['Unknown key: autofocus.' + key for key in focus if key not in __AUTOFOCUS_KEYS]
+        params = dict(__autofocus_defaults(), **focus)
+        __check(errors, params['coarse_step'], 'autofocus.coarse_step', number, above=0)
+        __check(errors, params['fine_step'], 'autofocus.fine_step', number, above=0)
+        __check(errors, params['search_range'], 'autofocus.search_range', number, above=0)
+        steps = (params['search_range'], params['coarse_step'])
+        if all(isinstance(step, number) and not isinstance(step, bool) for step in steps) and \
+                steps[0] < steps[1]:
+            errors.append('autofocus.search_range must be at least one coarse step, not ' +
+                          repr(steps[0]))
+        __check(errors, params['metric'], 'autofocus.metric', (str,),
+                choices=frameproc.focus_metrics())
+        __check(errors, params['num_to_avg'], 'autofocus.num_to_avg', (int,), minimum=1)
+        __check(errors, params['roi_size'], 'autofocus.roi_size', (int,), minimum=1,
+                optional=True)
+        __check(errors, params['factor'], 'autofocus.factor', (int,), minimum=1)
+    elif focus not in (None, True, False):
+        errors.append('autofocus must be true, false or find_focus() params')
+
+    __check(errors, protocol['num_to_avg'], 'num_to_avg', (int,), minimum=1)
+    __check(errors, protocol['avg_mode'], 'avg_mode', (str,), choices=frameproc.avg_modes())
+    if protocol['avg_mode'] in frameproc.avg_modes() and isinstance(protocol['num_to_avg'], int):
+        max_to_avg = frameproc.get_max_to_avg(protocol['avg_mode'])
+        if max_to_avg is not None and protocol['num_to_avg'] > max_to_avg:
+            errors.append('num_to_avg must be at most ' + str(max_to_avg) + ' with avg_mode "' +
+                          protocol['avg_mode'] + '", not ' + repr(protocol['num_to_avg']))
+    __check(errors, protocol['timepoints'], 'timepoints', (int,), minimum=1)
+    __check(errors, protocol['interval'], 'interval', number, minimum=0)
+
+    if errors:
+        raise RuntimeError('Invalid protocol:\n  ' + '\n  '.join(errors))
+    return protocol
+
+
+def __positions(protocol, modules):
+    # Returns list of (name, x, y) in um
+
+    mosaic_dict = protocol['mosaic']
+    if mosaic_dict is None:
+        return [(position.get('name', 'p%03d' % i), float(position['x']), float(position['y']))
+                for i, position in enumerate(protocol['positions'])]
+
+    mosaic = modules['mosaic']
+    pitch = mosaic.grid_pitch(mosaic_dict['tile_size'], mosaic_dict.get('overlap', 0.1))
+    tiles = mosaic.scan_order(mosaic.grid(mosaic_dict['rows'], mosaic_dict['cols']), pitch,
+                              mosaic_dict.get('order', 'serpentine'))
+    return [('r%03d_c%03d' % tile, tile[0] * pitch[0], tile[1] * pitch[1]) for tile in tiles]
+
+
+def __log(state, event, **fields):
+    # Appends event to run log
+
+    record = dict(event=event,
+                  time=datetime.datetime.now().isoformat(),
+                  elapsed=round(time.perf_counter() - state['tic'], 6),
+                  **fields)
+    if state['log'] is not None:
+        state['log'].write(json.dumps(record) + '\n')
+        state['log'].flush()
+
+
+def __move(state, x_pos=None, y_pos=None, z_pos=None):
+    # Moves stage to (x, y, z) um relative to the start of the run
+
+    stage = state['modules']['stage']
+    delta_x = 0.0 if x_pos is None else x_pos - state['pos'][0]
+    delta_y = 0.0 if y_pos is None else y_pos - state['pos'][1]
+    delta_z = 0.0 if z_pos is None else z_pos - state['pos'][2]
+    if delta_x or delta_y:
+        stage.__go_xy(delta_x, delta_y)
+    if delta_z:
+        stage.__go_z(delta_z)
+    state['pos'] = [state['pos'][0] + delta_x, state['pos'][1] + delta_y,
+                    state['pos'][2] + delta_z]
+    if delta_x or delta_y or delta_z:
+        state['modules']['spincam'].mark_stale()
+
+
+def __setup(protocol, modules):
+    # Connects and configures camera, stage and LEDs, and starts the capture engine
+
+    spincam = modules['spincam']
+    camera = protocol['camera']
+    spincam.find_cam(camera['serial'])
+    spincam.init_cam()
+    spincam.disable_auto_exp()
+    spincam.disable_auto_gain()
+    spincam.disable_auto_frame()
+    spincam.set_acq_mode(camera['acq_mode'])
+    spincam.set_gain(camera['gain'])
+    spincam.set_exposure(camera['exposure'])
+    if camera['frame_rate'] is not None:
+        spincam.set_frame_rate(camera['frame_rate'])
+
+    modules['stage'].__connect_stages()
+    if protocol['led']['port'] is not None:
+        modules['ledserial'].connect(protocol['led']['port'])
+
+    modules['tiffwriter'].start(__WRITER_DEPTH, __WRITER_THREADS)
+    spincam.start_acquisition()
+
+
+def __file_name(state, timepoint, position, plane, color):
+    # File of one plane
+
+    name = state['name'] + '_t%04d_%s_z%03d' % (timepoint, position, plane)
+    if color is not None:
+        name += '_' + color
+    return name + '.tiff'
+
+
+def __save(state, timepoint, position, plane, color, image_dict):
+    # Queues plane for writing and logs it
+
+    tiffwriter = state['modules']['tiffwriter']
+    if state['stack'] is not None:
+        tiffwriter.submit_plane(state['stack'], image_dict['data'])
+        file_name = state['stack']
+    else:
+        file_name = __file_name(state, timepoint, position, plane, color)
+        tiffwriter.submit(file_name, image_dict['data'], compress=0)
+    state['planes'] += 1
+    __log(state, 'plane', timepoint=timepoint, position=position, plane=plane,
+          z=state['pos'][2], channel=color, file=file_name, seq=image_dict.get('seq'),
+          timestamp=image_dict.get('timestamp'), overrun=image_dict.get('overrun', 0))
+
+
+def __acquire_plane(state, protocol, timepoint, position, plane):
+    # Acquires one plane per channel at the current position
+
+    modules = state['modules']
+    channels = protocol['channels']
+    if not channels:
+        image_dict = modules['spincam'].get_image_and_avg(protocol['num_to_avg'],
+                                                          protocol['avg_mode'])
+        __save(state, timepoint, position, plane, None, image_dict)
+        return
+
+    def save_channel(index, color, image_dict):
+        __save(state, timepoint, position, plane, color, image_dict)
+
+    multicolor = modules['multicolor']
+    if protocol['led']['mode'] == 'trigger':
+        stats = multicolor.acquire_sequence(len(channels), protocol['num_to_avg'], save_channel,
+                                            channels, protocol['avg_mode'])
+    else:
+        stats = multicolor.acquire(len(channels), protocol['num_to_avg'], save_channel, channels,
+                                   protocol['avg_mode'])
+    state['discarded'] += stats['discarded']
+
+
+def __run_position(state, protocol, timepoint, position):
+    # Focuses (optionally) and takes the z stack at a position
+
+    name, x_pos, y_pos = position
+    focus_z = state['focus'].get(name, 0.0)
+    __move(state, x_pos, y_pos, focus_z)
+
+    focus = protocol['autofocus']
+    if focus:
+        params = focus if isinstance(focus, dict) else {}
+        focus_dict = state['modules']['autofocus'].find_focus(**params)
+        state['pos'][2] += focus_dict['z']
+        state['focus'][name] = state['pos'][2]
+        __log(state, 'autofocus', timepoint=timepoint, position=name, z=state['pos'][2],
+              frames=focus_dict['frames'], seconds=focus_dict['time'])
+
+    radius = protocol['z']['radius']
+    centre = state['focus'].get(name, 0.0)
+    for plane in range(2 * radius + 1):
+        __move(state, z_pos=centre + (plane - radius) * protocol['z']['step'])
+        __acquire_plane(state, protocol, timepoint, name, plane)
+
+
+def __run(protocol, log_name):
+    # Runs validated protocol; returns summary
+
+    modules = __import_modules()
+    positions = __positions(protocol, modules)
+    name = protocol['name_format'].replace('{name}', protocol['name']).replace(
+        '{date}', str(datetime.date.today()))
+    name = os.path.join(protocol['directory'], name.replace(' ', '_').replace(':', ''))
+    if log_name is None:
+        log_name = name + '_run.jsonl'
+
+    state = {'modules': modules,
+             'name': name,
+             'stack': None,
+             'pos': [0.0, 0.0, 0.0],
+             'focus': {},
+             'planes': 0,
+             'discarded': 0,
+             'log': open(log_name, 'a'),
+             'tic': time.perf_counter()}
+    __log(state, 'start', protocol=protocol, positions=[list(p) for p in positions])
+
+    status = 'error'
+    try:
+        __setup(protocol, modules)
+        if protocol['output_mode'] == 'stack':
+            state['stack'] = name + '.tiff'
+            modules['tiffwriter'].open_stack(
+                state['stack'],
+                (protocol['timepoints'], len(positions), 2 * protocol['z']['radius'] + 1,
+                 max(1, len(protocol['channels']))),
+                'TRZCYX')
+
+        for timepoint in range(protocol['timepoints']):
+            start = state['tic'] + timepoint * protocol['interval']
+            late = time.perf_counter() - start
+            if late < 0:
+                time.sleep(-late)
+            __log(state, 'timepoint', timepoint=timepoint, late=max(late, 0.0))
+            for position in positions:
+                __run_position(state, protocol, timepoint, position)
+
+        if state['stack'] is not None:
+            modules['tiffwriter'].close_stack(state['stack'])
+        modules['tiffwriter'].flush()
+        status = 'ok'
+    except Exception as ex:
+        __log(state, 'error', error=repr(ex))
+        raise
+    finally:
+        try:
+            __move(state, 0.0, 0.0, 0.0)
+            if modules['spincam'].is_streaming():
+                modules['spincam'].end_acquisition()
+            modules['tiffwriter'].stop()
+            if protocol['led']['port'] is not None:
+                modules['ledserial'].close()
+        finally:
+            summary = {'status': status,
+                       'planes': state['planes'],
+                       'discarded': state['discarded'],
+                       'seconds': time.perf_counter() - state['tic'],
+                       'log': log_name}
+            __log(state, 'end', **summary)
+            state['log'].close()
+
+    return summary
+
+
+### Public Functions ###
+
+def load(file_name):
+    # Reads and validates protocol from a JSON or YAML file
+    return __validate(__load(file_name))
+
+
+def validate(protocol):
+    # Returns protocol dict with defaults filled in; raises RuntimeError listing every problem
+    return __validate(protocol)
+
+
+def run(protocol, log_name=None):
+    # Validates and runs protocol headless. Every step is appended to the JSON Lines run log
+    # "log_name" (default: <directory>/<name>_run.jsonl). Returns 'status', 'planes',
+    # 'discarded' frames, 'seconds' and the 'log' file.
+    return __run(__validate(protocol), log_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs an acquisition protocol without the GUI.')
+    parser.add_argument('protocol', help='JSON or YAML protocol file')
+    parser.add_argument('--log', help='JSON Lines run log (default: next to the data)')
+    parser.add_argument('--validate', action='store_true', help='only validate the protocol')
+    parser.add_argument('--sim', action='store_true', help='use the simulated hardware')
+    args = parser.parse_args()
+
+    # Validation imports spincam, so the backend is chosen first
+    if args.sim:
+        backend.use_sim()
+    try:
+        protocol = load(args.protocol)
+    except RuntimeError as ex:
+        print(ex)
+        return 2
+    if args.validate:
+        print('Protocol is valid')
+        return 0
+
+    summary = __run(protocol, args.log)
+    print('Acquired %d plane(s) in %.1f s; log: %s' % (summary['planes'], summary['seconds'],
+                                                      summary['log']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import math
+import time
+import threading
+
+# Simulated thorlabs_apt backend. Motors follow a trapezoidal velocity profile, ring down around
+# the target for a settle time after the move, and home to 0. State is kept per serial number,
+# so every Motor(serial) refers to the same axis.
+
+# Motor params, per serial number in _MOTOR_PARAMS or _DEFAULT_PARAMS
+_DEFAULT_PARAMS = {'velocity': 1.0,  # mm/s
+                   'acceleration': 1.5,  # mm/s^2
+                   'settle_time': 0.05,  # seconds of ringing after the move
+                   'ringing': 0.5e-3,  # mm amplitude of ringing
+                   'ringing_freq': 40.0,  # Hz
+                   'home_time': 1.0,  # seconds of homing overhead on top of the move
+                   'start_position': 5.0,  # mm
+                   'homed': False}
+_MOTOR_PARAMS = {}
+
+# Serial number of the focus axis; simspin renders defocus from its position
+_FOCUS_SERIAL = 27002158
+
+_MOTORS = {}
+_LOCK = threading.Lock()
+
+
+def configure(serial_number=None, **kwargs):
+    # Sets motor params for one serial number, or the defaults if serial_number is None
+    with _LOCK:
+        params = _DEFAULT_PARAMS if serial_number is None else \
+            _MOTOR_PARAMS.setdefault(serial_number, {})
+        for key, value in kwargs.items():
+            if key not in _DEFAULT_PARAMS:
+                raise RuntimeError('Motor param: "' + key + '" is not supported. Options are: ' +
+                                   str(tuple(_DEFAULT_PARAMS)))
+            params[key] = value
+        _MOTORS.pop(serial_number, None)
+
+
+def set_focus_serial(serial_number):
+    global _FOCUS_SERIAL
+    _FOCUS_SERIAL = serial_number
+
+
+def _params(serial_number):
+    params = dict(_DEFAULT_PARAMS)
+    params.update(_MOTOR_PARAMS.get(serial_number, {}))
+    return params
+
+
+def _get_state(serial_number):
+    with _LOCK:
+        if serial_number not in _MOTORS:
+            params = _params(serial_number)
+            pos = params['start_position']
+            _MOTORS[serial_number] = {'params': params,
+                                      'start': pos,
+                                      'target': pos,
+                                      't_start': 0.0,
+                                      't_move': 0.0,
+                                      'homing': False,
+                                      'homed': params['homed'],
+                                      'ringing': False}
+        return _MOTORS[serial_number]
+
+
+def _move_duration(distance, params):
+    # Trapezoidal (or triangular for short moves) profile
+    vel = params['velocity']
+    acc = params['acceleration']
+    if distance <= vel * vel / acc:
+        return 2.0 * (distance / acc) ** 0.5
+    return distance / vel + vel / acc
+
+
+def _profile(state, elapsed):
+    # Fraction of move completed after "elapsed" seconds; symmetric s-curve approximation
+    if state['t_move'] <= 0 or elapsed >= state['t_move']:
+        return 1.0
+    frac = elapsed / state['t_move']
+    return frac * frac * (3.0 - 2.0 * frac)
+
+
+def _position(state, now):
+    params = state['params']
+    elapsed = now - state['t_start']
+    pos = state['start'] + (state['target'] - state['start']) * _profile(state, elapsed)
+
+    # Ring down around target after the move
+    after = elapsed - state['t_move']
+    if state['ringing'] and 0 <= after < params['settle_time']:
+        decay = 1.0 - after / params['settle_time']
+        pos += params['ringing'] * decay * math.sin(2.0 * math.pi * params['ringing_freq'] * after)
+    return pos
+
+
+def _start_move(state, target, ringing=True):
+    now = time.perf_counter()
+    start = _position(state, now)
+    state['start'] = start
+    state['target'] = target
+    state['t_start'] = now
+    state['t_move'] = _move_duration(abs(target - start), state['params'])
+    state['ringing'] = ringing and target != start
+
+
+def list_available_devices():
+    # Returns (hardware type, serial number) of configured and created motors; 31 is a KDC101/TDC001
+    serials = set(_MOTOR_PARAMS) | set(_MOTORS)
+    return [(31, serial) for serial in sorted(serials)]
+
+
+def get_position(serial_number):
+    # Returns position (mm) of motor with serial_number
+    return _position(_get_state(serial_number), time.perf_counter())
+
+
+def get_focus_position():
+    # Returns position (mm) of focus axis
+    return get_position(_FOCUS_SERIAL)
+
+
+class Motor(object):
+    # Subset of thorlabs_apt.Motor
+
+    def __init__(self, serial_number):
+        self.serial_number = serial_number
+        self._state = _get_state(serial_number)
+
+    def _elapsed(self):
+        return time.perf_counter() - self._state['t_start']
+
+    def _wait(self):
+        while self.is_in_motion or not self.is_settled:
+            time.sleep(0.001)
+
+    @property
+    def position(self):
+        return _position(self._state, time.perf_counter())
+
+    @property
+    def is_in_motion(self):
+        return self._elapsed() < self._state['t_move']
+
+    @property
+    def is_settled(self):
+        return self._elapsed() >= self._state['t_move'] + \
+            (self._state['params']['settle_time'] if self._state['ringing'] else 0.0)
+
+    @property
+    def is_homing(self):
+        if self._state['homing'] and not self.is_in_motion:
+            self._state['homing'] = False
+            self._state['homed'] = True
+        return self._state['homing']
+
+    @property
+    def has_homing_been_completed(self):
+        self.is_homing  # pylint: disable=pointless-statement
+        return self._state['homed']
+
+    def get_velocity_parameters(self):
+        params = self._state['params']
+        return (0.0, params['acceleration'], params['velocity'])
+
+    def set_velocity_parameters(self, min_vel, accn, max_vel):
+        self._state['params']['acceleration'] = accn
+        self._state['params']['velocity'] = max_vel
+
+    @property
+    def maximum_velocity(self):
+        return self._state['params']['velocity']
+
+    def move_by(self, value, blocking=False):
+        _start_move(self._state, self._state['target'] + value)
+        if blocking:
+            self._wait()
+
+    def move_to(self, value, blocking=False):
+        _start_move(self._state, value)
+        if blocking:
+            self._wait()
+
+    def move_home(self, blocking=False):
+        _start_move(self._state, 0.0, ringing=False)
+        self._state['t_move'] += self._state['params']['home_time']
+        self._state['homing'] = True
+        self._state['homed'] = False
+        if blocking:
+            self._wait()
+            self.is_homing  # pylint: disable=pointless-statement
+
+    def stop_profiled(self):
+        _start_move(self._state, self.position, ringing=False)
+
+    def identify(self):
+        pass
@@ -0,0 +1,303 @@
+import sys
+import time
+import struct
+import threading
+
+# Simulated pyserial backend. Serial emulates the LED Arduino speaking the framed binary protocol
+# of ledserial: commands are acknowledged, uploaded sequences are stepped through on command or
+# run on their own while pulsing the camera trigger line, and every LED switch is recorded with
+# the time the firmware would switch the LEDs, so the simulated camera can render the active
+# colour.
+
+# LED firmware params
+_LED_COLORS = 'rgbyc'
+_FIRMWARE_LATENCY = 0.001  # seconds between end of transmission and LED switch
+_LED_SETTLE = 0.0005  # seconds between LED switch and the next trigger pulse in trigger mode
+_TRIGGER_LINE = 0  # camera input line pulsed in trigger mode
+_MAX_STEPS = 64
+
+# Protocol, see ledserial
+_SYNC = 0xA5
+_CMD_SET_COLOR, _CMD_UPLOAD, _CMD_START, _CMD_ADVANCE, _CMD_STOP = range(1, 6)
+_MSG_ACK, _MSG_STEP, _MSG_DONE = range(0x80, 0x83)
+_STATUS_OK, _STATUS_CHECKSUM, _STATUS_COMMAND, _STATUS_PAYLOAD, _STATUS_NO_SEQUENCE, \
+    _STATUS_BUSY = range(6)
+_MODE_COMMAND, _MODE_TRIGGER = range(2)
+
+# History of (switch time, colour), shared by all ports
+_LED_DICT = {'history': [(0.0, 'c')], 'lock': threading.Lock()}
+_MAX_HISTORY = 256
+
+
+class SerialException(IOError):
+    pass
+
+
+class SerialTimeoutException(SerialException):
+    pass
+
+
+def _transmit_time(num_bytes, baudrate):
+    # 8N1 - 10 bits per byte
+    return num_bytes * 10.0 / baudrate
+
+
+def _record_color(color, switch_time):
+    with _LED_DICT['lock']:
+        _LED_DICT['history'].append((switch_time, color))
+        del _LED_DICT['history'][:-_MAX_HISTORY]
+
+
+def _crc8(data):
+    # CRC-8, polynomial 0x07
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+def _frame(msg_type, seq, payload=b''):
+    body = bytes([msg_type, seq, len(payload)]) + payload
+    return bytes([_SYNC]) + body + bytes([_crc8(body)])
+
+
+class _LedFirmware(object):
+    # Default device - LED Arduino firmware. Called with the bytes written to the port; replies
+    # and events are injected into the port.
+
+    def __init__(self):
+        self._rx = bytearray()
+        self._steps = []
+        self._mode = None
+        self._step = None
+        self._cycle = 0
+        self._cycles = 0
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __call__(self, serial_port, data):
+        self._rx.extend(data)
+        while self._rx:
+            start = self._rx.find(_SYNC)
+            if start < 0:
+                del self._rx[:]
+                break
+            del self._rx[:start]
+            if len(self._rx) < 4 or len(self._rx) < 5 + self._rx[3]:
+                break
+            length = self._rx[3]
+            body = bytes(self._rx[1:4 + length])
+            crc = self._rx[4 + length]
+            del self._rx[:5 + length]
+            if _crc8(body) != crc:
+                serial_port.inject(_frame(_MSG_ACK, 0, bytes([body[1], _STATUS_CHECKSUM])))
+                continue
+            status = self._command(serial_port, body[0], body[3:])
+            serial_port.inject(_frame(_MSG_ACK, 0, bytes([body[1], status])))
+        return b''
+
+    def _switch(self, serial_port, switch_time):
+        # Switches LED to colour of current step and reports the step
+        color = self._steps[self._step][0]
+        _record_color(color, switch_time)
+        serial_port.inject(_frame(_MSG_STEP, 0, struct.pack('<HBH', self._step,
+                                                            _LED_COLORS.index(color),
+                                                            self._cycle)))
+
+    def _next_step(self, serial_port, switch_time):
+        # Advances to the next step; returns False once the last cycle is done
+        self._step += 1
+        if self._step == len(self._steps):
+            self._step = 0
+            self._cycle += 1
+            if self._cycles and self._cycle == self._cycles:
+                self._mode = None
+                self._step = None
+                serial_port.inject(_frame(_MSG_DONE, 0))
+                return False
+        self._switch(serial_port, switch_time)
+        return True
+
+    def _command(self, serial_port, msg_type, payload):
+        # Runs command; returns status
+        switch_time = time.perf_counter() + _FIRMWARE_LATENCY
+        with self._lock:
+            if msg_type == _CMD_SET_COLOR:
+                if len(payload) != 1 or payload[0] >= len(_LED_COLORS):
+                    return _STATUS_PAYLOAD
+                if self._mode == _MODE_TRIGGER:
+                    return _STATUS_BUSY
+                _record_color(_LED_COLORS[payload[0]], switch_time)
+            elif msg_type == _CMD_UPLOAD:
+                if self._mode is not None:
+                    return _STATUS_BUSY
+                if not payload or len(payload) != 1 + 3 * payload[0] or \
+                        not 0 < payload[0] <= _MAX_STEPS:
+                    return _STATUS_PAYLOAD
+                steps = [struct.unpack_from('<BH', payload, 1 + 3 * i) for i in range(payload[0])]
+                if any(color >= len(_LED_COLORS) or dwell == 0 for color, dwell in steps):
+                    return _STATUS_PAYLOAD
+                self._steps = [(_LED_COLORS[color], dwell) for color, dwell in steps]
+            elif msg_type == _CMD_START:
+                if len(payload) != 7 or payload[0] not in (_MODE_COMMAND, _MODE_TRIGGER):
+                    return _STATUS_PAYLOAD
+                if not self._steps:
+                    return _STATUS_NO_SEQUENCE
+                if self._mode is not None:
+                    return _STATUS_BUSY
+                mode, period_us, cycles = struct.unpack('<BIH', payload)
+                if mode == _MODE_TRIGGER and period_us == 0:
+                    return _STATUS_PAYLOAD
+                self._mode = mode
+                self._step = 0
+                self._cycle = 0
+                self._cycles = cycles
+                if mode == _MODE_COMMAND:
+                    self._switch(serial_port, switch_time)
+                else:
+                    self._stop.clear()
+                    self._thread = threading.Thread(target=self._run,
+                                                    args=(serial_port, period_us * 1e-6,
+                                                          switch_time),
+                                                    daemon=True)
+                    self._thread.start()
+            elif msg_type == _CMD_ADVANCE:
+                if self._mode != _MODE_COMMAND:
+                    return _STATUS_NO_SEQUENCE
+                self._next_step(serial_port, switch_time)
+            elif msg_type == _CMD_STOP:
+                self._stop.set()
+                self._mode = None
+                self._step = None
+            else:
+                return _STATUS_COMMAND
+        return _STATUS_OK
+
+    def _run(self, serial_port, period, start_time):
+        # Trigger mode; pulses the camera line every period and switches the LED between pulses
+        # once the dwell of a step is reached
+        pulse_time = start_time + _LED_SETTLE
+        with self._lock:
+            self._switch(serial_port, start_time)
+        while True:
+            with self._lock:
+                dwell = self._steps[self._step][1]
+            for _ in range(dwell):
+                delay = pulse_time - time.perf_counter()
+                if self._stop.wait(max(delay, 0)):
+                    return
+                simspin = sys.modules.get('simspin')
+                if simspin is not None:
+                    simspin.line_trigger(_TRIGGER_LINE, pulse_time)
+                pulse_time += period
+            with self._lock:
+                if self._stop.is_set() or \
+                        not self._next_step(serial_port, pulse_time - _LED_SETTLE):
+                    return
+
+
+class Serial(object):
+    # Subset of serial.Serial used by ledserial
+
+    def __init__(self, port=None, baudrate=9600, timeout=None, write_timeout=None):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        self.is_open = False
+        self.device = _LedFirmware()
+        self._rx = bytearray()
+        self._cond = threading.Condition()
+        if port is not None:
+            self.open()
+
+    def open(self):
+        if self.is_open:
+            raise SerialException('Port is already open.')
+        if self.port is None:
+            raise SerialException('Port must be configured before it can be used.')
+        self.is_open = True
+
+    def close(self):
+        with self._cond:
+            self.is_open = False
+            self._cond.notify_all()
+
+    def _check_open(self):
+        if not self.is_open:
+            raise SerialException('Attempting to use a port that is not open')
+
+    def write(self, data):
+        self._check_open()
+        data = bytes(data)
+        # Emulate wire time
+        time.sleep(_transmit_time(len(data), self.baudrate))
+        reply = self.device(self, data)
+        if reply:
+            self.inject(reply)
+        return len(data)
+
+    def inject(self, data):
+        # Queues bytes as if they were sent by the device
+        with self._cond:
+            self._rx.extend(data)
+            self._cond.notify_all()
+
+    def flush(self):
+        self._check_open()
+
+    def _wait_rx(self, predicate):
+        # Waits until predicate(rx) is true or timeout expires
+        with self._cond:
+            if self.timeout is None:
+                self._cond.wait_for(lambda: predicate(self._rx) or not self.is_open)
+            else:
+                self._cond.wait_for(lambda: predicate(self._rx) or not self.is_open, self.timeout)
+
+    def read(self, size=1):
+        self._check_open()
+        self._wait_rx(lambda rx: len(rx) >= size)
+        with self._cond:
+            data = bytes(self._rx[:size])
+            del self._rx[:size]
+        return data
+
+    def readline(self):
+        self._check_open()
+        self._wait_rx(lambda rx: b'\n' in rx)
+        with self._cond:
+            end = self._rx.find(b'\n')
+            end = len(self._rx) if end < 0 else end + 1
+            data = bytes(self._rx[:end])
+            del self._rx[:end]
+        return data
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            return len(self._rx)
+
+    def reset_input_buffer(self):
+        with self._cond:
+            del self._rx[:]
+
+
+def get_led_history():
+    # Returns list of (perf_counter time, colour) LED switches
+    with _LED_DICT['lock']:
+        return list(_LED_DICT['history'])
+
+
+def get_led_color(when=None):
+    # Returns LED colour active at perf_counter time "when" (default now)
+    if when is None:
+        when = time.perf_counter()
+    color = 'c'
+    for switch_time, switch_color in get_led_history():
+        if switch_time > when:
+            break
+        color = switch_color
+    return color
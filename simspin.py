@@ -0,0 +1,758 @@
+import sys
+import time
+import random
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Simulated PySpin backend. Cameras free-run (or wait for triggers) at the configured frame rate
+# and deliver synthetic interferometric frames: a vignetted reflectance background with a weak
+# fringe pattern and nanoparticles whose contrast and blur follow the defocus of the simulated
+# focus stage (simapt). Intensity follows exposure, gain and the active simulated LED (simserial).
+# Timestamps are exposure start times on a per-camera nanosecond clock, frame IDs are sequential,
+# and a configurable fraction of frames are delivered incomplete.
+
+# Simulation params
+_SIM_PARAMS = {'serials': ['18475994'],
+               'model': 'Blackfly S BFS-U3-60S4M',
+               'sensor_width': 2736,
+               'sensor_height': 2192,
+               'fps_max': 35.0,  # at full sensor height
+               'incomplete_rate': 0.001,
+               'num_buffers': 10,
+               'counts_per_us': 2.0,  # background counts per microsecond of exposure
+               'read_noise': 40.0,  # counts
+               'num_noise_frames': 4,
+               'num_particles': 400,
+               'particle_contrast': 0.08,
+               'focus_z_mm': 0.025,  # focus stage position of best focus
+               'defocus_period_um': 4.0,  # axial period of interferometric contrast
+               'defocus_envelope_um': 8.0,
+               'led_gain': {'r': 1.0, 'y': 0.85, 'g': 0.7, 'b': 0.5, 'c': 0.05},
+               'seed': 0}
+
+# Access modes
+NI, NA, WO, RO, RW = range(5)
+
+EVENT_TIMEOUT_INFINITE = 0xFFFFFFFFFFFFFFFF
+
+# Enumerations, exposed as module constants e.g. PySpin.TriggerMode_On
+_ENUMS = {'StreamBufferHandlingMode': ['OldestFirst', 'OldestFirstOverwrite', 'NewestFirst',
+                                       'NewestOnly'],
+          'AcquisitionMode': ['Continuous', 'SingleFrame', 'MultiFrame'],
+          'ExposureAuto': ['Off', 'Once', 'Continuous'],
+          'GainAuto': ['Off', 'Once', 'Continuous'],
+          'AcquisitionFrameRateAuto': ['Off', 'Continuous'],
+          'PixelFormat': ['Mono8', 'Mono12p', 'Mono16'],
+          'TriggerMode': ['Off', 'On'],
+          'TriggerSelector': ['FrameStart', 'AcquisitionStart', 'FrameBurstStart'],
+          'TriggerSource': ['Software', 'Line0', 'Line1', 'Line2', 'Line3'],
+          'TriggerActivation': ['RisingEdge', 'FallingEdge'],
+          'BinningSelector': ['All', 'Sensor', 'ISP'],
+          'BinningHorizontalMode': ['Sum', 'Average'],
+          'BinningVerticalMode': ['Sum', 'Average'],
+          'VideoMode': ['Mode0', 'Mode1', 'Mode2', 'Mode3', 'Mode4', 'Mode5', 'Mode6', 'Mode7']}
+for _enum_name, _entries in _ENUMS.items():
+    for _i, _entry in enumerate(_entries):
+        setattr(sys.modules[__name__], _enum_name + '_' + _entry, _i)
+
+
+# Error codes of the Spinnaker SDK
+SPINNAKER_ERR_ERROR = -1001
+SPINNAKER_ERR_TIMEOUT = -1011
+
+
+class SpinnakerException(Exception):
+    def __init__(self, message, errorcode=SPINNAKER_ERR_ERROR):
+        super().__init__(message)
+        self.message = message
+        self.errorcode = errorcode
+
+
+def configure(**kwargs):
+    # Sets simulation params; takes effect for cameras created afterwards
+    for key, value in kwargs.items():
+        if key not in _SIM_PARAMS:
+            raise RuntimeError('Simulation param: "' + key + '" is not supported. Options are: ' +
+                               str(tuple(_SIM_PARAMS)))
+        _SIM_PARAMS[key] = value
+    _SYSTEM_DICT['cameras'] = None
+
+
+### Node map ###
+
+class _Entry(object):
+    def __init__(self, symbolic, value):
+        self._symbolic = symbolic
+        self._value = value
+
+    def GetSymbolic(self):
+        return self._symbolic
+
+    def GetValue(self):
+        return self._value
+
+    def GetName(self):
+        return 'EnumEntry_' + self._symbolic
+
+    def GetAccessMode(self):
+        return RO
+
+
+class _Node(object):
+    # Value, enumeration, boolean or command node
+
+    def __init__(self, cam, name, value=None, min_val=None, max_val=None, inc=None,
+                 entries=None, access=RW, stream_lock=False, command=None, on_set=None):
+        self._cam = cam
+        self._name = name
+        self._value = value
+        self._min = min_val
+        self._max = max_val
+        self._inc = inc
+        self._entries = entries
+        self._access = access
+        self._stream_lock = stream_lock
+        self._command = command
+        self._on_set = on_set
+
+    def GetName(self):
+        return self._name
+
+    def GetAccessMode(self):
+        if self._stream_lock and self._cam.IsStreaming() and self._access == RW:
+            return RO
+        if not self._cam.IsInitialized():
+            return NA
+        return self._access
+
+    def _bound(self, bound):
+        return bound() if callable(bound) else bound
+
+    def GetMin(self):
+        return self._bound(self._min)
+
+    def GetMax(self):
+        return self._bound(self._max)
+
+    def GetInc(self):
+        return 1 if self._inc is None else self._inc
+
+    def GetValue(self):
+        if self.GetAccessMode() not in (RO, RW):
+            raise SpinnakerException('Node "' + self._name + '" is not readable.')
+        return self._bound(self._value)
+
+    def GetIntValue(self):
+        return self.GetValue()
+
+    def ToString(self):
+        return str(self.GetValue())
+
+    def SetValue(self, value, verify=True):
+        if self.GetAccessMode() not in (WO, RW):
+            raise SpinnakerException('Node "' + self._name + '" is not writable.')
+        if self._entries is not None:
+            if value not in self._entries.values():
+                raise SpinnakerException('Invalid value for enumeration "' + self._name + '".')
+        elif self._min is not None:
+            if value < self.GetMin() or value > self.GetMax():
+                raise SpinnakerException('Value ' + str(value) + ' is out of range for "' +
+                                         self._name + '" [' + str(self.GetMin()) + ', ' +
+                                         str(self.GetMax()) + '].')
+            if self._inc is not None and (value - self.GetMin()) % self._inc:
+                raise SpinnakerException('Value ' + str(value) + ' is not a multiple of the "' +
+                                         self._name + '" increment.')
+        self._value = value
+        if self._on_set is not None:
+            self._on_set(value)
+
+    def SetIntValue(self, value):
+        self.SetValue(value)
+
+    def GetEntryByName(self, name):
+        if self._entries is None or name not in self._entries:
+            return None
+        return _Entry(name, self._entries[name])
+
+    def GetEntries(self):
+        return [_Entry(name, value) for name, value in self._entries.items()]
+
+    def GetCurrentEntry(self):
+        for name, value in self._entries.items():
+            if value == self._value:
+                return _Entry(name, value)
+        return None
+
+    def Execute(self):
+        if self.GetAccessMode() not in (WO, RW):
+            raise SpinnakerException('Node "' + self._name + '" is not writable.')
+        self._command()
+
+
+class _NodeMap(object):
+    def __init__(self, nodes):
+        self._nodes = nodes
+
+    def GetNode(self, name):
+        return self._nodes.get(name)
+
+
+def CEnumerationPtr(node):
+    return node
+
+
+def CEnumEntryPtr(node):
+    return node
+
+
+def CBooleanPtr(node):
+    return node
+
+
+def CFloatPtr(node):
+    return node
+
+
+def CIntegerPtr(node):
+    return node
+
+
+def CCommandPtr(node):
+    return node
+
+
+def CStringPtr(node):
+    return node
+
+
+def IsAvailable(node):
+    return node is not None and node.GetAccessMode() not in (NI, NA)
+
+
+def IsReadable(node):
+    return node is not None and node.GetAccessMode() in (RO, RW)
+
+
+def IsWritable(node):
+    return node is not None and node.GetAccessMode() in (WO, RW)
+
+
+### Images ###
+
+class _Image(object):
+    def __init__(self, data, frame_id, timestamp, incomplete):
+        self._data = data
+        self._frame_id = frame_id
+        self._timestamp = timestamp
+        self._incomplete = incomplete
+
+    def IsIncomplete(self):
+        return self._incomplete
+
+    def GetImageStatus(self):
+        return 1 if self._incomplete else 0
+
+    def GetNDArray(self):
+        return self._data
+
+    def GetTimeStamp(self):
+        return self._timestamp
+
+    def GetFrameID(self):
+        return self._frame_id
+
+    def GetBitsPerPixel(self):
+        return 16
+
+    def GetWidth(self):
+        return self._data.shape[1]
+
+    def GetHeight(self):
+        return self._data.shape[0]
+
+    def Release(self):
+        self._data = None
+
+
+### Scene ###
+
+def _focus_position_mm():
+    # Focus stage position if the simulated stage is in use
+    simapt = sys.modules.get('simapt')
+    if simapt is None:
+        return _SIM_PARAMS['focus_z_mm']
+    return simapt.get_focus_position()
+
+
+def _led_gain(start, end):
+    # Mean LED gain over exposure [start, end] (perf_counter seconds)
+    simserial = sys.modules.get('simserial')
+    led_gain = _SIM_PARAMS['led_gain']
+    if simserial is None:
+        return 1.0
+
+    history = simserial.get_led_history()
+    gain = 0.0
+    color = 'c'
+    for switch_time, switch_color in history:
+        if switch_time <= start:
+            color = switch_color
+    last = start
+    for switch_time, switch_color in history:
+        if start < switch_time < end:
+            gain += led_gain[color] * (switch_time - last)
+            last = switch_time
+            color = switch_color
+    gain += led_gain[color] * (end - last)
+    return gain / max(end - start, 1e-9)
+
+
+def _new_scene(seed):
+    rng = np.random.RandomState(seed)
+    height = _SIM_PARAMS['sensor_height']
+    width = _SIM_PARAMS['sensor_width']
+
+    # Vignetted background with weak fringes
+    y_coord, x_coord = np.ogrid[-1:1:height * 1j, -1:1:width * 1j]
+    background = (1.0 - 0.25 * (x_coord ** 2 + y_coord ** 2)) * \
+        (1.0 + 0.02 * np.cos(2 * np.pi * (7.3 * x_coord + 3.1 * y_coord)))
+
+    num_particles = _SIM_PARAMS['num_particles']
+    return {'background': background.astype(np.float32),
+            'particles_y': rng.randint(8, height - 8, num_particles),
+            'particles_x': rng.randint(8, width - 8, num_particles),
+            'particles_amp': rng.uniform(0.5, 1.0, num_particles).astype(np.float32)}
+
+
+def _particle_kernel(defocus_um, scale):
+    # Relative particle signal at defocus; interferometric contrast oscillates and decays with
+    # defocus while the blur grows. "scale" is sensor pixels per image pixel.
+
+    contrast = _SIM_PARAMS['particle_contrast'] * \
+        np.exp(-(defocus_um / _SIM_PARAMS['defocus_envelope_um']) ** 2) * \
+        np.cos(2 * np.pi * defocus_um / _SIM_PARAMS['defocus_period_um'])
+    sigma = max((1.0 + 0.6 * abs(defocus_um)) / scale, 0.5)
+    radius = int(min(3 * sigma, 7))
+    grid = np.arange(-radius, radius + 1, dtype=np.float32)
+    kernel = np.exp(-(grid[:, None] ** 2 + grid[None, :] ** 2) / (2 * sigma ** 2))
+    return kernel * (contrast / kernel.max()), radius
+
+
+### Camera ###
+
+class Camera(object):
+    def __init__(self, serial, index):
+        self._serial = serial
+        self._valid = True
+        self._initialized = False
+        self._streaming = False
+        self._boot = time.perf_counter()
+        self._cond = threading.Condition()
+        self._rng = random.Random(_SIM_PARAMS['seed'] + index)
+        self._scene = _new_scene(_SIM_PARAMS['seed'] + index)
+        self._cache = OrderedDict()
+        self._background_cache = {}
+        self._noise = None
+        self._out = None
+        self._triggers = []
+        self._frame_id = 0
+        self._next_time = 0.0
+        self._trigger_on_time = 0.0
+        self._latched = 0
+        self._build_nodes()
+
+    # Geometry
+    def _max_width(self):
+        return _SIM_PARAMS['sensor_width'] // (self.BinningHorizontal._value *
+                                               self.DecimationHorizontal._value)
+
+    def _max_height(self):
+        return _SIM_PARAMS['sensor_height'] // (self.BinningVertical._value *
+                                                self.DecimationVertical._value)
+
+    def _reset_geometry(self, _=None):
+        self.OffsetX._value = 0
+        self.OffsetY._value = 0
+        self.Width._value = self._max_width()
+        self.Height._value = self._max_height()
+
+    # Timing
+    def _fps_max(self):
+        # Readout scales with sensor rows read; exposure limits the frame period too. Decimated
+        # rows are skipped and sensor binning reads binned rows at once; ISP binning reads them all.
+        rows = self.Height._value
+        if self.BinningSelector._value != BinningSelector_Sensor:
+            rows *= self.BinningVertical._value
+        readout_fps = _SIM_PARAMS['fps_max'] * _SIM_PARAMS['sensor_height'] / float(rows)
+        return min(readout_fps, 1e6 / self.ExposureTime._value)
+
+    def _fps(self):
+        if not self.AcquisitionFrameRateEnabled._value:
+            return self._fps_max()
+        return min(self.AcquisitionFrameRate._value, self._fps_max())
+
+    def _get_fps_value(self):
+        return self._fps()
+
+    def _clock_ns(self, when=None):
+        if when is None:
+            when = time.perf_counter()
+        return int((when - self._boot) * 1e9)
+
+    def _latch(self):
+        self._latched = self._clock_ns()
+
+    def _set_trigger_mode(self, value):
+        # Free run exposures can't start once the trigger is on
+        with self._cond:
+            if value == TriggerMode_On:
+                self._trigger_on_time = time.perf_counter()
+            self._cond.notify_all()
+
+    def _trigger(self):
+        self._line_trigger(TriggerSource_Software, time.perf_counter())
+
+    def _line_trigger(self, source, when):
+        # Queues exposure starting at perf_counter time "when" if triggered by "source"
+        with self._cond:
+            if self._streaming and self.TriggerMode._value == TriggerMode_On and \
+                    self.TriggerSource._value == source:
+                self._triggers.append(when)
+                self._cond.notify_all()
+
+    def _build_nodes(self):
+        sensor_width = _SIM_PARAMS['sensor_width']
+        sensor_height = _SIM_PARAMS['sensor_height']
+
+        def enum(name, default, **kwargs):
+            entries = OrderedDict((entry, i) for i, entry in enumerate(_ENUMS[name]))
+            return _Node(self, name, value=entries[default], entries=entries, **kwargs)
+
+        def geometry(name, value, inc, max_val, **kwargs):
+            return _Node(self, name, value=value, min_val=inc if name in ('Width', 'Height') else 0,
+                         max_val=max_val, inc=inc, stream_lock=True, **kwargs)
+
+        # Binning and decimation change geometry
+        self.BinningSelector = enum('BinningSelector', 'All', stream_lock=True)
+        self.BinningHorizontal = _Node(self, 'BinningHorizontal', 1, 1, 4, stream_lock=True,
+                                       on_set=self._reset_geometry)
+        self.BinningVertical = _Node(self, 'BinningVertical', 1, 1, 4, stream_lock=True,
+                                     on_set=self._reset_geometry)
+        self.BinningHorizontalMode = enum('BinningHorizontalMode', 'Sum', stream_lock=True)
+        self.BinningVerticalMode = enum('BinningVerticalMode', 'Sum', stream_lock=True)
+        self.DecimationHorizontal = _Node(self, 'DecimationHorizontal', 1, 1, 4, stream_lock=True,
+                                          on_set=self._reset_geometry)
+        self.DecimationVertical = _Node(self, 'DecimationVertical', 1, 1, 4, stream_lock=True,
+                                        on_set=self._reset_geometry)
+
+        self.Width = geometry('Width', sensor_width, 8,
+                              lambda: self._max_width() - self.OffsetX._value)
+        self.Height = geometry('Height', sensor_height, 2,
+                               lambda: self._max_height() - self.OffsetY._value)
+        self.OffsetX = geometry('OffsetX', 0, 4, lambda: self._max_width() - self.Width._value)
+        self.OffsetY = geometry('OffsetY', 0, 2, lambda: self._max_height() - self.Height._value)
+        self.WidthMax = _Node(self, 'WidthMax', self._max_width, access=RO)
+        self.HeightMax = _Node(self, 'HeightMax', self._max_height, access=RO)
+        self.SensorWidth = _Node(self, 'SensorWidth', sensor_width, access=RO)
+        self.SensorHeight = _Node(self, 'SensorHeight', sensor_height, access=RO)
+        self.PixelFormat = enum('PixelFormat', 'Mono16', stream_lock=True)
+        self.VideoMode = enum('VideoMode', 'Mode0', stream_lock=True)
+
+        self.ExposureAuto = enum('ExposureAuto', 'Continuous')
+        self.ExposureTime = _Node(self, 'ExposureTime', 10000.0, 6.0, 30000000.0)
+        self.GainAuto = enum('GainAuto', 'Continuous')
+        self.Gain = _Node(self, 'Gain', 0.0, 0.0, 47.0)
+        self.Gamma = _Node(self, 'Gamma', 1.0, 0.25, 4.0)
+        self.AcquisitionFrameRateEnabled = _Node(self, 'AcquisitionFrameRateEnabled', False)
+        self.AcquisitionFrameRateAuto = enum('AcquisitionFrameRateAuto', 'Continuous')
+        self.AcquisitionFrameRate = _Node(self, 'AcquisitionFrameRate', _SIM_PARAMS['fps_max'],
+                                          1.0, self._fps_max)
+        self.ResultingFrameRate = _Node(self, 'ResultingFrameRate', self._get_fps_value, access=RO)
+        self.AcquisitionMode = enum('AcquisitionMode', 'Continuous', stream_lock=True)
+
+        self.TriggerMode = enum('TriggerMode', 'Off', on_set=self._set_trigger_mode)
+        self.TriggerSelector = enum('TriggerSelector', 'FrameStart')
+        self.TriggerSource = enum('TriggerSource', 'Software')
+        self.TriggerActivation = enum('TriggerActivation', 'RisingEdge')
+        self.TriggerSoftware = _Node(self, 'TriggerSoftware', access=WO, command=self._trigger)
+        self.TimestampLatch = _Node(self, 'TimestampLatch', access=WO, command=self._latch)
+        self.TimestampLatchValue = _Node(self, 'TimestampLatchValue', lambda: self._latched,
+                                         access=RO)
+
+        self.TLStream = _Namespace(
+            StreamBufferHandlingMode=enum('StreamBufferHandlingMode', 'OldestFirst'),
+            StreamBufferCountManual=_Node(self, 'StreamBufferCountManual',
+                                          _SIM_PARAMS['num_buffers'], 1, 1000))
+        self.TLDevice = _Namespace(
+            DeviceSerialNumber=_Node(self, 'DeviceSerialNumber', self._serial, access=RO),
+            DeviceModelName=_Node(self, 'DeviceModelName', _SIM_PARAMS['model'], access=RO))
+        # TL device nodes are readable before Init()
+        for node in vars(self.TLDevice).values():
+            node.GetAccessMode = lambda: RO
+
+        self._nodemap = _NodeMap({name: node for name, node in vars(self).items()
+                                  if isinstance(node, _Node)})
+
+    # Frames
+    def _geometry(self):
+        return (self.BinningHorizontal._value, self.BinningVertical._value,
+                self.BinningHorizontalMode._value, self.BinningVerticalMode._value,
+                self.DecimationHorizontal._value, self.DecimationVertical._value,
+                self.OffsetX._value, self.OffsetY._value, self.Width._value, self.Height._value)
+
+    def _background(self, counts):
+        # Background at current exposure, gain and geometry as float32, cached
+        key = (round(counts, 1), self._geometry())
+        if self._background_cache.get('key') == key:
+            return self._background_cache['image']
+
+        image = self._scene['background'] * counts
+
+        # Decimation then binning; average mode divides the sum
+        image = image[::self.DecimationVertical._value, ::self.DecimationHorizontal._value]
+        bin_h, bin_v = self.BinningHorizontal._value, self.BinningVertical._value
+        height = image.shape[0] // bin_v * bin_v
+        width = image.shape[1] // bin_h * bin_h
+        image = image[:height, :width].reshape(height // bin_v, bin_v, width // bin_h, bin_h)
+        image = image.sum(axis=(1, 3))
+        if self.BinningHorizontalMode._value == BinningHorizontalMode_Average:
+            image /= bin_h
+        if self.BinningVerticalMode._value == BinningVerticalMode_Average:
+            image /= bin_v
+
+        image = np.ascontiguousarray(
+            image[self.OffsetY._value:self.OffsetY._value + self.Height._value,
+                  self.OffsetX._value:self.OffsetX._value + self.Width._value])
+        self._background_cache = {'key': key, 'image': image}
+        return image
+
+    def _clean_frame(self, gain):
+        # Scene at current defocus, exposure, gain and geometry as uint16 with the noise offset
+        # removed; cached since z and settings only change between planes
+        defocus_um = round((_focus_position_mm() - _SIM_PARAMS['focus_z_mm']) * 1e3, 2)
+        counts = _SIM_PARAMS['counts_per_us'] * self.ExposureTime._value * \
+            10 ** (self.Gain._value / 20.0) * gain
+        key = (defocus_um, round(counts, 1), self._geometry())
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        background = self._background(counts)
+        noise_span = int(6 * _SIM_PARAMS['read_noise'])
+        image = background - noise_span // 2
+
+        # Particles modulate the background around them
+        step_x = self.DecimationHorizontal._value * self.BinningHorizontal._value
+        step_y = self.DecimationVertical._value * self.BinningVertical._value
+        kernel, radius = _particle_kernel(defocus_um, (step_x * step_y) ** 0.5)
+        height, width = image.shape
+        for y, x, amp in zip(self._scene['particles_y'], self._scene['particles_x'],
+                             self._scene['particles_amp']):
+            y = y // step_y - self.OffsetY._value
+            x = x // step_x - self.OffsetX._value
+            y0, y1 = max(y - radius, 0), min(y + radius + 1, height)
+            x0, x1 = max(x - radius, 0), min(x + radius + 1, width)
+            if y0 >= y1 or x0 >= x1:
+                continue
+            image[y0:y1, x0:x1] += background[y0:y1, x0:x1] * amp * \
+                kernel[y0 - y + radius:y1 - y + radius, x0 - x + radius:x1 - x + radius]
+
+        frame = np.clip(image, 0, 65535 - noise_span).astype(np.uint16)
+        self._cache[key] = frame
+        while len(self._cache) > 16:
+            self._cache.popitem(last=False)
+        return frame
+
+    def _noise_frames(self, shape):
+        # Noise frames are row-shifted views of one noise field, which is much cheaper to generate
+        if self._noise is None or self._noise[0].shape != shape:
+            rng = np.random.RandomState(_SIM_PARAMS['seed'])
+            noise_span = int(6 * _SIM_PARAMS['read_noise'])
+            num_noise = _SIM_PARAMS['num_noise_frames']
+            field = rng.normal(noise_span / 2.0, _SIM_PARAMS['read_noise'],
+                               (shape[0] + num_noise, shape[1]))
+            field = np.clip(field, 0, noise_span).astype(np.uint16)
+            self._noise = [field[i:i + shape[0]] for i in range(num_noise)]
+            self._out = np.empty(shape, dtype=np.uint16)
+        return self._noise
+
+    def _wait_frame(self, timeout):
+        # Waits for next frame; returns exposure (start, end) in perf_counter seconds
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        exposure = self.ExposureTime._value * 1e-6
+        with self._cond:
+            if self.TriggerMode._value == TriggerMode_On:
+                while True:
+                    if not self._streaming:
+                        raise SpinnakerException('Camera is not streaming.')
+                    if self._triggers:
+                        start = self._triggers[0]
+                        ready = start + exposure
+                        now = time.perf_counter()
+                        if ready <= now:
+                            self._triggers.pop(0)
+                            return start, ready
+                        wait = ready - now
+                    else:
+                        wait = None
+                    if deadline is not None:
+                        remaining = deadline - time.perf_counter()
+                        if remaining <= 0:
+                            raise SpinnakerException('Timeout waiting for image.',
+                                                     SPINNAKER_ERR_TIMEOUT)
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._cond.wait(wait)
+
+            # Free running
+            period = 1.0 / self._fps()
+            now = time.perf_counter()
+            if self._next_time < now - period:
+                late = int((now - self._next_time) / period)
+                if self.TLStream.StreamBufferHandlingMode._value == \
+                        StreamBufferHandlingMode_NewestOnly:
+                    # Only the newest frame is kept; skipped frames show up as frame ID gaps
+                    self._frame_id += late
+                    self._next_time += late * period
+                elif late > _SIM_PARAMS['num_buffers']:
+                    skipped = late - _SIM_PARAMS['num_buffers']
+                    self._frame_id += skipped
+                    self._next_time += skipped * period
+            if deadline is not None and self._next_time > deadline:
+                time.sleep(max(deadline - now, 0))
+                raise SpinnakerException('Timeout waiting for image.', SPINNAKER_ERR_TIMEOUT)
+        if self._next_time > now:
+            time.sleep(self._next_time - now)
+        ready = self._next_time
+        self._next_time = ready + period
+
+        # Trigger was enabled before this exposure started, so it never happened
+        with self._cond:
+            if self.TriggerMode._value == TriggerMode_On and \
+                    ready - exposure >= self._trigger_on_time:
+                self._next_time = ready
+                return self._wait_frame(None if deadline is None else
+                                        max(deadline - time.perf_counter(), 0))
+        return ready - exposure, ready
+
+    # PySpin camera API
+    def Init(self):
+        self._initialized = True
+
+    def DeInit(self):
+        if self._streaming:
+            raise SpinnakerException('Camera is streaming.')
+        self._initialized = False
+
+    def IsValid(self):
+        return self._valid
+
+    def IsInitialized(self):
+        return self._initialized
+
+    def IsStreaming(self):
+        return self._streaming
+
+    def GetNodeMap(self):
+        return self._nodemap
+
+    def GetTLDeviceNodeMap(self):
+        return _NodeMap(vars(self.TLDevice))
+
+    def BeginAcquisition(self):
+        if not self._initialized:
+            raise SpinnakerException('Camera is not initialized.')
+        if self._streaming:
+            raise SpinnakerException('Camera is already streaming.')
+        with self._cond:
+            self._streaming = True
+            self._triggers = []
+            self._next_time = time.perf_counter() + 1.0 / self._fps()
+
+    def EndAcquisition(self):
+        if not self._streaming:
+            raise SpinnakerException('Camera is not streaming.')
+        with self._cond:
+            self._streaming = False
+            self._cond.notify_all()
+
+    def GetNextImage(self, timeout=EVENT_TIMEOUT_INFINITE):
+        if not self._streaming:
+            raise SpinnakerException('Camera is not streaming.')
+        timeout = None if timeout == EVENT_TIMEOUT_INFINITE else timeout * 1e-3
+        start, end = self._wait_frame(timeout)
+
+        frame = self._clean_frame(_led_gain(start, end))
+        noise = self._noise_frames(frame.shape)
+        np.add(frame, noise[self._frame_id % len(noise)], out=self._out)
+
+        image = _Image(self._out, self._frame_id, self._clock_ns(start),
+                       self._rng.random() < _SIM_PARAMS['incomplete_rate'])
+        self._frame_id += 1
+        return image
+
+
+def line_trigger(line, when=None):
+    # Pulses input line "line" of every camera at perf_counter time "when" (default now), e.g.
+    # from the simulated LED controller
+    source = globals()['TriggerSource_Line' + str(line)]
+    when = time.perf_counter() if when is None else when
+    for cam in _SYSTEM_DICT['cameras'] or []:
+        cam._line_trigger(source, when)  # pylint: disable=protected-access
+
+
+class _Namespace(object):
+    def __init__(self, **nodes):
+        self.__dict__.update(nodes)
+
+
+### System ###
+
+class _CameraList(object):
+    def __init__(self, cams):
+        self._cams = list(cams)
+
+    def __iter__(self):
+        return iter(self._cams)
+
+    def __len__(self):
+        return len(self._cams)
+
+    def GetSize(self):
+        return len(self._cams)
+
+    def GetByIndex(self, index):
+        return self._cams[index]
+
+    def GetBySerial(self, serial):
+        for cam in self._cams:
+            if cam.TLDevice.DeviceSerialNumber.GetValue() == str(serial):
+                return cam
+        return None
+
+    def Clear(self):
+        self._cams = []
+
+
+_SYSTEM_DICT = {'system': None, 'cameras': None}
+
+
+class System(object):
+    @staticmethod
+    def GetInstance():
+        if _SYSTEM_DICT['system'] is None:
+            _SYSTEM_DICT['system'] = System()
+        return _SYSTEM_DICT['system']
+
+    def GetCameras(self):
+        if _SYSTEM_DICT['cameras'] is None:
+            _SYSTEM_DICT['cameras'] = [Camera(str(serial), i)
+                                       for i, serial in enumerate(_SIM_PARAMS['serials'])]
+        return _CameraList(_SYSTEM_DICT['cameras'])
+
+    def IsInUse(self):
+        return False
+
+    def ReleaseInstance(self):
+        _SYSTEM_DICT['system'] = None
@@ -1,26 +1,31 @@
+import time
+__IMPORT_TIC = time.perf_counter()  # startup timing includes the imports below
+
+import os
 import sys
 #import queue
 import functools
 import datetime
-import serial
-from tkinter import messagebox
-from tkinter import filedialog
-from subprocess import Popen
 import numpy as np
 import stage
-import time
 # import cv2
 
-
-import matplotlib.pyplot as plt
-from matplotlib.widgets import TextBox
-from matplotlib.widgets import Button
-from matplotlib.widgets import Slider
-
-from skimage.external import tifffile as ski
-
 import spincam
 import ledserial
+import multicolor
+import mosaic
+import autofocus
+import positions
+import tiffwriter
+import frameproc
+
+# matplotlib and tkinter are imported when the GUI is built, so scripts and tests that only use
+# the acquisition functions start quickly
+plt = None
+TextBox = Button = Slider = RectangleSelector = RadioButtons = None
+
+# Startup timings in seconds, printed when the GUI is up
+__STARTUP = {'import': None, 'gui': None}
 
 # Camera Properties Min/Max
 __FPS_MIN = 1
@@ -34,7 +39,8 @@ __EXPOSURE_MAX = 200000  # microseconds seconds
 #__QUEUE = queue.Queue()
 __STREAM = False
 __IMSHOW_DICT = {'imshow': None, 'imshow_size': None, 'max_val': None}
-__HIST_DICT = {'bar': None, 'max_val': None}
+__HIST_DICT = {'line': None, 'text': None, 'num_bins': None, 'seq': None}
+__HIST_BINS = 256
 __GUI_DICT = None
 __STAGE_DICT = None
 
@@ -46,11 +52,57 @@ __Z_STEP_PLUS = 100
 __XY_STEP = 1
 __XY_STEP_PLUS = 100
 
-__X_POS = 0
-__Y_POS = 0
-__Z_POS = 0
+# Last position shown in the readouts, in um
+__X_POS = None
+__Y_POS = None
+__Z_POS = None
 __COM_PORT = 7
 
+# TIFF writer params
+__WRITER_DEPTH = 8
+__WRITER_THREADS = 2
+
+# Trigger source for defocus acquisition - None free runs, 'Software' exposes exactly "# to Avg"
+# frames per plane once the stage has settled, 'Line0'..'Line3' uses an external trigger
+__TRIGGER_SOURCE = None
+__TRIGGER_LABELS = ('free run', 'Software', 'Line0')
+
+# LED engine for four colour acquisition - 'command' switches colours over serial and discards
+# frames straddling a switch, 'trigger' runs the colour sequence on the LED controller, which
+# triggers the camera through Line0
+__LED_MODE = 'command'
+__LED_MODES = ('command', 'trigger')
+
+# Live view - binned preview frames at a fixed interval, taken from the acquisition stream
+__PREVIEW_INTERVAL = 0.1  # seconds
+__PREVIEW_BIN = 4
+__PREVIEW_SEQ = None
+
+# ROI selection on the live image; "bin" is the binning of the shown preview frame
+__ROI_DICT = {'selector': None, 'bin': __PREVIEW_BIN}
+
+# Display - live view is blitted at most __REFRESH_RATE times a second; black and white levels of
+# the 16 bit -> 8 bit display mapping, None is the max value
+__REFRESH_RATE = 20  # Hz
+__DISPLAY_RANGE = (0, None)
+__RENDER_DICT = {'background': None}
+
+# Output mode - 'files' writes one TIFF per plane, 'stack' appends every plane of a run to one
+# BigTIFF
+__OUTPUT_MODE = 'files'
+__OUTPUT_MODES = ('files', 'stack')
+
+# Adaptive z-stack - every defocus plane is scored with autofocus.score(); each time point's
+# stack is centred on the best plane of the previous one and, when writing files, a sweep stops
+# once the score has clearly passed a peak near the centre
+__ADAPTIVE_Z = False
+
+# Mosaic - tile size is the field of view: ROI in sensor pixels times __PIXEL_SIZE, the sensor
+# pixel pitch divided by the magnification, in um at the sample
+__PIXEL_SIZE = 0.345  # um
+__MOSAIC_OVERLAP = 0.1  # fraction of a tile
+__MOSAIC_ORDER = 'serpentine'
+
 
 def __find_and_init_cam(_=None):
     # Finds and initializes camera
@@ -59,24 +111,35 @@ def __find_and_init_cam(_=None):
     global __FPS_MAX
     global __FPS_MIN
 
+    # "serial, serial, ..." - the first camera is shown live, the others are acquired with it
     find_and_init_text = __GUI_DICT['display_dict']['find_and_init_text'].text
+    cam_serials = [cam_serial.strip() for cam_serial in find_and_init_text.split(',')]
     print('Connecting camera...')
-    spincam.find_cam(find_and_init_text)
-    spincam.init_cam()
+    spincam.find_cam(cam_serials[0])
+    for cam_serial in cam_serials[1:]:
+        spincam.add_cam(cam_serial)
+    spincam.for_each_cam(__init_cam)
     __EXPOSURE_MIN = spincam.get_exp_min()
     __EXPOSURE_MAX = spincam.get_exp_max()
     __FPS_MIN = spincam.get_fps_min()
     __FPS_MAX = spincam.get_fps_max()
+    __show_roi(spincam.get_roi())
+    ledserial.connect(__COM_PORT)
+
+
+def __init_cam():
+    # Initializes selected camera with manual exposure, gain and frame rate
+    spincam.init_cam()
     spincam.disable_auto_exp()
     spincam.disable_auto_gain()
     spincam.disable_auto_frame()
     __init_gain(0)
     spincam.set_video_mode('7')
     spincam.set_pixel_format()
-    ledserial.connect(__COM_PORT)
 
 
 def __choose_directory(_=None):
+    from tkinter import filedialog
     dir = filedialog.askdirectory()
     __GUI_DICT['directory_text'].set_val(dir)
 
@@ -95,58 +158,67 @@ def __find_and_init_cam(_=None):
     global __FPS_MAX
     global __FPS_MIN
 
+    # "serial, serial, ..." - the first camera is shown live, the others are acquired with it
     find_and_init_text = __GUI_DICT['display_dict']['find_and_init_text'].text
+    cam_serials = [cam_serial.strip() for cam_serial in find_and_init_text.split(',')]
     print('Connecting camera...')
-    spincam.find_cam(find_and_init_text)
-
-    spincam.init_cam()
+    spincam.find_cam(cam_serials[0])
+    for cam_serial in cam_serials[1:]:
+        spincam.add_cam(cam_serial)
+    spincam.for_each_cam(__init_cam)
     __EXPOSURE_MIN = spincam.get_exp_min()
     __EXPOSURE_MAX = spincam.get_exp_max()
     __FPS_MIN = spincam.get_fps_min()
     __FPS_MAX = spincam.get_fps_max()
-    spincam.disable_auto_exp()
-    spincam.disable_auto_gain()
-    spincam.disable_auto_frame()
-    __init_gain(0)
-    spincam.set_video_mode('7')
-    spincam.set_pixel_format()
+    __show_roi(spincam.get_roi())
     ledserial.connect(__COM_PORT)
 
 
 def __choose_directory(_=None):
+    from tkinter import filedialog
     dir = filedialog.askdirectory()
     __GUI_DICT['directory_text'].set_val(dir)
 
-def __open_preview(_=None):
-    Popen('flycap.exe')
-
 def __start_stream(_=None):
     # Starts stream of cameras
     global __STREAM
+    global __PREVIEW_SEQ
 
     # Ensure aren't already streaming
     if not __STREAM:
         print('Starting stream...')
 
         # Set buffer to newest only
-        spincam.cam_node_cmd('TLStream.StreamBufferHandlingMode',
+        spincam.for_each_cam(spincam.cam_node_cmd,
+                             'TLStream.StreamBufferHandlingMode',
                              'SetValue',
                              'RW',
                              'PySpin.StreamBufferHandlingMode_NewestOnly')
 
         # Set acquisition mode to continuous
-        spincam.cam_node_cmd('AcquisitionMode',
+        spincam.for_each_cam(spincam.cam_node_cmd,
+                             'AcquisitionMode',
                              'SetValue',
                              'RW',
                              'PySpin.AcquisitionMode_Continuous')
 
-        # Start acquisition
-        spincam.start_acquisition()
+        # Start acquisition of every camera
+        spincam.start_acquisitions()
+        spincam.start_preview(__PREVIEW_INTERVAL, __preview_bin(spincam.get_acq_mode()))
+        __PREVIEW_SEQ = None
+        __HIST_DICT['seq'] = None
 
         # Enable stream
         __STREAM = True
 
 
+def __ensure_stream():
+    # Streaming session stays open between operations; settings are applied live and spincam
+    # only hands out frames taken after the last settings change
+    if not __STREAM:
+        __start_stream()
+
+
 def __stop_stream(_=None):
     # Stops stream of cameras
     global __STREAM
@@ -156,14 +228,161 @@ def __stop_stream(_=None):
         print('Stopping stream...')
 
         # Stop acquisition
-        spincam.end_acquisition()
+        spincam.stop_preview()
+        spincam.end_acquisitions()
         # End stream
         __STREAM = False
 
+    # Make sure everything acquired so far is on disk
+    tiffwriter.flush()
+
+
+def __refresh_limits():
+    # Re-reads frame rate and exposure limits, which change with the sensor geometry, and
+    # updates the slider ranges
+    global __EXPOSURE_MAX
+    global __EXPOSURE_MIN
+    global __FPS_MAX
+    global __FPS_MIN
+
+    __EXPOSURE_MIN = spincam.get_exp_min()
+    __EXPOSURE_MAX = spincam.get_exp_max()
+    __FPS_MIN = spincam.get_fps_min()
+    __FPS_MAX = spincam.get_fps_max()
+
+    for slider_str, val_min, val_max in (('fps_slider', __FPS_MIN, __FPS_MAX),
+                                         ('exposure_slider', __EXPOSURE_MIN, __EXPOSURE_MAX)):
+        slider = __GUI_DICT[slider_str]
+        slider.valmin = val_min
+        slider.valmax = val_max
+        slider.ax.set_xlim(val_min, val_max)
+    __RENDER_DICT['background'] = None
+
+
+def __show_roi(roi):
+    # Shows ROI in text box without triggering its callback
+    __GUI_DICT['roi_text'].eventson = False
+    __GUI_DICT['roi_text'].set_val('%d, %d, %d, %d' % (roi['offset_x'], roi['offset_y'],
+                                                       roi['width'], roi['height']))
+    __GUI_DICT['roi_text'].eventson = True
+
+
+def __set_roi(offset_x, offset_y, width, height):
+    # Applies ROI on the camera; frame sequence restarts with the new capture buffers
+    global __PREVIEW_SEQ
+
+    roi = spincam.set_roi(offset_x, offset_y, width, height)
+    __PREVIEW_SEQ = None
+    __HIST_DICT['seq'] = None
+    __show_roi(roi)
+    __refresh_limits()
+    print('ROI is set to x: %d, y: %d, width: %d, height: %d' % (roi['offset_x'], roi['offset_y'],
+                                                               roi['width'], roi['height']))
+    print('Frame rate limit is ' + str(__FPS_MAX))
+
+
+def __roi_text(_=None):
+    # ROI text callback; "x, y, width, height" in sensor pixels
+    roi_text = __GUI_DICT['roi_text'].text
+    if not roi_text:
+        return
+
+    try:
+        values = [int(float(val)) for val in roi_text.replace(',', ' ').split()]
+    except ValueError:
+        values = []
+    if len(values) != 4:
+        print('ROI must be given as "x, y, width, height".')
+        return
+
+    __set_roi(*values)
+
+
+def __full_frame(_=None):
+    # Reads out the full sensor again
+    roi = spincam.get_roi()
+    __set_roi(0, 0, roi['max_width'], roi['max_height'])
+
+
+def __on_roi_selected(press, release):
+    # Rectangle drawn on the live image; preview pixels are binned and relative to the current ROI
+    __stop_roi_selector()
+
+    roi = spincam.get_roi()
+    factor = __ROI_DICT['bin']
+    x_min, x_max = sorted((press.xdata, release.xdata))
+    y_min, y_max = sorted((press.ydata, release.ydata))
+    __set_roi(roi['offset_x'] + int(round(x_min * factor)),
+              roi['offset_y'] + int(round(y_min * factor)),
+              int(round((x_max - x_min) * factor)),
+              int(round((y_max - y_min) * factor)))
+
+
+def __stop_roi_selector():
+    # Removes rectangle selector from the live image
+    selector = __ROI_DICT['selector']
+    if selector is not None:
+        __ROI_DICT['selector'] = None
+        selector.set_active(False)
+        selector.set_visible(False)
+        selector.disconnect_events()
+        __RENDER_DICT['background'] = None
+
+
+def __acq_factor(acq_mode, direction):
+    # Sensor pixels per image pixel along "direction"; cameras without binning or decimation
+    # report None for them
+    return ((acq_mode['binning_' + direction] or 1) *
+            (acq_mode['decimation_' + direction] or 1))
+
+
+def __preview_bin(acq_mode):
+    # Live view binning on top of the camera's binning and decimation, so the shown frame keeps
+    # about the same size in every acquisition mode
+    camera_bin = max(__acq_factor(acq_mode, 'horizontal'), __acq_factor(acq_mode, 'vertical'))
+    return max(1, __PREVIEW_BIN // camera_bin)
+
+
+def __set_acq_mode(acq_mode):
+    # Acquisition mode callback; binning and decimation change the sensor geometry, so the ROI is
+    # reset to the full sensor and the live view is binned less
+    global __PREVIEW_SEQ
+
+    __stop_roi_selector()
+    acq_mode_dict = spincam.set_acq_mode(acq_mode)
+    if __STREAM:
+        spincam.stop_preview()
+        spincam.start_preview(__PREVIEW_INTERVAL, __preview_bin(acq_mode_dict))
+    __PREVIEW_SEQ = None
+    __HIST_DICT['seq'] = None
+    __show_roi(spincam.get_roi())
+    __refresh_limits()
+    print('Acquisition mode is set to %s: binning %dx%d (%s), decimation %dx%d' % (
+        acq_mode,
+        acq_mode_dict['binning_horizontal'],
+        acq_mode_dict['binning_vertical'],
+        acq_mode_dict['binning_horizontal_mode'],
+        acq_mode_dict['decimation_horizontal'],
+        acq_mode_dict['decimation_vertical']))
+    print('Frame rate limit is ' + str(__FPS_MAX))
+
 
 def __select_roi(_=None):
-    # spincam.roi()
-    print('ROI')
+    # Lets the user drag the ROI on the live image; it is applied when the mouse is released
+    if not __STREAM or __IMSHOW_DICT['imshow'] is None:
+        print('Start the stream to select the ROI on the live image.')
+        return
+
+    __stop_roi_selector()
+    # No blitting, so the rectangle is drawn with the cached background
+    __ROI_DICT['selector'] = RectangleSelector(__GUI_DICT['display_dict']['image_axes'],
+                                               __on_roi_selected,
+                                               useblit=False,
+                                               button=[1],
+                                               minspanx=2,
+                                               minspany=2,
+                                               spancoords='data')
+    print('Drag the ROI on the live image...')
 
 
 def __test(_=None):
@@ -171,61 +390,112 @@ def __test(_=None):
 
 
 def __plot_image(image, max_val, image_axes, imshow_dict):
-    # plots image
+    # plots image; 16 bit data is mapped to 8 bit through a precomputed LUT
+
+    # LUT only changes with the contrast range
+    black, white = __DISPLAY_RANGE
+    lut_key = (black, max_val if white is None else white, max_val)
+    if imshow_dict.get('lut_key') != lut_key:
+        imshow_dict['lut'] = frameproc.display_lut(lut_key[0], lut_key[1],
+                                                   int(max_val).bit_length())
+        imshow_dict['lut_key'] = lut_key
+    display = frameproc.apply_lut(image, imshow_dict['lut'])
 
     # If image size changes or max val changes, replot imshow
     if image.shape != imshow_dict['imshow_size'] or max_val != imshow_dict['max_val']:
         image_axes.cla()
-        imshow_dict['imshow'] = image_axes.imshow(image, cmap='gray', vmin=0, vmax=max_val)
+        imshow_dict['imshow'] = image_axes.imshow(display, cmap='gray', vmin=0, vmax=255,
+                                                  interpolation='nearest', animated=True)
         imshow_dict['imshow_size'] = image.shape
         imshow_dict['max_val'] = max_val
         image_axes.set_xticklabels([])
         image_axes.set_yticklabels([])
         # image_axes.set_xticks(list(range(1,2736)))
         # image_axes.set_yticks(list(range(1,2192)))
+        # Axes changed, so the cached background is stale
+        __RENDER_DICT['background'] = None
     else:
         # Can just "set_data" since data is the same size and has the same max val
-        imshow_dict['imshow'].set_data(image)
+        imshow_dict['imshow'].set_data(display)
 
     return imshow_dict
 
 
-def __plot_hist(_=None):
-    global __HIST_DICT
-	# plots histogram
-    num_to_avg = int(__GUI_DICT['avg_images_text'].text)
-    # grab an image
-    if (__STREAM):
-        __stop_stream()
-    time.sleep(10)
-    __start_stream()
-    time.sleep(5)
-    image_dict = spincam.get_image_and_avg(num_to_avg)
-    image = image_dict['data']
-    max_val = 2**image_dict['bitsperpixel']-1
-    hist_axes =__GUI_DICT['display_dict']['hist_axes']
-    hist_dict =__HIST_DICT
-    __stop_stream()
-    # Calculate histogram
-    num_bins = 100
-    hist, bins = np.histogram(image.ravel(), bins=num_bins, range=(0, max_val))
+def __on_draw(event):
+    # Full redraws (resize, widget updates) leave out the animated artists; cache the new
+    # background and put the artists back on top
+    canvas = event.canvas
+    __RENDER_DICT['background'] = canvas.copy_from_bbox(canvas.figure.bbox)
+    __blit_artists(canvas)
+
+
+def __blit_artists(canvas):
+    # Draws live image and histogram over the cached background and blits them
+
+    for artist in (__IMSHOW_DICT['imshow'], __HIST_DICT['line'], __HIST_DICT['text']):
+        if artist is not None:
+            canvas.figure.draw_artist(artist)
+    canvas.blit(canvas.figure.bbox)
+
 
-    # If no histogram or max value changes, replot histogram
-    if hist_dict['bar'] is None or hist_dict['max_val'] != max_val:
-        # Reset axes and plot hist
+def __render():
+    # Updates the live view; only the animated artists are redrawn unless the figure changed
+
+    canvas = __GUI_DICT['fig'].canvas
+    if __RENDER_DICT['background'] is None:
+        # Draw event caches the background and blits
+        canvas.draw()
+        return
+
+    canvas.restore_region(__RENDER_DICT['background'])
+    __blit_artists(canvas)
+
+
+def __draw_hist(hist_dict, hist_axes):
+    # Draws live histogram; after the first call only the line data and saturation text change
+
+    hist = hist_dict['hist']
+    if hist_dict['line'] is None or hist_dict['num_bins'] != hist.shape[0]:
+        # Reset axes and plot hist; counts are scaled to the tallest bin so limits stay fixed
         hist_axes.cla()
-        hist_dict['bar'] = hist_axes.bar(bins[:-1], hist, color='k', width=(max_val + 1) / num_bins)
-        hist_dict['max_val'] = max_val
+        hist_dict['line'], = hist_axes.plot(np.arange(hist.shape[0]), hist, color='k',
+                                            drawstyle='steps-mid', linewidth=0.8, animated=True)
+        hist_dict['text'] = hist_axes.text(0.98, 0.9, '', transform=hist_axes.transAxes,
+                                           ha='right', va='top', fontsize=7, animated=True)
+        hist_dict['num_bins'] = hist.shape[0]
+        hist_axes.set_xlim(0, hist.shape[0] - 1)
+        hist_axes.set_ylim(0, 1.05)
         hist_axes.set_xticklabels([])
         hist_axes.set_yticklabels([])
         hist_axes.set_xticks([])
         hist_axes.set_yticks([])
-    else:
-        # Reset height
-        for i, bar in enumerate(hist_dict['bar']):  # pylint: disable=blacklisted-name
-            bar.set_height(hist[i])
-    __HIST_DICT = hist_dict
-    return hist_dict
+        __RENDER_DICT['background'] = None
+
+    peak = hist.max()
+    hist_dict['line'].set_ydata(hist / peak if peak > 0 else hist)
+    hist_dict['text'].set_text('Saturated: %.2f%%' % hist_dict['saturation'])
+    hist_dict['text'].set_color('r' if hist_dict['saturation'] > 0 else 'k')
+
+
+def __update_hist():
+    # Redraws histogram if the stream has a newer one
+    global __HIST_DICT
+
+    hist = spincam.get_histogram(__HIST_BINS, __HIST_DICT['seq'])
+    if hist is None:
+        return False
+
+    __HIST_DICT.update(hist)
+    __draw_hist(__HIST_DICT, __GUI_DICT['display_dict']['hist_axes'])
+    return True
+
+
+def __plot_hist(_=None):
+    # Histogram is computed live on the running stream by spincam's preview thread and redrawn
+    # by the GUI loop; this only makes sure the stream runs
+    __ensure_stream()
+    if __update_hist():
+        __render()
 
 
 def __plot_image_and_hist(image, max_val, image_axes, imshow_dict, hist_axes,
@@ -319,8 +589,7 @@ def __fps_slider(_=None):
     # Set fps for camera
     framerate = min(__FPS_MAX, framerate)
     framerate = max(__FPS_MIN, framerate)
-    spincam.set_frame_rate(framerate)
-    fr = spincam.get_frame_rate()
+    fr = spincam.set_frame_rate(framerate)
     print('Frame Rate is set to ' + str(fr))
 
 
@@ -341,8 +610,7 @@ def __fps_text(_=None):
     # Set fps for camera
     framerate = min(__FPS_MAX, framerate)
     framerate = max(__FPS_MIN, framerate)
-    spincam.set_frame_rate(framerate)
-    fr = spincam.get_frame_rate()
+    fr = spincam.set_frame_rate(framerate)
     print('Frame Rate is set to ' + str(fr))
 
 
@@ -378,6 +646,46 @@ def __gain_text(_=None):
     spincam.set_gain(gain)
 
 
+def __set_output_mode(output_mode):
+    # Output mode callback
+    global __OUTPUT_MODE
+    __OUTPUT_MODE = output_mode
+    print('Output mode is set to ' + output_mode)
+
+
+def __set_trigger_source(label):
+    # Trigger source callback; 'free run' takes frames from the free running stream
+    global __TRIGGER_SOURCE
+    __TRIGGER_SOURCE = None if label == 'free run' else label
+    print('Defocus trigger is set to ' + label)
+
+
+def __set_led_mode(led_mode):
+    # LED engine callback
+    global __LED_MODE
+    __LED_MODE = led_mode
+    print('LED mode is set to ' + led_mode)
+
+
+def __set_adaptive_z(label):
+    # Adaptive z-stack callback
+    global __ADAPTIVE_Z
+    __ADAPTIVE_Z = label == 'adaptive'
+    print('Defocus z-stack is set to ' + label)
+
+
+def __radio_with_title(fig, pos, title, options, active, callback):
+    # Creates radio buttons with a title above them
+
+    radio_axes = fig.add_axes(pos)
+    radio_axes.set_title(title, fontsize=7)
+    radio = RadioButtons(radio_axes, options, active=active)
+    for label in radio.labels:
+        label.set_fontsize(7)
+    radio.on_clicked(callback)
+    return radio
+
+
 def __slider_with_text(fig, pos, slider_str, val_min, val_max, val_default,
                        padding):  # pylint: disable=too-many-arguments
     # Creates a slider with text box
@@ -430,106 +738,94 @@ def __exposure_slider(_=None):
 
 
 def __go_right(_=None):
-    global __Y_POS
-    __Y_POS = __Y_POS + __XY_STEP
     stage.__go_y(__XY_STEP)
-    __update_pos_y
+    __update_pos()
 
 def __go_right_plus(_=None):
-    global __Y_POS
-    __Y_POS = __Y_POS + __XY_STEP_PLUS
     stage.__go_y(__XY_STEP_PLUS)
-    __update_pos_y
+    __update_pos()
 
 def __go_left(_=None):
-    global __Y_POS
-    __Y_POS = __Y_POS - __XY_STEP
     stage.__go_y(-__XY_STEP)
-    __update_pos_y
+    __update_pos()
 
 def __go_left_plus(_=None):
-    global __Y_POS
-    __Y_POS = __Y_POS - __XY_STEP_PLUS
     stage.__go_y(-__XY_STEP_PLUS)
-    __update_pos_y
+    __update_pos()
 
 def __go_up(_=None):
-    global __X_POS
-    __X_POS = __X_POS + __XY_STEP
     stage.__go_x(__XY_STEP)
-    __update_pos_x
+    __update_pos()
 
 def __go_up_plus(_=None):
-    global __X_POS
-    __X_POS = __X_POS + __XY_STEP_PLUS
     stage.__go_x(+__XY_STEP_PLUS)
-    __update_pos_x
+    __update_pos()
 
 def __go_down(_=None):
-    global __X_POS
-    __X_POS = __X_POS - __XY_STEP
     stage.__go_x(-__XY_STEP)
-    __update_pos_x
+    __update_pos()
 
 def __go_down_plus(_=None):
-    global __X_POS
-    __X_POS = __X_POS - __XY_STEP_PLUS
     stage.__go_x(-__XY_STEP_PLUS)
-    __update_pos_x
+    __update_pos()
 
 
 def __go_defocus_up(_=None):
-    global __Z_POS
-    __Z_POS = __Z_POS + __Z_STEP
     stage.__go_z(+__Z_STEP)
-    __update_pos_z
+    __update_pos()
 
 def __go_defocus_up_plus(_=None):
-    global __Z_POS
-    __Z_POS = __Z_POS + __Z_STEP_PLUS
     stage.__go_z(+__Z_STEP_PLUS)
-    __update_pos_z
+    __update_pos()
 
 def __go_defocus_down(_=None):
-    global __Z_POS
-    __Z_POS = __Z_POS - __Z_STEP
     stage.__go_z(-__Z_STEP)
-    __update_pos_z
+    __update_pos()
 def __go_defocus_down_plus(_=None):
-    global __Z_POS
-    __Z_POS = __Z_POS - __Z_STEP_PLUS
     stage.__go_z(-__Z_STEP_PLUS)
-    __update_pos_z
+    __update_pos()
 
-def __update_pos_x(_=None):
-    global __X_POS
-    # updates the current postion
-    stage_dict = __GUI_DICT['stage_dict']
-    pos = 'x_pos_but'
-    step = __X_POS
-    stage_dict[pos].eventson = False
-    stage_dict[pos].set_val(step)
-    stage_dict[pos].eventson = True
-
-def __update_pos_y(_=None):
-    global __Y_POS
-    # updates the current postion
-    stage_dict = __GUI_DICT['stage_dict']
-    pos = 'y_pos_but'
-    step = __Y_POS
-    stage_dict[pos].eventson = False
-    stage_dict[pos].set_val(step)
-    stage_dict[pos].eventson = True
-
-def __update_pos_z(_=None):
-    global __Z_POS
-    # updates the current postion
+def __update_pos(max_age=0, save=True):
+    # updates the current position readouts from the stage encoders; a read younger than
+    # "max_age" seconds is reused. "save" keeps it as the last-known position, so it's set once
+    # a move has finished.
+    global __X_POS, __Y_POS, __Z_POS
+
+    if save:
+        position = positions.save_position(max_age)
+    else:
+        position = positions.get_position(max_age)
+    if position == (__X_POS, __Y_POS, __Z_POS):
+        return
+    __X_POS, __Y_POS, __Z_POS = position
+
+    # set_val() redraws the whole figure; only the text changes, drawn on the next GUI event
     stage_dict = __GUI_DICT['stage_dict']
-    pos = 'z_pos_but'
-    step = __Z_POS
-    stage_dict[pos].eventson = False
-    stage_dict[pos].set_val(step)
-    stage_dict[pos].eventson = True
+    for pos, value in zip(('x_pos_but', 'y_pos_but', 'z_pos_but'), position):
+        stage_dict[pos].text_disp.set_text('%.2f' % value)
+    stage_dict['fig2'].canvas.draw_idle()
+
+def __go_to_pos(axis, text):
+    # position readout callback; moves axis to the absolute position (um) typed in
+    try:
+        value = float(text)
+    except ValueError:
+        __update_pos()
+        return
+    positions.move_to(**{axis + '_position': value})
+    __update_pos()
+
+def __save_bookmark(_=None):
+    # Saves the current position under the name in the bookmark box
+    name = __GUI_DICT['stage_dict']['bookmark_text'].text.strip()
+    position = positions.add_bookmark(name)
+    print('Bookmark "%s" at x %.2f, y %.2f, z %.2f um' % ((name,) + position))
+
+def __go_to_bookmark(_=None):
+    # Moves to the bookmark named in the bookmark box
+    name = __GUI_DICT['stage_dict']['bookmark_text'].text.strip()
+    positions.go_to_bookmark(name)
+    __update_pos()
 
 def __xy_step(_=None):
     # xy text callback
@@ -643,12 +939,7 @@ def __number_defocus(_=None):
 
 
 def __defocus_acquisition(_=None):
-    if (__STREAM):
-        __stop_stream()
-    time.sleep(10)
-    __start_stream()
-    time.sleep(5)
-    global __Z_POS
+    __ensure_stream()
     stage_dict = __GUI_DICT['stage_dict']
     num_z_step = int(stage_dict['step_num_text'].text)
     num_images = int(__GUI_DICT['num_images_text'].text)
@@ -659,40 +950,117 @@ def __defocus_acquisition(_=None):
     directory = __GUI_DICT['directory_text'].text
     img_name = name_format.replace('{date}', str(datetime.date.today()))
 
-    if directory:
-        directory = directory + '\\'
-
-    img_main = directory + img_name.replace(' ', '_').replace('.', '_').replace(':', '')
+    img_main = os.path.join(directory,
+                            img_name.replace(' ', '_').replace('.', '_').replace(':', ''))
     img_name = img_main
-    print('Experiment start: ' + str(datetime.datetime.now()))
-    # initialize z position for defocus acquisition
-    rel_z = (num_z_step + 1) * __Z_STEP
-    stage.__go_z(-rel_z)
-    __Z_POS = __Z_POS - rel_z
-    __update_pos_z
-    time.sleep(5)
-    print('Relative z position %2.2f' % -rel_z)
-    for ii in range(num_images):
-        print('Defocus acquisition %05d' %ii + 'is started... ')
-        for jj in range(1, 2 * num_z_step + 2):
-            print('Time point %05d' % ii + '  Relative z position %2.2f  um' % (-rel_z + (jj + 1) *
-                                                                                __Z_STEP))
-            stage.__go_z(__Z_STEP)
-            __Z_POS = __Z_POS + __Z_STEP
-            __update_pos_z
-            data = __acquire_images()
-            __save_images(img_name, data, ii, jj)
-        print('Defocus acquisition %05d' %ii  + 'is finished')
-        stage.__go_z(-2*rel_z + __Z_STEP)
+
+    # Stack holds planes in time x z order
+    stack_name = None
+    if __OUTPUT_MODE == 'stack':
+        stack_name = img_name + '.tiff'
+        tiffwriter.open_stack(stack_name, (num_images, 2 * num_z_step + 1), 'TZYX')
+
+    # Triggered mode exposes exactly the frames that are averaged
+    if __TRIGGER_SOURCE is not None:
+        spincam.set_trigger(__TRIGGER_SOURCE)
+
+    try:
+        print('Experiment start: ' + str(datetime.datetime.now()))
+        # initialize z position for defocus acquisition
+        rel_z = (num_z_step + 1) * __Z_STEP
+        stage.__go_z(-rel_z)
+        print('Relative z position %2.2f' % -rel_z)
+        for ii in range(num_images):
+            print('Defocus acquisition %05d' %ii + 'is started... ')
+            scores = []
+            for jj in range(1, 2 * num_z_step + 2):
+                print('Time point %05d' % ii + '  Relative z position %2.2f  um' %
+                      (-rel_z + (jj + 1) * __Z_STEP))
+                move_dict = stage.__go_z(__Z_STEP)
+                print('Stage move %.3f s, settle %.3f s' % (move_dict['move_time'],
+                                                           move_dict['settle_time']))
+                # Frames exposed while the stage was moving are not used
+                spincam.mark_stale()
+                data = __acquire_images()
+                __save_images(img_name, data, ii, jj, stack_name)
+
+                # A stack needs every plane, so only files end the sweep early. Contrast has side
+                # lobes on either side of focus, so only a peak within a step of the centre ends
+                # it; a peak further down may be a side lobe of a focus higher up.
+                if __ADAPTIVE_Z:
+                    scores.append(autofocus.score(data))
+                    if stack_name is None and np.argmax(scores) >= num_z_step - 1 and \
+                            autofocus.passed_peak(scores):
+                        print('Focus score passed its peak, sweep stopped after %d planes' % jj)
+                        break
+            print('Defocus acquisition %05d' %ii  + 'is finished')
+
+            # Back to the first plane of the stack, which is centred on the best plane so far in
+            # adaptive mode
+            shift = 0
+            if __ADAPTIVE_Z:
+                shift = int(round(autofocus.peak(range(-num_z_step, jj - num_z_step), scores)))
+                print('Stack centre moved by %d step(s)' % shift)
+            stage.__go_z((shift - jj) * __Z_STEP)
+            time.sleep(time_int)    # pause for certain time
+
+        stage.__go_z(-rel_z + __Z_STEP)
         time.sleep(time_int)    # pause for certain time
-        __Z_POS = __Z_POS - 2*rel_z + __Z_STEP
-        __update_pos_z
+        __update_pos()
+    finally:
+        if __TRIGGER_SOURCE is not None:
+            spincam.disable_trigger()
+
+        # Planes acquired before an error are kept, and the name is free for the next run
+        if stack_name is not None:
+            tiffwriter.close_stack(stack_name)
+    tiffwriter.flush()
+
+def __tile_size():
+    # Returns (x, y) field of view in um; rows of the image run along the stage's x axis
+    roi = spincam.get_roi()
+    acq_mode = spincam.get_acq_mode()
+    return (roi['height'] * __acq_factor(acq_mode, 'vertical') * __PIXEL_SIZE,
+            roi['width'] * __acq_factor(acq_mode, 'horizontal') * __PIXEL_SIZE)
+
+
+def __save_tile(img_name, index, tile, image_dict):
+    # Mosaic tile callback; queues tile for writing while the stage moves to the next one
+    tiffwriter.submit(img_name + '_r%03d_c%03d.tiff' % tile, image_dict['data'], compress=0)
+
+
+def __mosaic_acquisition(_=None):
+    __ensure_stream()
+    stage_dict = __GUI_DICT['stage_dict']
+    num_to_avg = int(__GUI_DICT['avg_images_text'].text)
+    rows, cols = [int(num) for num in stage_dict['mosaic_text'].text.lower().split('x')]
+    overlap = float(stage_dict['overlap_text'].text)
+    img_name = __fix_name()
+
+    pitch = mosaic.grid_pitch(__tile_size(), overlap)
+    print('Mosaic of %d x %d tiles, pitch %.1f x %.1f um' % (rows, cols, pitch[0], pitch[1]))
+    print('Experiment start: ' + str(datetime.datetime.now()))
+
+    # Each tile is written while the stage moves to the next one; the stage returns to the start
+    stats = mosaic.acquire(mosaic.grid(rows, cols),
+                           pitch,
+                           num_to_avg,
+                           functools.partial(__save_tile, img_name),
+                           __MOSAIC_ORDER)
+    tiffwriter.flush()
+    print('Mosaic of %d tile(s) took %.1f s, %.1f s waiting for the stage over %.0f um' %
+          (stats['tiles'], stats['time'], stats['stage_wait'], stats['path_length']))
+
+
+def __autofocus(_=None):
+    # Moves focus stage to the best focus near the current z
+    __ensure_stream()
+
+    focus_dict = autofocus.find_focus()
+    __update_pos()
+    print('Focus at %+.2f um, %d frame(s) in %.2f s' % (focus_dict['z'], focus_dict['frames'],
+                                                        focus_dict['time']))
 
-    stage.__go_z(-rel_z + __Z_STEP)
-    time.sleep(time_int)    # pause for certain time
-    __Z_POS = __Z_POS - rel_z + __Z_STEP
-    __update_pos_z
-    __stop_stream()
 
 def __time_int_def(_=None):
     # sets the time interval between z-stack frames
@@ -754,30 +1122,34 @@ def __fix_name(_=None):
     # file name
     name_format = __GUI_DICT['name_format_text'].text
     directory = __GUI_DICT['directory_text'].text
-    if directory:
-        directory = directory + '\\'
     img_name = name_format.replace('{date}', str(datetime.date.today()))
-    img_main = directory + img_name.replace(' ', '_').replace('.', '_').replace(':', '')
+    img_main = os.path.join(directory,
+                            img_name.replace(' ', '_').replace('.', '_').replace(':', ''))
     return img_main
 
 def __acquire_no_z(_=None):
-    if (__STREAM):
-        __stop_stream()
-    time.sleep(10)
-    __start_stream()
-    time.sleep(5)
+    __ensure_stream()
     global __GUI_DICT
 
     num_to_avg = int(__GUI_DICT['avg_images_text'].text)
     img_name = __fix_name()
+    if len(spincam.get_cam_serials()) > 1:
+        # Synchronized frame set; one file per camera
+        image_dicts = spincam.get_frame_set(num_to_avg)
+        print('Starting save ' + img_name)
+        for cam_serial, image_dict in image_dicts.items():
+            __save_images(img_name + '_cam_' + cam_serial, image_dict['data'], 0, 0)
+        tiffwriter.flush()
+        print('Finished Acquiring ' + img_name)
+        return
+
     image_dict = spincam.get_image_and_avg(num_to_avg)
     print('Starting save ' + img_name)
     # Make sure images are complete
     if 'data' in image_dict:
-        data = image_dict['data'].astype(np.uint16)
-        __save_images(img_name, data, 0 ,0)
+        __save_images(img_name, image_dict['data'], 0 ,0)
+        tiffwriter.flush()
         print('Finished Acquiring ' + img_name)
-    __stop_stream()
 
 def __acquire_images(_=None):
     global __IMSHOW_DICT
@@ -800,11 +1172,14 @@ def __acquire_images(_=None):
     #if (time_btwn_frames != 0):
     #    num_to_avg = int(frmrate * time_btwn_frames)
 
-    image_dict = spincam.get_image_and_avg(num_to_avg)
+    if __TRIGGER_SOURCE == 'Software':
+        image_dict = spincam.get_triggered_image_and_avg(num_to_avg)
+    else:
+        image_dict = spincam.get_image_and_avg(num_to_avg)
 
     # Make sure images are complete
     if 'data' in image_dict:
-        return image_dict['data'].astype(np.uint16)
+        return image_dict['data']
         # Save image
         # print('Acquired: ' + img_name)
         # ski.imsave(img_name, image_dict['data'].astype(np.uint16), compress=0, append=True)
@@ -826,60 +1201,78 @@ def __acquire_images(_=None):
 #    print('%s click: button=%d, x=%d, y=%d, xdata=%f, ydata=%f' %
 #          ('double' if event.dblclick else 'single', event.button,
 #           event.x, event.y, event.xdata, event.ydata))
-def __save_images(file_name, data, time, z):
+def __save_images(file_name, data, time, z, stack_name=None):
+    # Queues plane for writing, either as its own file or as the next plane of an open stack
+    if stack_name is not None:
+        tiffwriter.submit_plane(stack_name, data.astype(np.uint16, copy=False))
+        return
     file_name = file_name + '_time_%06d' % time + '_z_%03d' % z + '.tiff'
-    ski.imsave(file_name, data.astype(np.uint16), compress=0)
+    tiffwriter.submit(file_name, data.astype(np.uint16, copy=False), compress=0)
+
+
+def __save_color_plane(img_name_array, stack_name, lednumber, index, color, image_dict):
+    # Multicolor plane callback; queues plane for writing while the next colour is exposed
+    if stack_name is not None:
+        tiffwriter.submit_plane(stack_name, image_dict['data'])
+        return
+
+    # A new set of files is started every 10 time points
+    file_number = index // (10 * lednumber) + 1
+    img_name = img_name_array[index % lednumber] + str(file_number) + '.tiff'
+    tiffwriter.submit(img_name, image_dict['data'], compress=0, append=True)
 
 
 def __save_fourcolor(save_type):
     global __IMSHOW_DICT
     global __HIST_DICT
-    if not __STREAM:
-        raise RuntimeError('Stream has not been started yet! Please start it first.')
+    __ensure_stream()
 
     # set LED number	and array
-    lednumber = 4
-    color = ['r', 'y', 'g', 'b']
+    color = multicolor.colors()
+    lednumber = len(color)
 
     # Get name format, counter, and number of images
     name_format = __GUI_DICT['name_format_text'].text
-    counter = int(__GUI_DICT['counter_text'].text)
     num_images = int(__GUI_DICT['num_images_text'].text)
     num_to_avg = int(__GUI_DICT['avg_images_text'].text)
-    #time_btwn_frames = int(__GUI_DICT['time_images_text'].text)
-    frmrate = int(spincam.get_frame_rate())
     directory = __GUI_DICT['directory_text'].text
-    counter = 0
-    file_number = 1
-
-    #if (time_btwn_frames != 0):
-    #    num_to_avg = int(frmrate * time_btwn_frames)
 
     img_name = name_format.replace('{date}', str(datetime.date.today()))
 
-    if directory:
-        directory = directory + '\\'
+    img_main = os.path.join(directory,
+                            img_name.replace(' ', '_').replace('.', '_').replace(':', ''))
 
-    img_main = directory + img_name.replace(' ', '_').replace('.', '_').replace(':', '')
+    img_name_array = [img_main + "_" + led_color + "_" for led_color in color]
 
-    img_name_array = [img_main + "_" + color[0] + "_", img_main + "_" + color[1] + "_",
-                      img_main + "_" + color[2] + "_", img_main + "_" + color[3] + "_"]
-    print('Experiment start: ' + str(datetime.datetime.now()))
+    # Stack holds images in time x color order
+    stack_name = None
+    if __OUTPUT_MODE == 'stack':
+        stack_name = img_main + '.tiff'
+        num_time = (num_images + lednumber - 1) // lednumber
+        tiffwriter.open_stack(stack_name, (num_time, lednumber), 'TCYX')
 
-    for i in range(num_images):
-        ledserial.send(color[i % lednumber])
-        img_name = img_name_array[i % lednumber] + str(file_number) + '.tiff'
-        image_dict = spincam.get_image_and_avg(num_to_avg)
+    print('Experiment start: ' + str(datetime.datetime.now()))
 
-        # Make sure images are complete
-        if 'data' in image_dict:
-            # Save image
-            # print('Acquired: ' + img_name)
-            ski.imsave(img_name, image_dict['data'].astype(np.uint16), compress=0, append=True)
-            counter = counter + 1
-            if (counter / lednumber == 10):
-                file_number = file_number + 1
-                counter = 0
+    # Each plane is written while the next colour is exposed
+    callback = functools.partial(__save_color_plane, img_name_array, stack_name, lednumber)
+    try:
+        if __LED_MODE == 'trigger':
+            # Controller triggers every frame and switches colours between frames on its own
+            stats = multicolor.acquire_sequence(num_images, num_to_avg, callback, color)
+            print('LED sequence of %d plane(s) run by the controller' % stats['planes'])
+        else:
+            # LED switches are confirmed and frames straddling them are discarded
+            stats = multicolor.acquire(num_images, num_to_avg, callback, color)
+            print('Discarded %d frame(s) exposed during LED switches; switch round trip %.1f ms' %
+                  (stats['discarded'], stats['switch_time'] * 1e3))
+    finally:
+        # Planes acquired before an error are kept, and the name is free for the next run
+        if stack_name is not None:
+            tiffwriter.close_stack(stack_name)
+
+    if stack_name is not None:
+        img_name = stack_name
+    tiffwriter.flush()
     print('Finished Acquiring ' + img_name)
 
 def __stage_gui(fig2):
@@ -973,8 +1366,7 @@ def __stage_gui(fig2):
     x_pos_but_axes = fig2.add_axes(x_pos_but_pos)
     x_pos_but = TextBox(x_pos_but_axes, 'current x pos.')
     x_pos_but.label.set_fontsize(7)
-    x_pos_but.set_val(1)
-    x_pos_but.on_submit(__update_pos_x)
+    x_pos_but.on_submit(functools.partial(__go_to_pos, 'x'))
 
     # current position
     y_pos_but_pos = [up_button_pos1[0] + 6 * padding,
@@ -984,8 +1376,7 @@ def __stage_gui(fig2):
     y_pos_but_axes = fig2.add_axes(y_pos_but_pos)
     y_pos_but = TextBox(y_pos_but_axes, 'current y pos.')
     y_pos_but.label.set_fontsize(7)
-    y_pos_but.set_val(1)
-    y_pos_but.on_submit(__update_pos_y)
+    y_pos_but.on_submit(functools.partial(__go_to_pos, 'y'))
 
     # Set x-y step size
     xy_step_text_pos1 = [up_button_pos1[0] + 6 * padding,
@@ -1053,8 +1444,7 @@ def __stage_gui(fig2):
     z_pos_but_axes = fig2.add_axes(z_pos_but_pos)
     z_pos_but = TextBox(z_pos_but_axes, 'current z pos.')
     z_pos_but.label.set_fontsize(7)
-    z_pos_but.set_val(1)
-    z_pos_but.on_submit(__update_pos_z)
+    z_pos_but.on_submit(functools.partial(__go_to_pos, 'z'))
 
     # Set z step size
     z_step_text_pos1 = [z_pos_but_pos[0],
@@ -1167,6 +1557,70 @@ def __stage_gui(fig2):
     off_but.label.set_fontsize(7)
     off_but.on_clicked(__ledc)
 
+    # Mosaic
+    mosaic_text_pos = [pos[0] + 3 * padding + 0.12,
+                       red_but_pos[1] - 2 * padding - options_height * 2,
+                       0.1 - 2 * padding,
+                       options_height * 2]
+    mosaic_text_axes = fig2.add_axes(mosaic_text_pos)
+    mosaic_text = TextBox(mosaic_text_axes, 'mosaic tiles (rows x cols)')
+    mosaic_text.label.set_fontsize(7)
+    mosaic_text.set_val('3x3')
+
+    overlap_text_pos = [mosaic_text_pos[0] + 0.2,
+                        mosaic_text_pos[1],
+                        0.1 - 2 * padding,
+                        options_height * 2]
+    overlap_text_axes = fig2.add_axes(overlap_text_pos)
+    overlap_text = TextBox(overlap_text_axes, 'tile overlap')
+    overlap_text.label.set_fontsize(7)
+    overlap_text.set_val(__MOSAIC_OVERLAP)
+
+    mosaic_but_pos = [pos[0] + 3 * padding,
+                      mosaic_text_pos[1] - 2 * padding - options_height * 2,
+                      0.55,
+                      options_height * 2]
+    mosaic_but_axes = fig2.add_axes(mosaic_but_pos)
+    mosaic_but = Button(mosaic_but_axes, 'Start mosaic acquisition')
+    mosaic_but.label.set_fontsize(7)
+    mosaic_but.on_clicked(__mosaic_acquisition)
+
+    autofocus_but_pos = [pos[0] + 3 * padding,
+                         mosaic_but_pos[1] - 2 * padding - options_height * 2,
+                         0.55,
+                         options_height * 2]
+    autofocus_but_axes = fig2.add_axes(autofocus_but_pos)
+    autofocus_but = Button(autofocus_but_axes, 'Autofocus')
+    autofocus_but.label.set_fontsize(7)
+    autofocus_but.on_clicked(__autofocus)
+
+    # Bookmarks - named absolute positions, kept across sessions
+    bookmark_text_pos = [pos[0] + 3 * padding + 0.12,
+                         autofocus_but_pos[1] - 2 * padding - options_height * 2,
+                         0.1 - 2 * padding,
+                         options_height * 2]
+    bookmark_text_axes = fig2.add_axes(bookmark_text_pos)
+    bookmark_text = TextBox(bookmark_text_axes, 'bookmark')
+    bookmark_text.label.set_fontsize(7)
+
+    bookmark_save_but_pos = [pos[0] + 3 * padding + 0.24,
+                             bookmark_text_pos[1],
+                             0.15,
+                             options_height * 2]
+    bookmark_save_but_axes = fig2.add_axes(bookmark_save_but_pos)
+    bookmark_save_but = Button(bookmark_save_but_axes, 'Save bookmark')
+    bookmark_save_but.label.set_fontsize(7)
+    bookmark_save_but.on_clicked(__save_bookmark)
+
+    bookmark_go_but_pos = [pos[0] + 3 * padding + 0.40,
+                           bookmark_text_pos[1],
+                           0.15,
+                           options_height * 2]
+    bookmark_go_but_axes = fig2.add_axes(bookmark_go_but_pos)
+    bookmark_go_but = Button(bookmark_go_but_axes, 'Go to bookmark')
+    bookmark_go_but.label.set_fontsize(7)
+    bookmark_go_but.on_clicked(__go_to_bookmark)
+
     return {'fig2': fig2,
 			'up_button1': up_button1,
             'down_button1': down_button1,
@@ -1195,9 +1649,31 @@ def __stage_gui(fig2):
             'yellow_but': yellow_but,
             'green_but': green_but,
             'blue_but': blue_but,
-            'off_but':off_but}
+            'off_but':off_but,
+            'mosaic_text': mosaic_text,
+            'overlap_text': overlap_text,
+            'mosaic_but': mosaic_but,
+            'autofocus_but': autofocus_but,
+            'bookmark_text': bookmark_text,
+            'bookmark_save_but': bookmark_save_but,
+            'bookmark_go_but': bookmark_go_but}
+
+def __import_gui():
+    # Imports matplotlib and its widgets on first use
+    global plt
+    global TextBox, Button, Slider, RectangleSelector, RadioButtons
+
+    if plt is None:
+        import matplotlib.pyplot as plt
+        from matplotlib.widgets import TextBox
+        from matplotlib.widgets import Button
+        from matplotlib.widgets import Slider
+        from matplotlib.widgets import RectangleSelector
+        from matplotlib.widgets import RadioButtons
+
 
 def __spincam_gui():
+    __import_gui()
 
     # Get figure
     fig = plt.figure(1)
@@ -1213,6 +1689,9 @@ def __spincam_gui():
 
     # cid = fig.canvas.mpl_connect('button_press_event', onclick)
 
+    # Live view is blitted; full redraws only happen when the figure changes
+    fig.canvas.mpl_connect('draw_event', __on_draw)
+
     # Display Camera Image
     display_pos = [0,
                    cam_plot_height_offset,
@@ -1226,11 +1705,11 @@ def __spincam_gui():
     # Set initial values
     # Set callbacks
     display_dict['find_and_init_button'].on_clicked(__test)
-    ''' 
-    # Start stream
+
+    # Start stream; the live view shows binned preview frames of the running stream
     start_stream_button_pos = [padding,
                                display_pos[1] - options_height,
-                               0.5 - 2 * padding,
+                               1 / 3 - 2 * padding,
                                options_height]
     start_stream_button_axes = fig.add_axes(start_stream_button_pos)
     start_stream_button = Button(start_stream_button_axes, 'Start Stream')
@@ -1242,7 +1721,7 @@ def __spincam_gui():
     # Stop stream
     stop_stream_button_pos = [start_stream_button_pos[0] + start_stream_button_pos[2] + 2 * padding,
                               display_pos[1] - options_height,
-                              0.5 - 2 * padding,
+                              1 / 3 - 2 * padding,
                               options_height]
     stop_stream_button_axes = fig.add_axes(stop_stream_button_pos)
     stop_stream_button = Button(stop_stream_button_axes, 'Stop Stream')
@@ -1250,29 +1729,77 @@ def __spincam_gui():
 
     # Set callback
     stop_stream_button.on_clicked(__stop_stream)
-    '''
-    start_stream_button_pos = [padding,
-                               display_pos[1] - options_height,
-                               0.5 - 2 * padding,
-                               options_height]
-    start_stream_button_axes = fig.add_axes(start_stream_button_pos)
-    start_stream_button = Button(start_stream_button_axes, 'Open Preview')
-    start_stream_button.label.set_fontsize(7)
-
-    # Set callback
-    start_stream_button.on_clicked(__open_preview)
 
-    # Stop stream
-    stop_stream_button_pos = [start_stream_button_pos[0] + start_stream_button_pos[2] + 2 * padding,
-                              display_pos[1] - options_height,
-                              0.5 - 2 * padding,
-                              options_height]
-    stop_stream_button_axes = fig.add_axes(stop_stream_button_pos)
-    stop_stream_button = Button(stop_stream_button_axes, 'Plot Histogram')
-    stop_stream_button.label.set_fontsize(7)
+    # Histogram
+    hist_button_pos = [stop_stream_button_pos[0] + stop_stream_button_pos[2] + 2 * padding,
+                       display_pos[1] - options_height,
+                       1 / 3 - 2 * padding,
+                       options_height]
+    hist_button_axes = fig.add_axes(hist_button_pos)
+    hist_button = Button(hist_button_axes, 'Plot Histogram')
+    hist_button.label.set_fontsize(7)
 
     # Set callback
-    stop_stream_button.on_clicked(__plot_hist)
+    hist_button.on_clicked(__plot_hist)
+
+    # ROI
+    roi_text_pos = [cam_plot_width + 4 * padding,
+                    1 - options_height - 2 * padding,
+                    1 - cam_plot_width - 5 * padding,
+                    options_height]
+    roi_text_axes = fig.add_axes(roi_text_pos)
+    roi_text = TextBox(roi_text_axes, 'ROI')
+    roi_text.label.set_fontsize(7)
+    roi_text.on_submit(__roi_text)
+
+    select_roi_button_pos = [cam_plot_width + padding,
+                             roi_text_pos[1] - options_height - padding,
+                             (1 - cam_plot_width - 3 * padding) * 0.5,
+                             options_height]
+    select_roi_button_axes = fig.add_axes(select_roi_button_pos)
+    select_roi_button = Button(select_roi_button_axes, 'Select ROI')
+    select_roi_button.label.set_fontsize(7)
+    select_roi_button.on_clicked(__select_roi)
+
+    full_frame_button_pos = [select_roi_button_pos[0] + select_roi_button_pos[2] + padding,
+                             select_roi_button_pos[1],
+                             select_roi_button_pos[2],
+                             options_height]
+    full_frame_button_axes = fig.add_axes(full_frame_button_pos)
+    full_frame_button = Button(full_frame_button_axes, 'Full Frame')
+    full_frame_button.label.set_fontsize(7)
+    full_frame_button.on_clicked(__full_frame)
+
+    # Acquisition mode - binning and decimation presets
+    acq_modes = spincam.acq_modes()
+    acq_mode_radio_height = len(acq_modes) * options_height
+    acq_mode_radio_pos = [cam_plot_width + padding,
+                          select_roi_button_pos[1] - acq_mode_radio_height - padding,
+                          1 - cam_plot_width - 2 * padding,
+                          acq_mode_radio_height]
+    acq_mode_radio_axes = fig.add_axes(acq_mode_radio_pos)
+    acq_mode_radio = RadioButtons(acq_mode_radio_axes, acq_modes)
+    for label in acq_mode_radio.labels:
+        label.set_fontsize(7)
+    acq_mode_radio.on_clicked(__set_acq_mode)
+
+    # Modes of the acquisitions, stacked below the acquisition mode; each radio has a title row
+    mode_radios = []
+    mode_radio_pos = acq_mode_radio_pos
+    for title, options, active, callback in (
+            ('Output', __OUTPUT_MODES, __OUTPUT_MODES.index(__OUTPUT_MODE), __set_output_mode),
+            ('Defocus trigger', __TRIGGER_LABELS,
+             __TRIGGER_LABELS.index(__TRIGGER_SOURCE or 'free run'), __set_trigger_source),
+            ('LED mode', __LED_MODES, __LED_MODES.index(__LED_MODE), __set_led_mode),
+            ('Defocus z-stack', ('fixed', 'adaptive'), int(__ADAPTIVE_Z), __set_adaptive_z)):
+        height = len(options) * options_height
+        mode_radio_pos = [mode_radio_pos[0],
+                          mode_radio_pos[1] - height - options_height - 2 * padding,
+                          mode_radio_pos[2],
+                          height]
+        mode_radios.append(__radio_with_title(fig, mode_radio_pos, title, options, active,
+                                              callback))
+    output_radio, trigger_radio, led_mode_radio, adaptive_z_radio = mode_radios
 
     # fps
     fps_pos = [0, start_stream_button_pos[1] - options_height - padding, 1, options_height]
@@ -1386,6 +1913,7 @@ def __spincam_gui():
             'stage_dict': stage_dict,
             'start_stream_button': start_stream_button,
             'stop_stream_button': stop_stream_button,
+            'hist_button': hist_button,
             'save_button': save_button,
             'name_format_text': name_format_text,
             'counter_text': counter_text,
@@ -1396,35 +1924,47 @@ def __spincam_gui():
             'exposure_slider': exposure_slider,
             'exposure_text': exposure_text,
             'directory_text': directory_text,
-            'directory_button': directory_button}
+            'directory_button': directory_button,
+            'roi_text': roi_text,
+            'select_roi_button': select_roi_button,
+            'full_frame_button': full_frame_button,
+            'acq_mode_radio': acq_mode_radio,
+            'output_radio': output_radio,
+            'trigger_radio': trigger_radio,
+            'led_mode_radio': led_mode_radio,
+            'adaptive_z_radio': adaptive_z_radio}
 
 
 def __stream_images():
+    # Shows the latest preview frame, if there is a new one. Preview frames are binned copies made
+    # by spincam's preview thread, so the live view never takes frames away from acquisitions.
     global __IMSHOW_DICT
-    global __HIST_DICT
+    global __PREVIEW_SEQ
 
     try:
-        # Get image dicts - Must acquire primary image first in case there is a hardware trigger!
-        image_dict = spincam.get_image()
-
-        # Make sure images are complete
-        """if 'data' in image_dict:
-             Plot image and histogram
-            __IMSHOW_DICT, __HIST_DICT = __plot_image_and_hist(image_dict['data'],
-                                                               2 ** image_dict['bitsperpixel'] - 1,
-                                                               __GUI_DICT['display_dict'][
-                                                                   'image_axes'],
-                                                               __IMSHOW_DICT,
-                                                               __GUI_DICT['display_dict'][
-                                                                   'hist_axes'],
-                                                               __HIST_DICT)
-"""
+        image_dict = spincam.get_preview(__PREVIEW_SEQ)
+        if image_dict is not None:
+            __PREVIEW_SEQ = image_dict['seq']
+            __ROI_DICT['bin'] = image_dict['bin']
+            __IMSHOW_DICT = __plot_image(image_dict['data'],
+                                         2 ** image_dict['bitsperpixel'] - 1,
+                                         __GUI_DICT['display_dict']['image_axes'],
+                                         __IMSHOW_DICT)
+        if __update_hist() or image_dict is not None:
+            __render()
     except:  # pylint: disable=bare-except
         if __STREAM:
             # Only re-raise error if stream is still enabled
             raise
 
 
+def __confirm_homing():
+    # Homing drives z through its range, so the objective must be unmounted first; only asked if
+    # an axis actually needs homing
+    while(stage.__check_objective() == False):
+        print("------ Please unmount the objective ------ ")
+
+
 def main():
     #global __QUEUE
     global __STREAM
@@ -1432,32 +1972,49 @@ def main():
     global __HIST_DICT, __HIST_SECONDARY_DICT
     global __GUI_DICT
 
-    # check microscope objective
-    while(stage.__check_objective() == False):
-        print("------ Please unmount the objective ------ ")
-
-    # initialize stages
-    stage.__initialize_stages()
+    # initialize stages; homing all axes concurrently, skipped if already referenced
+    stage.__initialize_stages(confirm=__confirm_homing)
+    last = positions.get_last_position()
+    if last is not None:
+        print('Last position of the previous session: x %.2f, y %.2f, z %.2f um' % last)
 
     # Set GUI
+    tic = time.perf_counter()
     __GUI_DICT = __spincam_gui()
+    __STARTUP['gui'] = time.perf_counter() - tic
+
+    # Start background TIFF writer
+    tiffwriter.start(__WRITER_DEPTH, __WRITER_THREADS)
 
-    # initialize the camera
+    # initialize the camera and start the live view
     __find_and_init_cam()
+    __start_stream()
+    print('Startup: imports %.3f s, GUI %.3f s, Spinnaker system %.3f s' %
+          (__STARTUP['import'], __STARTUP['gui'], spincam.get_system_init_time() or 0.0))
+
+    # Show figures without blocking; the loop below runs the GUI event loop
+    plt.show(block=False)
+
     # Update plot while figure exists
     while plt.fignum_exists(__GUI_DICT['fig'].number):  # pylint: disable=unsubscriptable-object
         try:
+            tic = time.perf_counter()
+
             # Handle streams
-            #if __STREAM:
-            #    __stream_images()
+            if __STREAM:
+                __stream_images()
+
+            # Position readouts follow the encoders, at most once per poll interval
+            __update_pos(None, False)
 
             # Handle queue
             #while not __QUEUE.empty():
             #    func, args, kwargs = __QUEUE.get()
             #    func(*args, **kwargs)
 
-            # Update plot
-            plt.pause(sys.float_info.min)
+            # Handle GUI events until the next refresh instead of spinning
+            wait = 1.0 / __REFRESH_RATE - (time.perf_counter() - tic)
+            __GUI_DICT['fig'].canvas.start_event_loop(max(wait, 0.001))
         except:  # pylint: disable=bare-except
             if plt.fignum_exists(__GUI_DICT['fig'].number):
                 # Only re-raise error if figure is still open
@@ -1465,11 +2022,14 @@ def main():
 
     # Clean up
     #__QUEUE = queue.Queue()
+    __stop_stream()
     __STREAM = False
-    __IMSHOW_DICT = {'imshow': None, 'imshow_size': None}
-    __HIST_DICT = {'bar': None}
+    __IMSHOW_DICT = {'imshow': None, 'imshow_size': None, 'max_val': None}
+    __RENDER_DICT['background'] = None
+    __HIST_DICT = {'line': None, 'text': None, 'num_bins': None, 'seq': None}
     __GUI_DICT = None
     __STAGE_DICT = None
+    tiffwriter.stop()
     ledserial.send('c')
 
     print('Exiting...')
@@ -1477,5 +2037,7 @@ def main():
     return 0
 
 
+__STARTUP['import'] = time.perf_counter() - __IMPORT_TIC
+
 if __name__ == '__main__':
     sys.exit(main())
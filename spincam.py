@@ -1,15 +1,164 @@
 import os
+import time
 import atexit
+import functools
+import threading
 from warnings import warn
 from contextlib import suppress
 from datetime import datetime
-import PySpin
 import numpy as np
+import backend
+if backend.is_sim('cam'):
+    import simspin as PySpin
+else:
+    # Without the Spinnaker SDK spincam still imports, so presets and protocols can be checked;
+    # the first camera access raises
+    try:
+        import PySpin
+    except ImportError as ex:
+        PySpin = None
+        __PYSPIN_ERROR = ex
+import frameproc
 
-__SYSTEM = PySpin.System.GetInstance()
+# Spinnaker system; created on first use so importing spincam doesn't enumerate interfaces
+__SYSTEM = None
+__SYSTEM_INIT_TIME = None
 
 __CAM = None
 
+# Open cameras, keyed by serial, each {'cam', 'capture'}. Single camera functions act on the
+# selected camera (__CAM and its __CAPTURE); every camera has its own capture engine, so all of them
+# can stream at the same time.
+__CAMS = {}
+
+# Capture engine - dedicated grab thread writing into a ring of preallocated buffers
+__NUM_BUFFERS = 16
+__GRAB_TIMEOUT_MS = 200
+__CAPTURE = {'thread': None, 'stop': None, 'ring': None}
+
+# Frame sets - seconds to wait for every camera to be ready for the next software trigger
+__FRAME_SET_TIMEOUT = 10.0
+
+# Live preview - a separate thread bins the newest ring frame every interval and keeps only the
+# latest result. It never pins ring slots, so the grab thread can't drop frames because of it.
+__PREVIEW_INTERVAL = 0.1  # seconds
+__PREVIEW_BIN = 4
+__PREVIEW = {'thread': None, 'stop': None, 'interval': __PREVIEW_INTERVAL, 'factor': __PREVIEW_BIN,
+             'frame': None, 'error': None, 'lock': threading.Lock()}
+
+# The preview thread also keeps a decaying histogram of the raw frames it samples
+__HIST_DECAY = 0.5
+__HIST_BINS = 256
+__HISTOGRAM = {'running': frameproc.new_running_histogram(__HIST_DECAY), 'seq': None,
+               'bitsperpixel': None}
+
+# Node registry - nodes are resolved once per camera, and min/max of numeric nodes are cached
+# until a node they depend on is written. Keyed by id() of the camera.
+__REGISTRY = {}
+__PYSPIN_ARGS = {}
+
+# Prints every node command; off by default since the sliders send a command per event
+__VERBOSE = False
+
+# Order apply_settings() writes nodes in. Geometry, pixel format and exposure bound the frame rate,
+# so they go first. Nodes not listed are written last, in the order given.
+__SETTINGS_ORDER = ('PixelFormat',
+                    'VideoMode',
+                    'BinningSelector',
+                    'BinningHorizontalMode',
+                    'BinningVerticalMode',
+                    'BinningHorizontal',
+                    'BinningVertical',
+                    'DecimationHorizontal',
+                    'DecimationVertical',
+                    'Width',
+                    'Height',
+                    'OffsetX',
+                    'OffsetY',
+                    'ExposureAuto',
+                    'GainAuto',
+                    'AcquisitionFrameRateAuto',
+                    'AcquisitionFrameRateEnabled',
+                    'ExposureTime',
+                    'AcquisitionFrameRate',
+                    'Gain',
+                    'Gamma')
+
+# Cached limits invalidated by writing a node; None invalidates all of them
+__LIMIT_DEPENDENTS = {'PixelFormat': None,
+                      'VideoMode': None,
+                      'BinningHorizontal': None,
+                      'BinningVertical': None,
+                      'DecimationHorizontal': None,
+                      'DecimationVertical': None,
+                      'Width': None,
+                      'Height': None,
+                      'OffsetX': None,
+                      'OffsetY': None,
+                      'AcquisitionFrameRateEnabled': ('AcquisitionFrameRate', 'ExposureTime'),
+                      'ExposureTime': ('AcquisitionFrameRate',),
+                      'AcquisitionFrameRate': ('ExposureTime',)}
+
+# Acquisition modes trading resolution for frame rate and data rate. Binning combines pixels,
+# either summing them (more signal per pixel) or averaging them (same brightness, less noise);
+# decimation skips pixels. 2x2 gives 4x less data; decimation and sensor binning also shorten the
+# readout, up to 4x the frame rate, while binning in the camera's ISP only saves bandwidth.
+__ACQ_MODES = {'full': {'BinningSelector': 'All',
+                        'BinningHorizontal': 1,
+                        'BinningVertical': 1,
+                        'DecimationHorizontal': 1,
+                        'DecimationVertical': 1},
+               'bin2_sum': {'BinningSelector': 'All',
+                            'BinningHorizontalMode': 'Sum',
+                            'BinningVerticalMode': 'Sum',
+                            'BinningHorizontal': 2,
+                            'BinningVertical': 2,
+                            'DecimationHorizontal': 1,
+                            'DecimationVertical': 1},
+               'bin2_avg': {'BinningSelector': 'All',
+                            'BinningHorizontalMode': 'Average',
+                            'BinningVerticalMode': 'Average',
+                            'BinningHorizontal': 2,
+                            'BinningVertical': 2,
+                            'DecimationHorizontal': 1,
+                            'DecimationVertical': 1},
+               'bin4_sum': {'BinningSelector': 'All',
+                            'BinningHorizontalMode': 'Sum',
+                            'BinningVerticalMode': 'Sum',
+                            'BinningHorizontal': 4,
+                            'BinningVertical': 4,
+                            'DecimationHorizontal': 1,
+                            'DecimationVertical': 1},
+               'bin2_sensor': {'BinningSelector': 'Sensor',
+                               'BinningHorizontalMode': 'Sum',
+                               'BinningVerticalMode': 'Sum',
+                               'BinningHorizontal': 2,
+                               'BinningVertical': 2,
+                               'DecimationHorizontal': 1,
+                               'DecimationVertical': 1},
+               'dec2': {'BinningSelector': 'All',
+                        'BinningHorizontal': 1,
+                        'BinningVertical': 1,
+                        'DecimationHorizontal': 2,
+                        'DecimationVertical': 2}}
+
+# Nodes read by get_acq_mode() as (returned name, node name, enumeration)
+__ACQ_MODE_NODES = (('binning_selector', 'BinningSelector', True),
+                    ('binning_horizontal', 'BinningHorizontal', False),
+                    ('binning_vertical', 'BinningVertical', False),
+                    ('binning_horizontal_mode', 'BinningHorizontalMode', True),
+                    ('binning_vertical_mode', 'BinningVerticalMode', True),
+                    ('decimation_horizontal', 'DecimationHorizontal', False),
+                    ('decimation_vertical', 'DecimationVertical', False),
+                    ('video_mode', 'VideoMode', True),
+                    ('pixel_format', 'PixelFormat', True))
+
+# Short names accepted by apply_settings()
+__SETTING_ALIASES = {'exposure': 'ExposureTime',
+                     'frame_rate': 'AcquisitionFrameRate',
+                     'gain': 'Gain',
+                     'gamma': 'Gamma'}
+
 
 def __destructor():
     print('Cleaning up SpinCam...')
@@ -17,83 +166,395 @@ def __destructor():
     # Cleanup
     __cleanup_cam()
 
-    if __SYSTEM.IsInUse():
+    if __SYSTEM is not None and __SYSTEM.IsInUse():
         print('System is still in use')
 
 
 atexit.register(__destructor)
 
 
+def __get_registry(cam):
+    # Returns node registry of cam
+
+    registry = __REGISTRY.get(id(cam))
+    if registry is None or registry['cam'] is not cam:
+        registry = {'cam': cam, 'nodes': {}, 'limits': {}}
+        __REGISTRY[id(cam)] = registry
+    return registry
+
+
+def __clear_registry(cam=None):
+    # Drops resolved nodes and cached limits of cam, or of every camera, e.g. after the camera was
+    # re-initialized
+
+    if cam is None:
+        __REGISTRY.clear()
+    else:
+        __REGISTRY.pop(id(cam), None)
+
+
+def __get_node(cam, cam_attr_str):
+    # Returns node at attribute path "cam_attr_str"; the path is only walked the first time
+
+    nodes = __get_registry(cam)['nodes']
+    node = nodes.get(cam_attr_str)
+    if node is None:
+        node = cam
+        for sub_cam_attr_str in cam_attr_str.split('.'):
+            node = getattr(node, sub_cam_attr_str)
+        nodes[cam_attr_str] = node
+    return node
+
+
+def __parse_arg(cam_method_arg):
+    # Formats command argument in case it's a string containing a PySpin attribute
+
+    if not isinstance(cam_method_arg, str):
+        return cam_method_arg
+
+    if cam_method_arg not in __PYSPIN_ARGS:
+        cam_method_arg_split = cam_method_arg.split('.')
+        if cam_method_arg_split[0] != 'PySpin':
+            return cam_method_arg
+        if len(cam_method_arg_split) != 2:
+            raise RuntimeError('Arguments containing nested PySpin arguments are currently not '
+                               'supported...')
+        __PYSPIN_ARGS[cam_method_arg] = getattr(PySpin, cam_method_arg_split[1])
+
+    return __PYSPIN_ARGS[cam_method_arg]
+
+
+def __get_limits(cam, cam_attr_str):
+    # Returns cached (min, max) of a numeric node, or None if the node has no limits
+
+    limits = __get_registry(cam)['limits']
+    if cam_attr_str not in limits:
+        node = __get_node(cam, cam_attr_str)
+        node_limits = None
+        if hasattr(node, 'GetMin') and hasattr(node, 'GetMax'):
+            node_limits = (node.GetMin(), node.GetMax())
+            if None in node_limits:
+                node_limits = None
+        limits[cam_attr_str] = node_limits
+
+    return limits[cam_attr_str]
+
+
+def __invalidate_limits(cam, cam_attr_str):
+    # Drops cached limits that depend on node "cam_attr_str" after it was written
+
+    if cam_attr_str not in __LIMIT_DEPENDENTS:
+        return
+
+    limits = __get_registry(cam)['limits']
+    dependents = __LIMIT_DEPENDENTS[cam_attr_str]
+    if dependents is None:
+        limits.clear()
+    else:
+        for dependent in dependents:
+            limits.pop(dependent, None)
+
+
+def __check_limits(cam, cam_attr_str, value, clamp):
+    # Returns value if it is within the cached limits of the node; out of range values are
+    # clamped if "clamp" is set, otherwise they raise
+
+    limits = __get_limits(cam, cam_attr_str)
+    if limits is None or limits[0] <= value <= limits[1]:
+        return value
+
+    if clamp:
+        return min(max(value, limits[0]), limits[1])
+
+    raise RuntimeError('Value ' + str(value) + ' is out of range for "' + cam_attr_str + '" [' +
+                       str(limits[0]) + ', ' + str(limits[1]) + '].')
+
+
+def __settings_changed(cam):
+    # Later reads only use frames taken with the new settings
+
+    capture = __get_capture(cam)
+    if capture is not None and capture['thread'] is not None:
+        __ring_mark_settings_changed(capture['ring'], __latch_timestamp(cam))
+
+
 def __cam_node_cmd(cam, cam_attr_str, cam_method_str, pyspin_mode_str=None, cam_method_arg=None):
     # Performs cam_method on input cam with optional access mode check
     # First, get camera attribute
-    cam_attr = cam
-    cam_attr_str_split = cam_attr_str.split('.')
-    for sub_cam_attr_str in cam_attr_str_split:
-        cam_attr = getattr(cam_attr, sub_cam_attr_str)
+    cam_attr = __get_node(cam, cam_attr_str)
 
     # Print command info
-    info_str = 'Executing: "' + '.'.join([cam_attr_str, cam_method_str]) + '('
-    if cam_method_arg is not None:
-        info_str += str(cam_method_arg)
-    print(info_str + ')"')
+    if __VERBOSE:
+        info_str = 'Executing: "' + '.'.join([cam_attr_str, cam_method_str]) + '('
+        if cam_method_arg is not None:
+            info_str += str(cam_method_arg)
+        print(info_str + ')"')
 
     # Perform optional access mode check
     if pyspin_mode_str is not None:
-        if cam_attr.GetAccessMode() != getattr(PySpin, pyspin_mode_str):
+        if cam_attr.GetAccessMode() != __parse_arg('PySpin.' + pyspin_mode_str):
             raise RuntimeError('Access mode check failed for: "' + cam_attr_str + '" with mode: "' +
                                pyspin_mode_str + '".')
 
-    # Format command argument in case it's a string containing a PySpin attribute
-    if isinstance(cam_method_arg, str):
-        cam_method_arg_split = cam_method_arg.split('.')
-        if cam_method_arg_split[0] == 'PySpin':
-            if len(cam_method_arg_split) == 2:
-                cam_method_arg = getattr(PySpin, cam_method_arg_split[1])
-            else:
-                raise RuntimeError('Arguments containing nested PySpin arguments are currently not '
-                                   'supported...')
+    cam_method_arg = __parse_arg(cam_method_arg)
 
     # Perform command
     if cam_method_arg is None:  # pylint: disable=no-else-return
         return getattr(cam_attr, cam_method_str)()
     else:
-        return getattr(cam_attr, cam_method_str)(cam_method_arg)
+        result = getattr(cam_attr, cam_method_str)(cam_method_arg)
+        if cam_method_str == 'SetValue':
+            __invalidate_limits(cam, cam_attr_str)
+        return result
+
+
+def __settings_rank(cam_attr_str):
+    # Position of node in write order; unlisted nodes go last
+
+    if cam_attr_str in __SETTINGS_ORDER:
+        return __SETTINGS_ORDER.index(cam_attr_str)
+    return len(__SETTINGS_ORDER)
+
+
+def __enum_entries(cam, cam_attr_str):
+    # Returns names of the available entries of enumeration node "cam_attr_str"
+
+    entries = []
+    for entry in __get_node(cam, cam_attr_str).GetEntries():
+        entry = PySpin.CEnumEntryPtr(entry)
+        if PySpin.IsAvailable(entry) and PySpin.IsReadable(entry):
+            entries.append(entry.GetSymbolic())
+    return entries
+
+
+def __is_readable(cam, cam_attr_str):
+    # Returns True if the camera has node "cam_attr_str" and it can be read
+
+    try:
+        node = __get_node(cam, cam_attr_str)
+    except AttributeError:
+        return False
+    return PySpin.IsAvailable(node) and PySpin.IsReadable(node)
+
+
+def __missing_nodes(cam, settings):
+    # Returns names of the nodes (or enumeration entries, as 'Node_Entry') of "settings" the camera
+    # doesn't have
+
+    missing = []
+    for name, value in settings.items():
+        if not __is_readable(cam, name):
+            missing.append(name)
+        elif isinstance(value, str) and hasattr(__get_node(cam, name), 'GetEntryByName'):
+            entry = __get_node(cam, name).GetEntryByName(value)
+            if not PySpin.IsAvailable(entry) or not PySpin.IsReadable(entry):
+                missing.append(name + '_' + value)
+    return missing
+
+
+def __enum_value(cam, cam_attr_str, entry_str):
+    # Returns integer value of entry "entry_str" of enumeration node "cam_attr_str"
+
+    entry = __get_node(cam, cam_attr_str).GetEntryByName(entry_str)
+    if not PySpin.IsAvailable(entry) or not PySpin.IsReadable(entry):
+        raise RuntimeError('Entry: "' + entry_str + '" is not available for "' + cam_attr_str +
+                           '". Options are: ' + str(tuple(__enum_entries(cam, cam_attr_str))))
+    return entry.GetValue()
+
+
+def __enum_symbolic(cam, cam_attr_str):
+    # Returns name of the current entry of enumeration node "cam_attr_str"
+
+    return __get_node(cam, cam_attr_str).GetCurrentEntry().GetSymbolic()
+
+
+def __apply_settings(cam, settings, clamp):
+    # Writes settings in dependency order and returns the values written, keyed by node name
+
+    tic = time.perf_counter()
+
+    # Enumeration entries may be given by name, e.g. {'PixelFormat': 'Mono8'}
+    values = {}
+    symbolic = set()
+    for name, value in settings.items():
+        name = __SETTING_ALIASES.get(name, name)
+        values[name] = __parse_arg(value)
+        if isinstance(values[name], str) and hasattr(__get_node(cam, name), 'GetEntryByName'):
+            values[name] = __enum_value(cam, name, values[name])
+            symbolic.add(name)
+    # sorted() is stable, so unlisted nodes keep the order they were given in
+    names = sorted(values, key=__settings_rank)
+
+    # Validate up front whatever the earlier writes of this batch can't change, so a bad value
+    # fails before anything is written; the rest is checked against refreshed limits before its
+    # write
+    deferred = set()
+    all_deferred = False
+    for name in names:
+        if all_deferred or name in deferred:
+            deferred.add(name)
+        else:
+            values[name] = __check_limits(cam, name, values[name], clamp)
+        dependents = __LIMIT_DEPENDENTS.get(name, ())
+        if dependents is None:
+            all_deferred = True
+        else:
+            deferred.update(dependents)
+
+    applied = {}
+    try:
+        for name in names:
+            if name in deferred:
+                values[name] = __check_limits(cam, name, values[name], clamp)
+            if name in symbolic:
+                __get_node(cam, name).SetIntValue(values[name])
+            else:
+                __get_node(cam, name).SetValue(values[name])
+            __invalidate_limits(cam, name)
+            applied[name] = values[name]
+    except Exception as ex:
+        raise RuntimeError('Applying settings failed at "' + name + '"; applied so far: ' +
+                           str(applied) + '. ' + str(ex)) from ex
+    finally:
+        if applied:
+            __settings_changed(cam)
+
+    if __VERBOSE:
+        print('Applied settings %s in %.1f ms' % (applied, (time.perf_counter() - tic) * 1e3))
+
+    return applied
 
 
 def __cleanup_cam():
-    # cleans up camera
+    # cleans up cameras
     global __CAM
+    global __CAPTURE
 
     # End acquisition and de-init
-    with suppress(Exception):
-        end_acquisition()
-    with suppress(Exception):
-        deinit()
+    __stop_preview()
+    for cam_dict in __CAMS.values():
+        __close_cam(cam_dict)
+    __CAMS.clear()
 
     # Clear camera reference
     __CAM = None
+    __CAPTURE = {'thread': None, 'stop': None, 'ring': None}
+    __clear_registry()
+
+
+def __close_cam(cam_dict):
+    # Stops capture engine, ends acquisition and de-inits camera
+
+    cam = cam_dict['cam']
+    __stop_capture(cam_dict['capture'])
+    with suppress(Exception):
+        if cam.IsStreaming():
+            cam.EndAcquisition()
+    with suppress(Exception):
+        if cam.IsInitialized():
+            cam.DeInit()
+
+
+def __get_serial(cam):
+    # Returns serial number of camera; readable before Init()
+
+    return cam.TLDevice.DeviceSerialNumber.GetValue()
+
+
+def __get_system():
+    # Returns Spinnaker system, creating it on first use
+    global __SYSTEM
+    global __SYSTEM_INIT_TIME
+
+    if __SYSTEM is None:
+        if PySpin is None:
+            raise RuntimeError('Spinnaker SDK is not installed: ' + str(__PYSPIN_ERROR))
+        tic = time.perf_counter()
+        __SYSTEM = PySpin.System.GetInstance()
+        __SYSTEM_INIT_TIME = time.perf_counter() - tic
+        print('Spinnaker system initialized in %.3f s' % __SYSTEM_INIT_TIME)
+
+    return __SYSTEM
+
+
+def __list_cams():
+    # Returns serials of connected cameras
+
+    cam_list = __get_system().GetCameras()
+    try:
+        return [__get_serial(cam) for cam in cam_list]
+    finally:
+        cam_list.Clear()
 
 
 def __find_cam(cam_serial):
-    # returns camera object
+    # returns camera object with serial "cam_serial"; an empty serial takes the first camera
 
     # Retrieve cameras from the system
-    cam_list = __SYSTEM.GetCameras()
+    cam_list = __get_system().GetCameras()
 
     # Find camera matching serial
     cam_found = None
+    serials = []
+    try:
+        for cam in cam_list:
+            serials.append(__get_serial(cam))
+            if serials[-1] == str(cam_serial).strip() or (not cam_serial and cam_found is None):
+                cam_found = cam
+    finally:
+        cam_list.Clear()
 
-    for i, cam in enumerate(cam_list):
-        cam_found = cam
     # Check to see if match was found
     if cam_found is None:
-        print('Could not find camera with serial: "' + str(cam_serial) + '".')
-        return False
+        raise RuntimeError('Could not find camera with serial: "' + str(cam_serial) + '". '
+                           'Connected cameras are: ' + str(tuple(serials)))
 
     return cam_found
 
 
+def __open_cam(cam):
+    # Adds camera to the open cameras and returns its entry
+
+    cam_serial = __get_serial(cam)
+    if cam_serial in __CAMS:
+        raise RuntimeError('Camera: "' + cam_serial + '" is already open.')
+
+    cam_dict = {'cam': cam, 'capture': {'thread': None, 'stop': None, 'ring': None}}
+    __CAMS[cam_serial] = cam_dict
+    return cam_dict
+
+
+def __get_cam_dict(cam_serial):
+    # Returns entry of open camera with serial "cam_serial"
+
+    if str(cam_serial) not in __CAMS:
+        raise RuntimeError('Camera: "' + str(cam_serial) + '" is not open. Open cameras are: ' +
+                           str(tuple(__CAMS)))
+    return __CAMS[str(cam_serial)]
+
+
+def __get_capture(cam):
+    # Returns capture engine of camera, or None if the camera isn't open
+
+    if cam is __CAM:
+        return __CAPTURE
+    for cam_dict in __CAMS.values():
+        if cam_dict['cam'] is cam:
+            return cam_dict['capture']
+    return None
+
+
+def __select_cam(cam, capture):
+    # Makes single camera functions act on cam; returns the previous (cam, capture)
+    global __CAM
+    global __CAPTURE
+
+    selected = (__CAM, __CAPTURE)
+    __CAM = cam
+    __CAPTURE = capture
+    return selected
+
+
 def __get_image(cam):
     # Gets image and info from camera
 
@@ -113,32 +574,28 @@ def __get_image(cam):
     return image_dict
 
 
-def __get_image_and_avg(cam, num_to_avg):
+def __get_image_and_avg(cam, num_to_avg, avg_mode):
     # Gets images and info from camera
+    image_dict = {}
+    averager = None
     try:
         for i in range(0, num_to_avg):
             # Get image object
             image = cam.GetNextImage()
 
-            # Initialize image dict
-            image_dict = {}
-            arr = 0
             # Ensure image is complete
             if not image.IsIncomplete():
                 # Get data/metadata
-                if i == 0:
-                    img_array = np.array(image.GetNDArray(), dtype=np.float)
-                    arr = img_array / num_to_avg
-                    print('Frame: ' + str(datetime.now()))
-                else:
-                    img_array = np.array(image.GetNDArray(), dtype=np.float)
-                    arr = arr + img_array / num_to_avg
-                    print('Frame: ' + str(datetime.now()))
+                data = image.GetNDArray()
+                if averager is None:
+                    averager = frameproc.get_averager(data.shape, num_to_avg, avg_mode)
+                frameproc.add_frame(averager, data)
+                image_dict['timestamp'] = image.GetTimeStamp()
+                image_dict['bitsperpixel'] = image.GetBitsPerPixel()
             image.Release()
-        image_dict['data'] = arr
-        image_dict['timestamp'] = image.GetTimeStamp()
-        print('Averaged Frame: ' + str(datetime.now()))
-        image_dict['bitsperpixel'] = image.GetBitsPerPixel()
+        if averager is not None:
+            image_dict['data'] = frameproc.get_result(averager)
+            print('Averaged Frame: ' + str(datetime.now()))
     except PySpin.SpinnakerException as ex:
         print('Error: %s' % ex)
         return False
@@ -146,6 +603,516 @@ def __get_image_and_avg(cam, num_to_avg):
     return image_dict
 
 
+def __ring_new(num_buffers, height, width):
+    # Returns ring of preallocated uint16 frame buffers; frames are addressed by sequence number
+    return {'buffers': np.empty((num_buffers, height, width), dtype=np.uint16),
+            'seq': np.full(num_buffers, -1, dtype=np.int64),
+            'timestamp': np.zeros(num_buffers, dtype=np.int64),
+            'bitsperpixel': 16,
+            'next_seq': 0,
+            'pinned': set(),
+            'overruns': 0,
+            'dropped': 0,
+            'incomplete': 0,
+            'last_frame_id': None,
+            'ready_seq': None,
+            'ready_timestamp': None,
+            'ready_min_seq': 0,
+            'error': None,
+            'cond': threading.Condition()}
+
+
+def __ring_put(ring, image):
+    # Copies a complete image into the next slot of the ring
+
+    num_buffers = ring['buffers'].shape[0]
+    with ring['cond']:
+        seq = ring['next_seq']
+        slot = seq % num_buffers
+        if slot in ring['pinned']:
+            # Consumer is still reading the oldest frame; drop incoming frame rather than stall
+            ring['dropped'] += 1
+            return False
+        ring['seq'][slot] = -1
+
+    # Copy outside of lock so consumers of other slots are never blocked
+    np.copyto(ring['buffers'][slot], image.GetNDArray(), casting='unsafe')
+
+    with ring['cond']:
+        timestamp = image.GetTimeStamp()
+        ring['seq'][slot] = seq
+        ring['timestamp'][slot] = timestamp
+        ring['bitsperpixel'] = image.GetBitsPerPixel()
+        ring['next_seq'] = seq + 1
+
+        # First frame exposed entirely after the last settings change
+        if ring['ready_seq'] is None:
+            if ring['ready_timestamp'] is not None:
+                if timestamp > ring['ready_timestamp']:
+                    ring['ready_seq'] = seq
+            elif seq >= ring['ready_min_seq']:
+                ring['ready_seq'] = seq
+
+        ring['cond'].notify_all()
+    return True
+
+
+def __ring_mark_settings_changed(ring, timestamp):
+    # Frames captured before the change are no longer valid. When the camera timestamp of the
+    # change is unknown, the frame in flight and the one being exposed are skipped.
+
+    with ring['cond']:
+        ring['ready_seq'] = None
+        ring['ready_timestamp'] = timestamp
+        ring['ready_min_seq'] = ring['next_seq'] + 2
+
+
+def __ring_wait_ready(ring, timeout):
+    # Waits for the first valid frame after a settings change and returns its sequence number
+
+    with ring['cond']:
+        if not ring['cond'].wait_for(lambda: ring['ready_seq'] is not None or
+                                     ring['error'] is not None, timeout):
+            raise RuntimeError('Timed out waiting for a frame with the new camera settings.')
+        if ring['error'] is not None:
+            raise RuntimeError('Grab thread failed: ' + str(ring['error']))
+        return ring['ready_seq']
+
+
+def __latch_timestamp(cam):
+    # Returns current camera time, or None if the camera can't latch its timestamp
+
+    try:
+        __get_node(cam, 'TimestampLatch').Execute()
+        return __get_node(cam, 'TimestampLatchValue').GetValue()
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+
+def __ring_acquire(ring, seq, timeout):
+    # Waits for frame "seq" and pins its slot; returns (slot, seq, overrun). If "seq" has
+    # already been overwritten, the oldest frame still available is returned instead and the
+    # number of lost frames is reported as the overrun.
+
+    num_buffers = ring['buffers'].shape[0]
+    with ring['cond']:
+        if not ring['cond'].wait_for(lambda: ring['next_seq'] > seq or ring['error'] is not None,
+                                     timeout):
+            raise RuntimeError('Timed out waiting for frame ' + str(seq) + '.')
+        if ring['error'] is not None:
+            raise RuntimeError('Grab thread failed: ' + str(ring['error']))
+
+        # Slot of next_seq - num_buffers may be mid-overwrite, so it is not considered available
+        oldest_seq = max(0, ring['next_seq'] - num_buffers + 1)
+        overrun = 0
+        if seq < oldest_seq:
+            overrun = oldest_seq - seq
+            ring['overruns'] += overrun
+            seq = oldest_seq
+
+        slot = seq % num_buffers
+        ring['pinned'].add(slot)
+    return slot, seq, overrun
+
+
+def __ring_release(ring, slot):
+    # Unpins slot so grab thread can reuse it
+
+    with ring['cond']:
+        ring['pinned'].discard(slot)
+
+
+def __grab_loop(cam, ring, stop):
+    # Grab thread; drains the camera as fast as it delivers frames
+
+    while not stop.is_set():
+        try:
+            image = cam.GetNextImage(__GRAB_TIMEOUT_MS)
+        except PySpin.SpinnakerException as ex:
+            # Timeouts are expected at low frame rates and while stopping; anything else (camera
+            # removed, stream failed) is handed to the readers instead of retried forever
+            if ex.errorcode == PySpin.SPINNAKER_ERR_TIMEOUT:
+                continue
+            with ring['cond']:
+                ring['error'] = ex
+                ring['cond'].notify_all()
+            return
+
+        try:
+            if image.IsIncomplete():
+                ring['incomplete'] += 1
+                continue
+
+            # Frames skipped by the driver show up as gaps in the frame ID
+            frame_id = image.GetFrameID()
+            if ring['last_frame_id'] is not None and frame_id > ring['last_frame_id'] + 1:
+                ring['dropped'] += frame_id - ring['last_frame_id'] - 1
+            ring['last_frame_id'] = frame_id
+
+            __ring_put(ring, image)
+        except Exception as ex:  # pylint: disable=broad-except
+            with ring['cond']:
+                ring['error'] = ex
+                ring['cond'].notify_all()
+            return
+        finally:
+            image.Release()
+
+
+def __start_capture(cam, num_buffers, capture):
+    # Starts grab thread for streaming camera
+
+    __stop_capture(capture)
+
+    ring = __ring_new(num_buffers, cam.Height.GetValue(), cam.Width.GetValue())
+    stop = threading.Event()
+    thread = threading.Thread(target=__grab_loop, args=(cam, ring, stop), name='spincam-grab',
+                              daemon=True)
+    capture['ring'] = ring
+    capture['stop'] = stop
+    capture['thread'] = thread
+    thread.start()
+
+
+def __stop_capture(capture):
+    # Stops grab thread; ring is kept so its statistics can still be read
+
+    if capture['thread'] is None:
+        return
+
+    capture['stop'].set()
+    capture['thread'].join()
+    capture['thread'] = None
+    capture['stop'] = None
+
+
+def __get_ring(capture):
+    # Returns ring of running capture engine
+
+    if capture['thread'] is None:
+        raise RuntimeError('Capture engine is not running. Please start_acquisition() first.')
+
+    return capture['ring']
+
+
+def __get_frame(ring, seq, timeout):
+    # Gets copy of frame "seq" from ring
+
+    slot, seq, overrun = __ring_acquire(ring, seq, timeout)
+    try:
+        image_dict = {'data': ring['buffers'][slot].copy(),
+                      'timestamp': int(ring['timestamp'][slot]),
+                      'bitsperpixel': ring['bitsperpixel'],
+                      'seq': seq}
+    finally:
+        __ring_release(ring, slot)
+
+    if overrun:
+        image_dict['overrun'] = overrun
+        warn('Capture ring overrun: ' + str(overrun) + ' frame(s) lost before frame ' + str(seq))
+
+    return image_dict
+
+
+def __get_ring_image_and_avg(ring, num_to_avg, avg_mode, timeout, trigger=None, done=None,
+                             seq=None):
+    # Averages the next "num_to_avg" frames from the ring; frames are summed straight out of the
+    # pinned ring slots, so no per-frame copies are made. If "trigger" is given, it is called
+    # once before each frame; every frame is then exposed after this call by construction. If
+    # "done" is given, it is called once the last frame is in, before the result is computed.
+    # If "seq" is given, averaging starts at that frame instead.
+
+    averager = frameproc.get_averager(ring['buffers'].shape[1:], num_to_avg, avg_mode)
+    if seq is None:
+        if trigger is None:
+            seq = max(ring['next_seq'], __ring_wait_ready(ring, timeout))
+        else:
+            seq = ring['next_seq']
+    overrun = 0
+    for _ in range(num_to_avg):
+        if trigger is not None:
+            trigger()
+        slot, seq, frame_overrun = __ring_acquire(ring, seq, timeout)
+        try:
+            frameproc.add_frame(averager, ring['buffers'][slot])
+            timestamp = int(ring['timestamp'][slot])
+        finally:
+            __ring_release(ring, slot)
+        overrun += frame_overrun
+        seq += 1
+
+    if done is not None:
+        done()
+
+    image_dict = {'data': frameproc.get_result(averager),
+                  'timestamp': timestamp,
+                  'bitsperpixel': ring['bitsperpixel'],
+                  'seq': seq - 1}
+    if overrun:
+        image_dict['overrun'] = overrun
+        warn('Capture ring overrun: ' + str(overrun) + ' frame(s) lost while averaging')
+
+    return image_dict
+
+
+def __software_triggered(cam):
+    # Returns True if camera exposes a frame per software trigger
+
+    return __get_node(cam, 'TriggerMode').GetValue() == PySpin.TriggerMode_On and \
+        __get_node(cam, 'TriggerSource').GetValue() == PySpin.TriggerSource_Software
+
+
+def __per_cam_worker(results, func, cam_serial, cam_dict, args):
+    # Stores result of func, or the exception it raised, under the camera serial
+
+    try:
+        results[cam_serial] = func(cam_serial, cam_dict, *args)
+    except Exception as ex:  # pylint: disable=broad-except
+        results[cam_serial] = ex
+
+
+def __run_per_cam(func, *args):
+    # Calls func(cam_serial, cam_dict, *args) for every open camera, each in its own thread, and
+    # returns the results keyed by serial. Errors are raised once all threads are done.
+
+    results = {}
+    threads = [threading.Thread(target=__per_cam_worker,
+                                args=(results, func, cam_serial, cam_dict, args),
+                                name='spincam-' + cam_serial,
+                                daemon=True)
+               for cam_serial, cam_dict in __CAMS.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # A camera that failed breaks the trigger barrier of the others, so report its error first
+    errors = [(cam_serial, result) for cam_serial, result in results.items()
+              if isinstance(result, Exception)]
+    errors.sort(key=lambda error: isinstance(error[1], threading.BrokenBarrierError))
+    if errors:
+        raise RuntimeError('Camera: "' + errors[0][0] + '" failed: ' + str(errors[0][1])) \
+            from errors[0][1]
+
+    return results
+
+
+def __frame_set_cam(cam_serial, cam_dict, num_to_avg, avg_mode, barrier):
+    # Averages frames of one camera of a frame set; software triggered cameras wait at the
+    # barrier before each frame, whose action triggers all of them at once
+
+    cam = cam_dict['cam']
+    ring = __get_ring(cam_dict['capture'])
+    trigger = None
+    if barrier is not None and __software_triggered(cam):
+        trigger = functools.partial(barrier.wait, __FRAME_SET_TIMEOUT)
+    try:
+        return __get_ring_image_and_avg(ring, num_to_avg, avg_mode, __frame_timeout(cam), trigger)
+    except Exception:
+        if barrier is not None:
+            barrier.abort()
+        raise
+
+
+def __frame_set(num_to_avg, avg_mode):
+    # Averages "num_to_avg" frames of every open camera in parallel. Software triggered cameras
+    # are triggered together, once per frame; free running and hardware triggered cameras use the
+    # frames exposed after this call.
+
+    triggered = []
+    for cam_serial, cam_dict in __CAMS.items():
+        cam = cam_dict['cam']
+        __validate_cam_streaming(cam, cam_serial)
+        ring = __get_ring(cam_dict['capture'])
+        if __software_triggered(cam):
+            triggered.append(cam)
+        else:
+            __ring_mark_settings_changed(ring, __latch_timestamp(cam))
+
+    barrier = None
+    if triggered:
+        barrier = threading.Barrier(len(triggered),
+                                    action=functools.partial(__software_triggers, triggered))
+
+    return __run_per_cam(__frame_set_cam, num_to_avg, avg_mode, barrier)
+
+
+def __software_triggers(cams):
+    # Fires software trigger of every camera, back to back
+
+    for cam in cams:
+        __software_trigger(cam)
+
+
+def __stream_cam(cam_serial, cam_dict, num_frames, callback):
+    # Hands the next "num_frames" frames of one camera to callback(cam_serial, image_dict), in
+    # order; returns the number of frames and of frames lost to ring overruns
+
+    cam = cam_dict['cam']
+    ring = __get_ring(cam_dict['capture'])
+    timeout = __frame_timeout(cam)
+    seq = max(ring['next_seq'], __ring_wait_ready(ring, timeout))
+    overruns = 0
+    for _ in range(num_frames):
+        image_dict = __get_frame(ring, seq, timeout)
+        overruns += image_dict.get('overrun', 0)
+        callback(cam_serial, image_dict)
+        seq = image_dict['seq'] + 1
+
+    return {'frames': num_frames, 'overruns': overruns}
+
+
+def __preview_frame(ring, factor, last_seq):
+    # Bins newest frame of ring if it is newer than "last_seq". Returns None if there is no new
+    # frame or the grab thread reused its slot while it was being binned.
+
+    num_buffers = ring['buffers'].shape[0]
+    with ring['cond']:
+        seq = ring['next_seq'] - 1
+        if seq <= last_seq:
+            return None
+        slot = seq % num_buffers
+        timestamp = int(ring['timestamp'][slot])
+        bitsperpixel = ring['bitsperpixel']
+
+    data = frameproc.bin_frame(ring['buffers'][slot], factor)
+    counts = frameproc.histogram(ring['buffers'][slot], bitsperpixel)
+
+    # The grab thread invalidates a slot before overwriting it, so an unchanged seq means the
+    # binned copy and histogram are consistent
+    with ring['cond']:
+        if ring['seq'][slot] != seq:
+            return None
+
+    return {'data': data,
+            'timestamp': timestamp,
+            'bitsperpixel': bitsperpixel,
+            'seq': seq,
+            'bin': factor,
+            'counts': counts}
+
+
+def __preview_loop(interval, factor, stop, capture):
+    # Preview thread; publishes a binned frame of the camera of "capture" every "interval" seconds,
+    # replacing the last one
+
+    ring = None
+    last_seq = -1
+    next_time = time.perf_counter()
+    while True:
+        next_time = max(next_time + interval, time.perf_counter())
+        if stop.wait(next_time - time.perf_counter()):
+            return
+
+        # Ring is replaced when acquisition restarts
+        if capture['thread'] is None:
+            continue
+        if capture['ring'] is not ring:
+            ring = capture['ring']
+            last_seq = -1
+
+        try:
+            image_dict = __preview_frame(ring, factor, last_seq)
+        except Exception as ex:  # pylint: disable=broad-except
+            with __PREVIEW['lock']:
+                __PREVIEW['error'] = ex
+            return
+
+        if image_dict is not None:
+            last_seq = image_dict['seq']
+            counts = image_dict.pop('counts')
+            with __PREVIEW['lock']:
+                __PREVIEW['frame'] = image_dict
+                frameproc.add_histogram(__HISTOGRAM['running'], counts)
+                __HISTOGRAM['seq'] = last_seq
+                __HISTOGRAM['bitsperpixel'] = image_dict['bitsperpixel']
+
+
+def __start_preview(interval, factor):
+    # Starts preview thread
+
+    __stop_preview()
+
+    stop = threading.Event()
+    thread = threading.Thread(target=__preview_loop, args=(interval, factor, stop, __CAPTURE),
+                              name='spincam-preview', daemon=True)
+    __PREVIEW['stop'] = stop
+    __PREVIEW['thread'] = thread
+    __PREVIEW['interval'] = interval
+    __PREVIEW['factor'] = factor
+    thread.start()
+
+
+def __stop_preview():
+    # Stops preview thread and drops the last preview frame
+
+    if __PREVIEW['thread'] is not None:
+        __PREVIEW['stop'].set()
+        __PREVIEW['thread'].join()
+        __PREVIEW['thread'] = None
+        __PREVIEW['stop'] = None
+
+    with __PREVIEW['lock']:
+        __PREVIEW['frame'] = None
+        __PREVIEW['error'] = None
+        __HISTOGRAM['running'] = frameproc.new_running_histogram(__HIST_DECAY)
+        __HISTOGRAM['seq'] = None
+
+
+def __get_preview(last_seq):
+    # Returns latest preview frame if it is newer than "last_seq", otherwise None
+
+    with __PREVIEW['lock']:
+        error = __PREVIEW['error']
+        image_dict = __PREVIEW['frame']
+
+    if error is not None:
+        raise RuntimeError('Preview thread failed: ' + str(error))
+    if image_dict is None or (last_seq is not None and image_dict['seq'] <= last_seq):
+        return None
+
+    return image_dict
+
+
+def __get_histogram(num_bins, last_seq):
+    # Returns running histogram rebinned to "num_bins" if it is newer than "last_seq", otherwise
+    # None
+
+    with __PREVIEW['lock']:
+        error = __PREVIEW['error']
+        seq = __HISTOGRAM['seq']
+        if seq is None or (last_seq is not None and seq <= last_seq):
+            hist = None
+        else:
+            hist = frameproc.rebin_histogram(__HISTOGRAM['running']['hist'], num_bins)
+            saturation = __HISTOGRAM['running']['saturation']
+            bitsperpixel = __HISTOGRAM['bitsperpixel']
+
+    if error is not None:
+        raise RuntimeError('Preview thread failed: ' + str(error))
+    if hist is None:
+        return None
+
+    return {'hist': hist,
+            'saturation': saturation,
+            'bitsperpixel': bitsperpixel,
+            'seq': seq}
+
+
+def __frame_timeout(cam):
+    # Seconds to wait for a frame; a few frame periods at the current frame rate
+
+    return max(1.0,
+               5.0 / __get_node(cam, 'AcquisitionFrameRate').GetValue(),
+               2.0 * __get_node(cam, 'ExposureTime').GetValue() * 1e-6)
+
+
+def __software_trigger(cam):
+    # Fires software trigger
+
+    cam.TriggerSoftware.Execute()
+
+
 def __init_cam(cam):
     # Init() camera
     cam.Init()
@@ -176,36 +1143,93 @@ def __validate_cam_streaming(cam, cam_str):
         raise RuntimeError(cam_str + ' cam is not streaming. Please start_acquisition() it.')
 
 
-def __roi():
-    return 0
+def __snap(value, node_min, node_max, inc):
+    # Rounds value to the nearest step of "inc" above node_min and clamps it to the node range
 
-def set_pixel_format():
-    global __CAM
-    # Sets pixel format of the camera
-    if __CAM.PixelFormat.GetAccessMode() != PySpin.RW:
-        print('Unable to set pixel format. Aborting...')
-        return False
+    value = node_min + int(round((value - node_min) / float(inc))) * inc
+    node_max -= (node_max - node_min) % inc
+    return max(node_min, min(node_max, value))
 
-    __CAM.PixelFormat.SetValue(PySpin.PixelFormat_Mono16)
-    print('Pixel format is set %s...' % __CAM.PixelFormat.GetCurrentEntry().GetSymbolic())
 
-def set_video_mode(mode):
-    global __CAM
+def __get_roi(cam):
+    # Returns current sensor ROI in pixels of the (binned) sensor
 
-    nodemap = __CAM.GetNodeMap()
-    node_video_mode = PySpin.CEnumerationPtr(nodemap.GetNode("VideoMode"))
-    if not PySpin.IsAvailable(node_video_mode) or not PySpin.IsWritable(node_video_mode):
-        print('Unable to set VideoMode. Aborting...')
-        return False
+    return {'offset_x': __get_node(cam, 'OffsetX').GetValue(),
+            'offset_y': __get_node(cam, 'OffsetY').GetValue(),
+            'width': __get_node(cam, 'Width').GetValue(),
+            'height': __get_node(cam, 'Height').GetValue(),
+            'max_width': __get_node(cam, 'WidthMax').GetValue(),
+            'max_height': __get_node(cam, 'HeightMax').GetValue()}
 
-    node_video_mode_7 = node_video_mode.GetEntryByName("Mode7")
-    if not PySpin.IsAvailable(node_video_mode_7) or not PySpin.IsReadable(node_video_mode_7):
-        print('Unable to set VideoMode to Mode7 (entry retrieval). Aborting...')
-        return False
 
-    video_mode_7 = node_video_mode_7.GetValue()
-    node_video_mode.SetIntValue(video_mode_7)
-    print('Video Mode set to Mode ' + mode)
+def __roi(cam, offset_x, offset_y, width, height):
+    # Sets sensor ROI; values are snapped to the node increments and clamped to the sensor.
+    # Acquisition must be stopped.
+
+    max_width = __get_node(cam, 'WidthMax').GetValue()
+    max_height = __get_node(cam, 'HeightMax').GetValue()
+    width_node = __get_node(cam, 'Width')
+    height_node = __get_node(cam, 'Height')
+
+    width = __snap(width, width_node.GetMin(), max_width, width_node.GetInc())
+    height = __snap(height, height_node.GetMin(), max_height, height_node.GetInc())
+    offset_x = __snap(offset_x, 0, max_width - width, __get_node(cam, 'OffsetX').GetInc())
+    offset_y = __snap(offset_y, 0, max_height - height, __get_node(cam, 'OffsetY').GetInc())
+
+    # Offsets go to 0 first; otherwise a region that doesn't fit next to the current offsets
+    # would be rejected. Geometry writes drop every cached limit, since fps depends on it.
+    __apply_settings(cam, {'OffsetX': 0, 'OffsetY': 0}, False)
+    __apply_settings(cam, {'Width': width,
+                           'Height': height,
+                           'OffsetX': offset_x,
+                           'OffsetY': offset_y}, False)
+
+    return __get_roi(cam)
+
+
+def __restart_after(func, *args):
+    # Calls func with the camera, stopping and restarting acquisition around it if streaming;
+    # the capture ring is reallocated for the new frame size
+
+    cam = __get_and_validate_init_cam()
+    streaming = __CAPTURE['thread'] is not None
+    if streaming:
+        num_buffers = __CAPTURE['ring']['buffers'].shape[0]
+        end_acquisition()
+
+    try:
+        return func(cam, *args)
+    finally:
+        if streaming:
+            start_acquisition(num_buffers)
+
+
+def __get_acq_mode(cam):
+    # Returns current binning, decimation, video mode and pixel format; None for nodes the camera
+    # doesn't have
+
+    acq_mode = {}
+    for key, cam_attr_str, enum in __ACQ_MODE_NODES:
+        if not __is_readable(cam, cam_attr_str):
+            acq_mode[key] = None
+        elif enum:
+            acq_mode[key] = __enum_symbolic(cam, cam_attr_str)
+        else:
+            acq_mode[key] = __get_node(cam, cam_attr_str).GetValue()
+    return acq_mode
+
+
+def __geometry(cam, settings):
+    # Applies settings that change the sensor geometry (binning, decimation, video mode, pixel
+    # format) and reads out the full, new sensor afterwards. Acquisition must be stopped.
+
+    # Offsets go to 0 first, so the smaller sensor of a coarser mode can't be exceeded
+    __apply_settings(cam, {'OffsetX': 0, 'OffsetY': 0}, False)
+    __apply_settings(cam, settings, False)
+    __roi(cam, 0, 0, __get_node(cam, 'WidthMax').GetValue(),
+          __get_node(cam, 'HeightMax').GetValue())
+
+    return __get_acq_mode(cam)
 
 
 def __get_and_validate_init_cam():
@@ -236,62 +1260,272 @@ def __get_cam():
 ### Public Functions ###
 
 def cam_node_cmd(cam_attr_str, cam_method_str, pyspin_mode_str=None, cam_method_arg=None):
-    return __cam_node_cmd(__get_and_validate_init_cam(),
-                          cam_attr_str,
-                          cam_method_str,
-                          pyspin_mode_str,
-                          cam_method_arg)
+    cam = __get_and_validate_init_cam()
+    result = __cam_node_cmd(cam,
+                            cam_attr_str,
+                            cam_method_str,
+                            pyspin_mode_str,
+                            cam_method_arg)
+
+    # Settings are applied live
+    if cam_method_str == 'SetValue':
+        __settings_changed(cam)
+
+    return result
+
+
+def apply_settings(settings, clamp=False):
+    # Writes several settings in one batch, e.g. {'ExposureTime': 5000, 'AcquisitionFrameRate': 20}.
+    # Keys are node names (or 'exposure', 'frame_rate', 'gain', 'gamma'); values may be 'PySpin.X'
+    # strings. Nodes are written in dependency order and checked against their cached min/max
+    # first; out of range values raise, or are clamped if "clamp" is set. Frames taken before the
+    # batch are only marked stale once. Returns the values written, keyed by node name.
+    return __apply_settings(__get_and_validate_init_cam(), settings, clamp)
+
+
+def set_verbose(verbose):
+    # Enables printing of every node command
+    global __VERBOSE
+    __VERBOSE = verbose
 
 
 def get_image():
     # Gets image from camera 
-    return __get_image(__get_and_validate_streaming_cam())
+    cam = __get_and_validate_streaming_cam()
+    if __CAPTURE['thread'] is not None:
+        ring = __CAPTURE['ring']
+        timeout = __frame_timeout(cam)
+        return __get_frame(ring, max(ring['next_seq'], __ring_wait_ready(ring, timeout)), timeout)
+    return __get_image(cam)
+
+
+def get_image_and_avg(num_to_avg, avg_mode='mean', done=None):
+    # Gets and averages images from camera; "avg_mode" is one of frameproc.avg_modes(). "done" is
+    # called once the last frame is in, so e.g. the next LED can be switched while the average is
+    # computed.
+    cam = __get_and_validate_streaming_cam()
+    if __CAPTURE['thread'] is not None:
+        return __get_ring_image_and_avg(__CAPTURE['ring'], num_to_avg, avg_mode,
+                                        __frame_timeout(cam), done=done)
+    image_dict = __get_image_and_avg(cam, num_to_avg, avg_mode)
+    if done is not None:
+        done()
+    return image_dict
+
+
+def get_frames_and_avg(seq, num_to_avg, avg_mode='mean', timeout=None):
+    # Averages the "num_to_avg" frames starting at sequence number "seq", e.g. frames of an
+    # externally triggered sequence whose first frame is known. "timeout" is per frame.
+    if timeout is None:
+        timeout = __frame_timeout(__get_cam())
+    return __get_ring_image_and_avg(__get_ring(__CAPTURE), num_to_avg, avg_mode, timeout, seq=seq)
+
+
+def get_triggered_image_and_avg(num_to_avg, avg_mode='mean'):
+    # Software triggers exactly "num_to_avg" exposures and averages them. Requires
+    # set_trigger('Software') and a running capture engine.
+    cam = __get_and_validate_streaming_cam()
+    return __get_ring_image_and_avg(__get_ring(__CAPTURE), num_to_avg, avg_mode,
+                                    __frame_timeout(cam),
+                                    functools.partial(__software_trigger, cam))
+
+
+def start_preview(interval=__PREVIEW_INTERVAL, factor=__PREVIEW_BIN):
+    # Starts live preview: every "interval" seconds the newest captured frame is block-mean binned
+    # by "factor" on a separate thread. Frames the display doesn't pick up in time are replaced,
+    # not queued, and acquisitions reading the ring never lose frames to the preview.
+    __start_preview(interval, factor)
+
+
+def stop_preview():
+    # Stops live preview
+    __stop_preview()
+
+
+def get_preview(last_seq=None):
+    # Returns latest binned preview frame, or None if there is none newer than "last_seq". Never
+    # waits for the camera.
+    return __get_preview(last_seq)
+
+
+def get_histogram(num_bins=__HIST_BINS, last_seq=None):
+    # Returns decaying histogram of the live stream, or None if there is none newer than
+    # "last_seq". 'hist' holds the fraction of pixels per bin over [0, 2**bitsperpixel) and
+    # 'saturation' the percentage of saturated pixels in the newest frame. Needs start_preview().
+    return __get_histogram(num_bins, last_seq)
+
+
+def get_frame(seq, timeout=None):
+    # Gets frame "seq" from capture engine. If it was already overwritten, the oldest available
+    # frame is returned and image_dict['overrun'] holds the number of lost frames
+    if timeout is None:
+        timeout = __frame_timeout(__get_cam())
+    return __get_frame(__get_ring(__CAPTURE), seq, timeout)
+
+
+def wait_ready(timeout=None):
+    # Waits for the first frame taken with the current settings and returns its sequence number
+    if timeout is None:
+        timeout = __frame_timeout(__get_cam())
+    return __ring_wait_ready(__get_ring(__CAPTURE), timeout)
+
+
+def mark_stale():
+    # Marks frames exposed up to now as stale, e.g. after the stage moved; later reads wait for a
+    # frame exposed entirely after this call. Returns the latched camera time, or None if the
+    # camera can't latch it.
+    timestamp = __latch_timestamp(__get_cam())
+    __ring_mark_settings_changed(__get_ring(__CAPTURE), timestamp)
+    return timestamp
+
+
+def is_streaming():
+    # Returns True if the capture engine is running
+    return __CAPTURE['thread'] is not None
+
 
+def get_next_seq():
+    # Returns sequence number the next captured frame will get
+    return __get_ring(__CAPTURE)['next_seq']
 
-def get_image_and_avg(num_to_avg):
-    # Gets and averages images from camera 
-    return __get_image_and_avg(__get_and_validate_streaming_cam(), num_to_avg)
+
+def get_capture_stats():
+    # Returns capture engine counters
+    ring = __get_ring(__CAPTURE)
+    with ring['cond']:
+        return {'frames': ring['next_seq'],
+                'overruns': ring['overruns'],
+                'dropped': ring['dropped'],
+                'incomplete': ring['incomplete'],
+                'num_buffers': ring['buffers'].shape[0]}
 
 
 def end_acquisition():
     # Ends acquisition
-    __get_and_validate_streaming_cam().EndAcquisition()
+    cam = __get_and_validate_streaming_cam()
+    __stop_capture(__CAPTURE)
+    cam.EndAcquisition()
 
 
 def find_cam(cam_serial):
-    # Finds Camera
-    global __CAM
-
+    # Finds camera with serial "cam_serial" (an empty serial takes the first one) and selects it;
+    # cameras opened before are closed
     cam = __find_cam(cam_serial)
 
     # Cleanup AFTER new camera is found successfully
     __cleanup_cam()
 
     # Assign camera
-    __CAM = cam
+    cam_dict = __open_cam(cam)
+    __select_cam(cam_dict['cam'], cam_dict['capture'])
+
+    print('Found camera ' + __get_serial(cam))
+
+
+def add_cam(cam_serial):
+    # Finds camera with serial "cam_serial" and opens it next to the open ones. Single camera
+    # functions keep acting on the selected camera; use select_cam() or for_each_cam().
+    cam_dict = __open_cam(__find_cam(cam_serial))
+    if __CAM is None:
+        __select_cam(cam_dict['cam'], cam_dict['capture'])
+
+    print('Added camera ' + __get_serial(cam_dict['cam']))
+
+
+def select_cam(cam_serial):
+    # Makes single camera functions (settings, ROI, get_image_and_avg() ...) act on open camera
+    # "cam_serial"; a running live preview switches to it
+    cam_dict = __get_cam_dict(cam_serial)
+    __select_cam(cam_dict['cam'], cam_dict['capture'])
+    if __PREVIEW['thread'] is not None:
+        __start_preview(__PREVIEW['interval'], __PREVIEW['factor'])
+
+
+def list_cams():
+    # Returns serials of connected cameras
+    return __list_cams()
+
+
+def get_system_init_time():
+    # Returns seconds it took to create the Spinnaker system, or None if it wasn't needed yet
+    return __SYSTEM_INIT_TIME
+
 
-    print('Found camera')
+def get_cam_serials():
+    # Returns serials of open cameras, in the order they were opened
+    return tuple(__CAMS)
+
+
+def get_cam_serial():
+    # Returns serial of selected camera
+    return __get_serial(__get_cam())
+
+
+def for_each_cam(func, *args, **kwargs):
+    # Calls single camera function func(*args, **kwargs) with every open camera selected in turn,
+    # e.g. for_each_cam(set_exposure, 5000). Returns results keyed by serial.
+    results = {}
+    selected = (__CAM, __CAPTURE)
+    try:
+        for cam_serial, cam_dict in __CAMS.items():
+            __select_cam(cam_dict['cam'], cam_dict['capture'])
+            results[cam_serial] = func(*args, **kwargs)
+    finally:
+        __select_cam(*selected)
+
+    return results
+
+
+def start_acquisitions(num_buffers=__NUM_BUFFERS):
+    # Starts acquisition and grab thread of every open camera that isn't streaming yet; every
+    # camera is drained by its own thread
+    for cam_dict in __CAMS.values():
+        cam = cam_dict['cam']
+        __validate_cam_init(cam, 'Camera')
+        if not cam.IsStreaming():
+            cam.BeginAcquisition()
+            __start_capture(cam, num_buffers, cam_dict['capture'])
+
+
+def end_acquisitions():
+    # Ends acquisition of every open camera
+    for cam_dict in __CAMS.values():
+        if cam_dict['cam'].IsStreaming():
+            __stop_capture(cam_dict['capture'])
+            cam_dict['cam'].EndAcquisition()
+
+
+def get_frame_set(num_to_avg, avg_mode='mean'):
+    # Gets and averages "num_to_avg" frames of every open camera at once. Cameras set up with
+    # set_trigger('Software') are triggered together for each frame; free running cameras, and
+    # cameras triggered by a shared hardware line, use the frames exposed after this call.
+    # Returns image dicts keyed by serial.
+    return __frame_set(num_to_avg, avg_mode)
+
+
+def stream_frames(num_frames, callback):
+    # Hands the next "num_frames" frames of every open camera to callback(cam_serial, image_dict),
+    # in order and from one thread per camera, e.g. to append them to a stack per camera. Returns
+    # 'frames' and 'overruns' keyed by serial.
+    for cam_serial, cam_dict in __CAMS.items():
+        __validate_cam_streaming(cam_dict['cam'], cam_serial)
+    return __run_per_cam(__stream_cam, num_frames, callback)
 
 
 def set_gain(gain):
-    cam_node_cmd('Gain',
-                 'SetValue',
-                 'RW',
-                 gain)
+    # Sets gain, clamped to its limits; returns gain set
+    return apply_settings({'Gain': gain}, clamp=True)['Gain']
 
 
 def set_exposure(exposure):
-    cam_node_cmd('ExposureTime',
-                 'SetValue',
-                 'RW',
-                 exposure)
+    # Sets exposure, clamped to its limits; returns exposure set
+    return apply_settings({'ExposureTime': exposure}, clamp=True)['ExposureTime']
 
 
 def set_frame_rate(frame_rate):
-    cam_node_cmd('AcquisitionFrameRate',
-                 'SetValue',
-                 'RW',
-                 frame_rate)
+    # Sets frame rate, clamped to its limits; returns frame rate set
+    return apply_settings({'AcquisitionFrameRate': frame_rate},
+                          clamp=True)['AcquisitionFrameRate']
 
 
 def disable_auto_exp():
@@ -342,6 +1576,42 @@ def set_gamma(gamma_val):
                  gamma_val)
 
 
+def set_trigger(trigger_source='Software', trigger_selector='FrameStart'):
+    # Enables triggered acquisition; "trigger_source" is e.g. 'Software' or 'Line0'
+    print('Setting trigger to ' + trigger_source + ' (' + trigger_selector + ')')
+
+    # Trigger has to be off while it's being configured
+    cam_node_cmd('TriggerMode',
+                 'SetValue',
+                 'RW',
+                 'PySpin.TriggerMode_Off')
+    cam_node_cmd('TriggerSelector',
+                 'SetValue',
+                 'RW',
+                 'PySpin.TriggerSelector_' + trigger_selector)
+    cam_node_cmd('TriggerSource',
+                 'SetValue',
+                 'RW',
+                 'PySpin.TriggerSource_' + trigger_source)
+    cam_node_cmd('TriggerMode',
+                 'SetValue',
+                 'RW',
+                 'PySpin.TriggerMode_On')
+
+
+def disable_trigger():
+    print('Disabling trigger')
+    cam_node_cmd('TriggerMode',
+                 'SetValue',
+                 'RW',
+                 'PySpin.TriggerMode_Off')
+
+
+def software_trigger():
+    # Fires a single software trigger
+    __software_trigger(__get_and_validate_init_cam())
+
+
 def get_exp_min():
     return cam_node_cmd('ExposureTime', 'GetMin')
 
@@ -364,15 +1634,110 @@ def get_frame_rate():
 
 
 def init_cam():
-    # Initializes camera
+    # Initializes camera; nodes are resolved again afterwards
+    __clear_registry(__get_cam())
     __init_cam(__get_cam())
 
 
-def start_acquisition():
-    # Starts acquisition
-    __get_and_validate_init_cam().BeginAcquisition()
+def start_acquisition(num_buffers=__NUM_BUFFERS):
+    # Starts acquisition and grab thread
+    cam = __get_and_validate_init_cam()
+    cam.BeginAcquisition()
+    __start_capture(cam, num_buffers, __CAPTURE)
+
+
+def set_roi(offset_x, offset_y, width, height):
+    # Crops sensor readout to a region of interest, in pixels of the (binned) sensor. Values are
+    # snapped to the camera's increments and clamped to the sensor; a running acquisition is
+    # restarted with buffers of the new size. Frame rate and exposure limits change with the
+    # ROI, so re-read them with get_fps_max() etc. Returns the ROI that was set.
+    return __restart_after(__roi, offset_x, offset_y, width, height)
+
 
+def reset_roi():
+    # Reads out the full sensor again
+    return set_roi(0, 0, __get_node(__get_cam(), 'WidthMax').GetValue(),
+                   __get_node(__get_cam(), 'HeightMax').GetValue())
 
-def roi():
-    # Select Region of Interest
-    return __roi()
+
+def get_roi():
+    # Returns current ROI: offset_x, offset_y, width, height, and max_width, max_height of the
+    # sensor
+    return __get_roi(__get_and_validate_init_cam())
+
+
+def set_binning(horizontal, vertical=None, mode='Sum', selector='All'):
+    # Bins pixels on the camera; "mode" is 'Sum' or 'Average', "selector" e.g. 'Sensor' or 'ISP'.
+    # "vertical" defaults to "horizontal". The ROI is reset to the full binned sensor and a
+    # running acquisition is restarted with buffers of the new size. Returns the acquisition mode,
+    # see get_acq_mode().
+    if vertical is None:
+        vertical = horizontal
+    return __restart_after(__geometry, {'BinningSelector': selector,
+                                        'BinningHorizontalMode': mode,
+                                        'BinningVerticalMode': mode,
+                                        'BinningHorizontal': horizontal,
+                                        'BinningVertical': vertical})
+
+
+def set_decimation(horizontal, vertical=None):
+    # Skips pixels on the camera; see set_binning()
+    if vertical is None:
+        vertical = horizontal
+    return __restart_after(__geometry, {'DecimationHorizontal': horizontal,
+                                        'DecimationVertical': vertical})
+
+
+def set_video_mode(mode):
+    # Sets video mode, e.g. 7 or 'Mode7'; see get_video_modes() for the modes of the camera.
+    # Cameras without the mode are left as they are; returns None then.
+    mode = str(mode)
+    if not mode.startswith('Mode'):
+        mode = 'Mode' + mode
+    if __missing_nodes(__get_and_validate_init_cam(), {'VideoMode': mode}):
+        print('Unable to set VideoMode to ' + mode + '. Skipping...')
+        return None
+    acq_mode = __restart_after(__geometry, {'VideoMode': mode})
+    print('Video Mode set to ' + acq_mode['video_mode'])
+    return acq_mode
+
+
+def set_pixel_format(pixel_format='Mono16'):
+    # Sets pixel format, e.g. 'Mono8' or 'Mono16'; frames are stored as uint16 either way
+    acq_mode = __restart_after(__geometry, {'PixelFormat': pixel_format})
+    print('Pixel format is set %s...' % acq_mode['pixel_format'])
+    return acq_mode
+
+
+def set_acq_mode(acq_mode):
+    # Sets one of the binning/decimation presets in acq_modes(), e.g. 'bin2_sum'
+    if acq_mode not in __ACQ_MODES:
+        raise RuntimeError('Acquisition mode: "' + str(acq_mode) + '" is not supported. Options '
+                           'are: ' + str(tuple(__ACQ_MODES)))
+    missing = __missing_nodes(__get_and_validate_init_cam(), __ACQ_MODES[acq_mode])
+    if missing:
+        raise RuntimeError('Acquisition mode: "' + acq_mode + '" is not supported by this camera, '
+                           'which lacks ' + str(tuple(missing)) + '. Options are: ' +
+                           str(acq_modes()))
+    return __restart_after(__geometry, __ACQ_MODES[acq_mode])
+
+
+def acq_modes():
+    # Returns names of the binning/decimation presets; once a camera is initialized, only those
+    # it has the nodes for
+    if __CAM is None or not __CAM.IsValid() or not __CAM.IsInitialized():
+        return tuple(__ACQ_MODES)
+    return tuple(name for name, settings in __ACQ_MODES.items()
+                 if not __missing_nodes(__CAM, settings))
+
+
+def get_acq_mode():
+    # Returns binning_selector, binning_horizontal, binning_vertical, binning_horizontal_mode,
+    # binning_vertical_mode, decimation_horizontal, decimation_vertical, video_mode and
+    # pixel_format; None for nodes the camera doesn't have
+    return __get_acq_mode(__get_and_validate_init_cam())
+
+
+def get_video_modes():
+    # Returns names of the video modes the camera supports
+    return __enum_entries(__get_and_validate_init_cam(), 'VideoMode')
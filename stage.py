@@ -1,72 +1,237 @@
-import thorlabs_apt as apt
 import time
+import backend
 __cntrl_x = None
 __cntrl_y = None
 __cntrl_z = None
 
-def __initialize_stages():
+# Motion params
+__MOVE_TIMEOUT = 30  # seconds
+__HOME_TIMEOUT = 60  # seconds for all axes to home
+__POLL_INTERVAL = 0.005  # seconds
+__START_GRACE = 0.2  # seconds to wait for a move to be reported before trusting "not in motion"
+__POS_TOL = 0.2e-3  # mm
+__ARRIVAL_TOL = 1e-3  # mm a stopped axis may be from its target before the move counts as failed
+__SETTLE_READS = 5
+# Settle time per axis in seconds; None measures it from position readback
+__SETTLE_TIME = {'x': 0.02, 'y': 0.02, 'z': 0.05}
+__LAST_MOVE = {'axis': None, 'move_time': None, 'settle_time': None}
+
+# SNs of the KDC101 devices
+__X_SERIAL = 27002265
+__Y_SERIAL = 27002165
+__Z_SERIAL = 27002158
+
+def __connect_stages():
     global __cntrl_x
     global __cntrl_y
     global __cntrl_z
 
+    # APT is loaded on first connect; importing thorlabs_apt initializes the driver
+    if backend.is_sim('stage'):
+        import simapt as apt
+    else:
+        import thorlabs_apt as apt
+
     # get current device lists
     devices = apt.list_available_devices()
 
-    # SNs of the KDC101 devices
-    x_stage = 27002265
-    y_stage = 27002165
-    z_stage = 27002158
-
     # initialize the motor controllers
-    __cntrl_x = apt.Motor(x_stage)
-    __cntrl_y = apt.Motor(y_stage)
-    __cntrl_z = apt.Motor(z_stage)
+    __cntrl_x = apt.Motor(__X_SERIAL)
+    __cntrl_y = apt.Motor(__Y_SERIAL)
+    __cntrl_z = apt.Motor(__Z_SERIAL)
     print('Stages are initialized...')
 
-    # default positions of x,y, and z all in microns
-    x_pos = 5
-    y_pos = 5
-    z_pos = 5
-    
-    # homing
-    print('Homing is started...')
-    __cntrl_x.move_home()
-    time.sleep(1)    # pause 5 to homing
-    __cntrl_y.move_home()
-    time.sleep(1)    # pause 5 to homing
-    __cntrl_z.move_home()
-    time.sleep(20)    # pause 5 to homing
-    print('Homing is finished...')
-
-    # go to home positions
-
-    # print('Going to default positions...')
-    # __cntrl_x.move_to(x_pos)
-    # time.sleep(1)
-    # __cntrl_y.move_to(y_pos)
-    # time.sleep(1)
-    # __cntrl_z.move_to(z_pos)
-    # time.sleep(20)    # pause 5 to homing
+def __axes():
+    # Returns (controller, axis) of every stage
+    return ((__cntrl_x, 'x'), (__cntrl_y, 'y'), (__cntrl_z, 'z'))
+
+
+def __home_stages(force=False, timeout=__HOME_TIMEOUT, confirm=None):
+    # Homes all axes at the same time and polls until each reports homing complete. Axes the
+    # controller reports as already referenced are skipped unless "force" is set. "confirm" is
+    # called before anything moves. Returns seconds each homed axis took; None if skipped.
+
+    times = {axis: None for _, axis in __axes()}
+    pending = [(cntrl, axis) for cntrl, axis in __axes()
+               if force or not cntrl.has_homing_been_completed]
+    if not pending:
+        print('Stages are already homed...')
+        return times
+
+    if confirm is not None:
+        confirm()
+
+    print('Homing ' + ', '.join(axis for _, axis in pending) + '...')
+    tic = time.perf_counter()
+    for cntrl, _ in pending:
+        cntrl.move_home(False)
+
+    # Completion is polled, so startup takes as long as the slowest axis. A forced home can still
+    # report the old homed flag before the move starts, so it's only trusted once the axis was
+    # seen moving or the start grace has passed.
+    moving = set()
+    while pending:
+        elapsed = time.perf_counter() - tic
+        for cntrl, axis in list(pending):
+            if cntrl.is_in_motion:
+                moving.add(axis)
+            elif cntrl.has_homing_been_completed and \
+                    (axis in moving or elapsed > __START_GRACE):
+                times[axis] = elapsed
+                pending.remove((cntrl, axis))
+        if pending and elapsed > timeout:
+            for cntrl, _ in pending:
+                cntrl.stop_profiled()
+            raise RuntimeError(', '.join(axis for _, axis in pending) +
+                               ' stage did not finish homing within ' + str(timeout) + ' s.')
+        time.sleep(__POLL_INTERVAL)
+
+    print('Homing is finished in %.1f s...' % (time.perf_counter() - tic))
+    return times
+
+
+def __initialize_stages(force=False, timeout=__HOME_TIMEOUT, confirm=None):
+    # Connects and homes stages; see __home_stages()
+
+    __connect_stages()
+    times = __home_stages(force, timeout, confirm)
     print('Stages are ready...')
+    return times
 
 
+def __wait_motion(cntrl, axis, target, timeout):
+    # Waits until controller stops moving at target, then until axis settles. Returns move and
+    # settle durations in seconds; raises if the axis stopped short, e.g. because it stalled, hit
+    # a limit switch or the controller faulted.
 
-def __go_y(position):
+    tic = time.perf_counter()
+
+    # Motion may not have been reported yet right after the command, so also check position
+    while True:
+        elapsed = time.perf_counter() - tic
+        if not cntrl.is_in_motion:
+            if abs(cntrl.position - target) <= __POS_TOL or elapsed > __START_GRACE:
+                break
+        if elapsed > timeout:
+            raise RuntimeError(axis + ' stage did not finish moving within ' + str(timeout) + ' s.')
+        time.sleep(__POLL_INTERVAL)
+    move_time = time.perf_counter() - tic
+
+    error = cntrl.position - target
+    if abs(error) > __ARRIVAL_TOL:
+        raise RuntimeError('%s stage stopped %.2f um from its target after %.2f s; it may have '
+                           'stalled, hit a limit switch or faulted.' % (axis, error * 1e3,
+                                                                        move_time))
+
+    # Settle
+    tic = time.perf_counter()
+    settle_time = __SETTLE_TIME[axis]
+    if settle_time is None:
+        # Measured - wait until successive position readings agree
+        last_pos = cntrl.position
+        num_stable = 0
+        while num_stable < __SETTLE_READS:
+            time.sleep(__POLL_INTERVAL)
+            pos = cntrl.position
+            num_stable = num_stable + 1 if abs(pos - last_pos) <= __POS_TOL else 0
+            last_pos = pos
+            if time.perf_counter() - tic > timeout:
+                raise RuntimeError(axis + ' stage did not settle within ' + str(timeout) + ' s.')
+    elif settle_time > 0:
+        time.sleep(settle_time)
+    settle_time = time.perf_counter() - tic
+
+    __LAST_MOVE['axis'] = axis
+    __LAST_MOVE['move_time'] = move_time
+    __LAST_MOVE['settle_time'] = settle_time
+    return {'move_time': move_time, 'settle_time': settle_time}
+
+
+def __move_by(cntrl, axis, position, wait, timeout):
+    # Moves axis by position (um); optionally waits for motion to complete
+
+    target = cntrl.position + position*1e-3
+    cntrl.move_by(position*1e-3)
+    if not wait:
+        return None
+    return __wait_motion(cntrl, axis, target, timeout)
+
+
+def __go_y(position, wait=True, timeout=__MOVE_TIMEOUT):
     global __cntrl_y
     # go to positions
-    __cntrl_y.move_by(position*1e-3)
+    return __move_by(__cntrl_y, 'y', position, wait, timeout)
 
 
-def __go_x(position):
+def __go_x(position, wait=True, timeout=__MOVE_TIMEOUT):
     global __cntrl_x
     # go to positions
-    __cntrl_x.move_by(position*1e-3)
+    return __move_by(__cntrl_x, 'x', position, wait, timeout)
 
 
-def __go_z(position):
+def __go_z(position, wait=True, timeout=__MOVE_TIMEOUT):
     global __cntrl_z
     # go to positions
-    __cntrl_z.move_by(position*1e-3)
+    return __move_by(__cntrl_z, 'z', position, wait, timeout)
+
+
+def __go_xy(x_position, y_position, wait=True, timeout=__MOVE_TIMEOUT):
+    # Moves x and y by position (um) at the same time. Without wait, returns the pending moves for
+    # __wait_moves(), so other work can run while the stage travels.
+    global __cntrl_x
+    global __cntrl_y
+
+    pending = []
+    for cntrl, axis, position in ((__cntrl_x, 'x', x_position), (__cntrl_y, 'y', y_position)):
+        if position:
+            pending.append((cntrl, axis, cntrl.position + position*1e-3))
+            cntrl.move_by(position*1e-3)
+    if not wait:
+        return pending
+    return __wait_moves(pending, timeout)
+
+
+def __move_to(x_position=None, y_position=None, z_position=None, wait=True,
+              timeout=__MOVE_TIMEOUT):
+    # Moves axes to absolute positions (um) at the same time; None leaves an axis where it is.
+    # Without wait, returns the pending moves for __wait_moves().
+
+    pending = []
+    for (cntrl, axis), position in zip(__axes(), (x_position, y_position, z_position)):
+        if position is not None:
+            pending.append((cntrl, axis, position*1e-3))
+            cntrl.move_to(position*1e-3)
+    if not wait:
+        return pending
+    return __wait_moves(pending, timeout)
+
+
+def __get_positions():
+    # Returns (x, y, z) encoder positions in um
+    return tuple(cntrl.position*1e3 for cntrl, _ in __axes())
+
+
+def __wait_moves(pending, timeout=__MOVE_TIMEOUT):
+    # Waits for moves started by __go_xy(wait=False); returns the longest move and settle
+    # durations in seconds
+
+    move_dict = {'move_time': 0.0, 'settle_time': 0.0}
+    tic = time.perf_counter()
+    for cntrl, axis, target in pending:
+        axis_dict = __wait_motion(cntrl, axis, target, timeout)
+        move_dict['settle_time'] = max(move_dict['settle_time'], axis_dict['settle_time'])
+    move_dict['move_time'] = time.perf_counter() - tic - move_dict['settle_time']
+    return move_dict
+
+
+def __set_settle_time(axis, settle_time):
+    # Sets settle time (s) of axis; None measures it from position readback on every move
+    __SETTLE_TIME[axis] = settle_time
+
+
+def __get_last_move():
+    # Returns axis, move and settle durations of the last completed move
+    return dict(__LAST_MOVE)
 
 def __check_objective():
     var = input("Is objective unmounted (Y/N): ")
@@ -0,0 +1,267 @@
+import json
+import time
+import queue
+import atexit
+import threading
+
+# Writer params
+__DEPTH = 8
+__NUM_THREADS = 2
+
+# Each writer thread owns a bounded queue; jobs are routed by file name so appends to the same
+# file are always written in order by the same thread
+__WRITER_DICT = {'queues': [], 'threads': []}
+__ERRORS = []
+__STATS = {'files': 0, 'bytes': 0, 'write_time': 0.0, 'blocked_time': 0.0}
+__LOCK = threading.Lock()
+
+# Open BigTIFF stacks, keyed by file name
+__STACKS = {}
+
+
+def __destructor():
+    print('Flushing TIFF writer...')
+
+    with __LOCK:
+        running = bool(__WRITER_DICT['threads'])
+    if running:
+        try:
+            __stop()
+        except RuntimeError as ex:
+            print('Error: %s' % ex)
+
+
+atexit.register(__destructor)
+
+
+def __writer_loop(job_queue):
+    # Writer thread; writes jobs until it receives None
+
+    while True:
+        job = job_queue.get()
+        try:
+            if job is None:
+                return
+            _, write_func, args = job
+            tic = time.perf_counter()
+            num_bytes = write_func(*args)
+            toc = time.perf_counter()
+            with __LOCK:
+                __STATS['bytes'] += num_bytes
+                __STATS['write_time'] += toc - tic
+        except Exception as ex:  # pylint: disable=broad-except
+            with __LOCK:
+                __ERRORS.append((job[0], ex))
+        finally:
+            job_queue.task_done()
+
+
+def __tifffile():
+    # Returns tifffile; imported by the first write so importing tiffwriter stays cheap
+
+    from skimage.external import tifffile as ski
+    return ski
+
+
+def __write_file(file_name, data, kwargs):
+    # Writes a standalone TIFF (or appends to one)
+
+    __tifffile().imsave(file_name, data, **kwargs)
+    with __LOCK:
+        __STATS['files'] += 1
+    return data.nbytes
+
+
+def __write_plane(stack, data):
+    # Appends plane to BigTIFF stack; planes are stored contiguously so each one is a single
+    # sequential write
+
+    if stack['writer'] is None:
+        stack['writer'] = __tifffile().TiffWriter(stack['file_name'], bigtiff=True)
+        stack['plane_shape'] = data.shape
+        shape = list(stack['shape']) + list(data.shape)
+        stack['writer'].save(data,
+                             contiguous=True,
+                             description=json.dumps({'shape': shape, 'axes': stack['axes']}),
+                             metadata=None)
+        with __LOCK:
+            __STATS['files'] += 1
+    else:
+        if data.shape != stack['plane_shape']:
+            raise RuntimeError('Plane shape ' + str(data.shape) + ' does not match stack plane shape ' +
+                               str(stack['plane_shape']) + '.')
+        stack['writer'].save(data, contiguous=True, metadata=None)
+
+    stack['count'] += 1
+    return data.nbytes
+
+
+def __close_stack_writer(stack):
+    # Closes BigTIFF stack
+
+    if stack['writer'] is not None:
+        stack['writer'].close()
+        stack['writer'] = None
+
+    num_planes = 1
+    for dim in stack['shape']:
+        num_planes *= dim
+    if stack['count'] != num_planes:
+        print('Warning: stack "' + stack['file_name'] + '" holds ' + str(stack['count']) +
+              ' of ' + str(num_planes) + ' planes.')
+    return 0
+
+
+def __open_stack(file_name, shape, axes):
+    # Registers new BigTIFF stack; file is created when the first plane arrives so the plane
+    # geometry is taken from the data
+
+    if file_name in __STACKS:
+        raise RuntimeError('Stack "' + file_name + '" is already open.')
+    if len(axes) != len(shape) + 2:
+        raise RuntimeError('Axes "' + axes + '" do not match stack shape ' + str(shape) +
+                           ' plus image axes.')
+
+    __STACKS[file_name] = {'file_name': file_name,
+                           'shape': tuple(shape),
+                           'axes': axes,
+                           'plane_shape': None,
+                           'count': 0,
+                           'writer': None}
+
+
+def __close_stack(file_name):
+    # Queues closing of stack and waits for it to be written. The close is queued even after a
+    # failed write, so the file is always finalized; earlier failures are raised afterwards.
+
+    stack = __STACKS.pop(file_name)
+    if __WRITER_DICT['threads']:
+        __enqueue(file_name, __close_stack_writer, (stack,))
+    else:
+        __close_stack_writer(stack)
+    __flush()
+
+
+def __start(depth, num_threads):
+    # Starts writer threads
+
+    __stop()
+
+    depth_per_thread = max(1, depth // num_threads)
+    for i in range(num_threads):
+        job_queue = queue.Queue(maxsize=depth_per_thread)
+        thread = threading.Thread(target=__writer_loop, args=(job_queue,),
+                                  name='tiffwriter-' + str(i), daemon=True)
+        __WRITER_DICT['queues'].append(job_queue)
+        __WRITER_DICT['threads'].append(thread)
+        thread.start()
+
+
+def __stop():
+    # Closes open stacks, flushes pending writes and stops writer threads
+
+    try:
+        for file_name in list(__STACKS):
+            stack = __STACKS.pop(file_name)
+            if __WRITER_DICT['threads']:
+                __enqueue(file_name, __close_stack_writer, (stack,))
+        __flush()
+    finally:
+        for job_queue in __WRITER_DICT['queues']:
+            job_queue.put(None)
+        for thread in __WRITER_DICT['threads']:
+            thread.join()
+        __WRITER_DICT['queues'] = []
+        __WRITER_DICT['threads'] = []
+
+
+def __raise_errors():
+    # Re-raises first failed write on the caller's thread
+
+    with __LOCK:
+        errors = list(__ERRORS)
+        __ERRORS.clear()
+
+    if errors:
+        file_name, ex = errors[0]
+        raise RuntimeError(str(len(errors)) + ' TIFF write(s) failed. First failure: "' +
+                           file_name + '": ' + str(ex)) from ex
+
+
+def __flush():
+    # Blocks until every queued write is on disk
+
+    for job_queue in __WRITER_DICT['queues']:
+        job_queue.join()
+    __raise_errors()
+
+
+def __put(file_name, write_func, args):
+    # Queues write after checking for earlier failures
+
+    __raise_errors()
+
+    if not __WRITER_DICT['threads']:
+        __start(__DEPTH, __NUM_THREADS)
+
+    __enqueue(file_name, write_func, args)
+
+
+def __enqueue(file_name, write_func, args):
+    # Queues write; blocks while the writer for this file is full
+
+    queues = __WRITER_DICT['queues']
+    job_queue = queues[hash(file_name) % len(queues)]
+
+    tic = time.perf_counter()
+    job_queue.put((file_name, write_func, args))
+    with __LOCK:
+        __STATS['blocked_time'] += time.perf_counter() - tic
+
+
+### Public Functions ###
+
+def start(depth=__DEPTH, num_threads=__NUM_THREADS):
+    # Starts writer with "num_threads" threads and at most "depth" queued images
+    __start(depth, num_threads)
+
+
+def submit(file_name, data, **kwargs):
+    # Queues data to be written with imsave(file_name, data, **kwargs). The writer takes ownership
+    # of data, so it must not be modified afterwards. Blocks while the writer is behind (backpressure)
+    # and raises if a previous write failed.
+    __put(file_name, __write_file, (file_name, data, kwargs))
+
+
+def open_stack(file_name, shape, axes):
+    # Opens a single BigTIFF holding every plane of a run. "shape" gives the leading dimensions,
+    # e.g. (num_time, num_z), and "axes" names all dimensions including the image, e.g. 'TZYX'.
+    # Shape and axes are recorded as JSON in the image description of the first page.
+    __open_stack(file_name, shape, axes)
+
+
+def submit_plane(file_name, data):
+    # Queues next plane of an open stack; planes must be submitted in C order of the stack shape.
+    # Same ownership and backpressure rules as submit().
+    __put(file_name, __write_plane, (__STACKS[file_name], data))
+
+
+def close_stack(file_name):
+    # Closes stack after its queued planes are written; raises if any write failed
+    __close_stack(file_name)
+
+
+def flush():
+    # Waits for all queued writes and raises if any of them failed
+    __flush()
+
+
+def stop():
+    # Flushes and stops writer threads
+    __stop()
+
+
+def get_stats():
+    # Returns writer counters
+    with __LOCK:
+        return dict(__STATS)